@@ -37,5 +37,10 @@ setup(name='wiki_toc',
       entry_points="""\
       [paste.app_factory]
       main = wiki_toc:main
+      [console_scripts]
+      wiki_toc_bulk = wiki_toc.bulk:main
+      wiki_toc_index = wiki_toc.index:main
+      wiki_toc_benchmark = wiki_toc.benchmarks.run:main
+      wiki_toc_warmup = wiki_toc.warmup:main
       """,
       )
@@ -1,4 +1,15 @@
 from pyramid.config import Configurator
+from pyramid.events import BeforeRender
+
+from .cache import cache_from_settings
+from .engine import batch_engine_from_settings, engine_from_settings
+from .fetcher import fetcher_from_settings
+from .index import index_from_settings
+from .metrics import before_render, metrics_from_settings
+from .refresher import Refresher
+from .responses import responses_from_settings
+from .singleflight import SingleFlight
+from .warmup import popularity_from_settings, start_warmup
 
 
 def main(global_config, **settings):
@@ -6,8 +17,28 @@ def main(global_config, **settings):
     """
     config = Configurator(settings=settings)
     config.include('pyramid_chameleon')
+    config.registry.toc_cache = cache_from_settings(settings)             # Shared by the views through request.registry
+    config.registry.fetcher = fetcher_from_settings(settings)             # Pooled keep-alive connections to wikipedia
+    config.registry.toc_flights = SingleFlight()                          # Coalesces concurrent fetches of the same page
+    config.registry.toc_refresher = Refresher()                           # Refreshes stale tables of contents in the background
+    config.registry.fetch_engine = engine_from_settings(settings)         # Worker threads which fetch pages for the views
+    config.registry.batch_engine = batch_engine_from_settings(settings)   # Separate worker threads for /wiki_toc_batch
+    config.registry.toc_index = index_from_settings(settings)             # Precomputed tables of contents, read through mmap
+    config.registry.response_cache = responses_from_settings(settings)     # Rendered and compressed wiki_toc pages
+    config.registry.metrics = metrics_from_settings(settings)             # Per stage latency histograms and error counters
+    if config.registry.metrics is not None:
+        config.add_tween('wiki_toc.metrics.metrics_tween_factory')        # Times each request
+        config.add_subscriber(before_render, BeforeRender)                # Times the rendering of templates
+    config.registry.popularity = popularity_from_settings(settings)       # Recent requests, loaded from the popularity list
+    if config.registry.popularity is not None:
+        config.add_tween('wiki_toc.warmup.popularity_tween_factory')      # Counts the requests for each page
     config.add_static_view('static', 'static', cache_max_age=3600)
     config.add_route('choose_wiki_page', '/')                           # The default page where the user chooses the Wikipaedia TOC to view
     config.add_route('wiki_toc', '/wiki_toc/*wiki_location')
+    config.add_route('wiki_toc_json', '/wiki_toc_json/*wiki_location')  # The TOC as a json tree for machine clients
+    config.add_route('wiki_toc_batch', '/wiki_toc_batch')               # POST a json list of urls to get many TOCs at once
+    config.add_route('cache_stats', '/cache_stats')                     # Hit, miss and eviction counters for the toc cache
+    config.add_route('metrics', '/metrics')                             # The metrics in the Prometheus text format
     config.scan()
+    config.registry.warmup_scheduler = start_warmup(config.registry, settings)  # Fills the cache with popular pages
     return config.make_wsgi_app()
@@ -0,0 +1,14 @@
+""" Benchmarks for the pipeline which turns a wikipedia page into a table of contents.
+
+    Usage: wiki_toc_benchmark [options]
+
+    Nothing is fetched from wikipedia. A corpus of article html is either generated (see corpus.py) or read from a
+    directory of saved pages and served by a local stand-in for wikipedia with configurable latency. The benchmarks are:
+
+        micro.py    UrlManager, href rewriting, parsing, extraction and rendering, each run in isolation
+        load.py     requests to the wsgi app through WebTest and through a real waitress server, with the app's fetcher
+                    pointed at the stand-in server
+
+    Throughput, p50/p99 latency and the peak RSS during each benchmark are printed and written as json with --output
+    so that runs can be compared; --baseline prints the change from an earlier run. See run.py for the options.
+"""
@@ -0,0 +1,203 @@
+""" A corpus of article html and a local http server which serves it in place of wikipedia.
+
+    Generated articles are laid out like wikipedia's: a head with stylesheets and scripts, navigation, an infobox, the
+    lead, div#toc with nested sections and then the sections themselves. The table of contents is therefore found a few
+    kilobytes into the page, as it is on wikipedia, and the rest of the page is padded to the requested size.
+"""
+import BaseHTTPServer
+import SocketServer
+import gzip
+import random
+import threading
+import time
+from StringIO import StringIO
+
+from ..bulk import iter_directory
+
+_words = ("satchel strap leather bag school fashion history culture design canvas pocket buckle shoulder carry "
+          "student material century style market brand popular traditional modern craft worker city museum").split()
+
+
+def _sentence(rng, length):
+    words = [rng.choice(_words) for _ in range(length)]
+    return " ".join(words).capitalize() + "."
+
+def _paragraph(rng):
+    return "<p>%s</p>\n" % " ".join(_sentence(rng, rng.randint(8, 20)) for _ in range(rng.randint(3, 6)))
+
+def _sections(rng, count, max_depth):
+    """ Returns a list of (level, number, title) in document order
+    """
+    sections = []
+    numbers = [0] * (max_depth + 1)
+    level = 1
+    for _ in range(count):
+        if sections:
+            level = max(1, min(max_depth, level + rng.choice((-1, 0, 0, 1))))
+        numbers[level] += 1
+        for deeper in range(level + 1, max_depth + 1):
+            numbers[deeper] = 0
+        number = ".".join(str(numbers[index] or 1) for index in range(1, level + 1))
+        title = " ".join(rng.choice(_words) for _ in range(rng.randint(1, 4))).capitalize()
+        sections.append((level, number, "%s %s" % (title, number)))
+    return sections
+
+def _toc_html(sections):
+    parts = ['<div id="toc" class="toc" role="navigation" aria-labelledby="mw-toc-heading">'
+             '<input type="checkbox" role="button" id="toctogglecheckbox" class="toctogglecheckbox" style="display:none" />'
+             '<div class="toctitle" lang="en" dir="ltr"><h2 id="mw-toc-heading">Contents</h2></div>\n<ul>\n']
+    depth = 1
+    for index, (level, number, title) in enumerate(sections):
+        anchor = title.replace(" ", "_")
+        if index:
+            if level > depth:
+                parts.append("\n<ul>\n")
+            else:
+                parts.append("</li>\n")
+                for _ in range(depth - level):
+                    parts.append("</ul>\n</li>\n")
+        depth = level
+        parts.append('<li class="toclevel-%d tocsection-%d"><a href="#%s"><span class="tocnumber">%s</span> '
+                     '<span class="toctext">%s</span></a>' % (level, index + 1, anchor, number, title))
+    parts.append("</li>\n")
+    for _ in range(depth - 1):
+        parts.append("</ul>\n</li>\n")
+    parts.append("</ul>\n</div>\n")
+    return "".join(parts)
+
+def generate_article(title, sections=30, max_depth=3, payload_size=100 * 1024, seed=0):
+    """ Returns the html of an article with the given number of sections, padded to about payload_size bytes
+    """
+    rng = random.Random("%s-%s" % (seed, title))
+    outline = _sections(rng, sections, max_depth)
+    parts = ['<!DOCTYPE html>\n<html class="client-nojs" lang="en" dir="ltr">\n<head>\n<meta charset="UTF-8"/>\n'
+             '<title>%s - Wikipedia</title>\n' % title]
+    for index in range(6):
+        parts.append('<link rel="stylesheet" href="/w/load.php?lang=en&amp;modules=site.styles.%d&amp;only=styles&amp;skin=vector"/>\n' % index)
+        parts.append('<script>(RLQ=window.RLQ||[]).push(function(){mw.config.set({"wgPageName":"%s","wgIndex":%d});});</script>\n' % (title, index))
+    parts.append('</head>\n<body class="mediawiki ltr sitedir-ltr skin-vector">\n<div id="mw-navigation"><ul>\n')
+    for index in range(40):
+        parts.append('<li id="n-item-%d"><a href="/wiki/Special:Item_%d" title="Item %d">Item %d</a></li>\n' % (index, index, index, index))
+    parts.append('</ul></div>\n<div id="content" class="mw-body" role="main">\n<h1 id="firstHeading">%s</h1>\n'
+                 '<table class="infobox">\n' % title)
+    for index in range(12):
+        parts.append('<tr><th scope="row">%s</th><td>%s</td></tr>\n' % (rng.choice(_words).capitalize(), _sentence(rng, 4)))
+    parts.append("</table>\n")
+    for _ in range(3):
+        parts.append(_paragraph(rng))
+    parts.append(_toc_html(outline))
+    for level, number, section_title in outline:
+        heading = "h%d" % min(level + 1, 6)
+        parts.append('<%s><span class="mw-headline" id="%s">%s</span></%s>\n' % (
+            heading, section_title.replace(" ", "_"), section_title, heading))
+        parts.append(_paragraph(rng))
+    size = sum(len(part) for part in parts)
+    while size < payload_size:
+        paragraph = _paragraph(rng)
+        parts.append(paragraph)
+        size += len(paragraph)
+    parts.append("</div>\n</body>\n</html>\n")
+    return "".join(parts)
+
+def generate_corpus(pages=50, sections=30, payload_size=100 * 1024, seed=0):
+    """ Returns {wiki path: html} for generated articles, eg: {'/wiki/Article_0': ...}
+    """
+    return dict(("/wiki/Article_%d" % index, generate_article("Article %d" % index, sections,
+                                                              payload_size=payload_size, seed=seed))
+                for index in range(pages))
+
+def load_corpus(directory):
+    """ Returns {wiki path: html} for the saved article html in directory, which is read in the same way as by
+        wiki_toc_bulk, eg: Satchel.html is served as /wiki/Satchel
+    """
+    corpus = {}
+    for wiki_location, html in iter_directory(directory, "https://en.wikipedia.org/wiki"):
+        corpus["/" + wiki_location.split("/", 1)[1]] = html
+    return corpus
+
+
+class CorpusServer(object):
+    """ A threaded http server which serves the pages of a corpus, gzip encoded when asked, with keep-alive
+        Each response is delayed by latency seconds plus up to jitter seconds. Paths not in the corpus are 404.
+        Faults can be injected: a fraction error_rate of responses have the status error_status instead of the page,
+        with a Retry-After header of retry_after seconds if it is given. These may be changed while it is running.
+    """
+
+    def __init__(self, corpus, latency=0.0, jitter=0.0, host="127.0.0.1", port=0, error_rate=0.0, error_status=503,
+                 retry_after=None):
+        self.corpus = corpus
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.requests = 0
+        self.errors = 0
+        self._compressed = {}
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                delay = server.latency + (random.random() * server.jitter if server.jitter else 0)
+                if delay:
+                    time.sleep(delay)
+                html = server.corpus.get(self.path.split("?")[0])
+                if server.error_rate and random.random() < server.error_rate:
+                    with server._lock:
+                        server.errors += 1
+                    body, headers, status = "Injected fault", [], server.error_status
+                    if server.retry_after is not None:
+                        headers.append(("Retry-After", str(server.retry_after)))
+                elif html is None:
+                    body, headers, status = "Not found", [], 404
+                else:
+                    headers, status = [("ETag", '"%x"' % (hash(html) & 0xffffffff)),
+                                       ("Content-Type", "text/html; charset=UTF-8")], 200
+                    body = html
+                    if "gzip" in self.headers.get("Accept-Encoding", ""):
+                        body = server.compressed(self.path, html)
+                        headers.append(("Content-Encoding", "gzip"))
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+            request_queue_size = 128
+
+            def handle_error(self, request, client_address):
+                pass
+
+        self._server = Server((host, port), Handler)
+        self.url = "http://%s:%d" % self._server.server_address
+        self._thread = None
+
+    def compressed(self, path, html):
+        body = self._compressed.get(path)
+        if body is None:
+            buffer = StringIO()
+            with gzip.GzipFile(fileobj=buffer, mode="wb") as f:
+                f.write(html)
+            body = self._compressed[path] = buffer.getvalue()
+        return body
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="wiki_toc-corpus-server")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
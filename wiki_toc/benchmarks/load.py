@@ -0,0 +1,168 @@
+""" End-to-end load tests of the wsgi app with its fetcher pointed at a CorpusServer.
+
+    The same requests for the html table of contents are made through WebTest, which calls the app directly, and over
+    http to a real waitress server. A request fails if its status is not 200 or the page reports an error.
+"""
+import httplib
+import threading
+import timeit
+
+import waitress
+from webtest import TestApp
+
+from .. import main
+from .report import PeakRss, summarize
+
+clock = timeit.default_timer
+
+
+def app_settings(upstream, cache=False, **settings):
+    """ Returns the settings for an app which fetches pages from upstream
+        Without the caches every request fetches and renders its page, which is the path being measured. Requests to the stand-in
+        server are not rate limited but its circuit breakers still open when it fails.
+    """
+    defaults = {
+        "wiki_toc.fetch.upstream": upstream,
+        "wiki_toc.cache.enabled": "true" if cache else "false",
+        "wiki_toc.cache.backend": "memory",
+        "wiki_toc.responses.enabled": "true" if cache else "false",
+        "wiki_toc.upstream.rate": "0",
+    }
+    defaults.update(settings)
+    return defaults
+
+def make_app(settings):
+    return main({}, **settings)
+
+def close_app(app):
+    """ Stops the threads and connections held by an app made by make_app
+    """
+    for engine in (getattr(app.registry, "fetch_engine", None), getattr(app.registry, "batch_engine", None)):
+        if engine is not None:
+            engine.stop()
+    app.registry.fetcher.close()
+
+def request_paths(corpus, host="en.wikipedia.org"):
+    """ Returns the paths on the app of the table of contents of each page in corpus
+    """
+    return ["/wiki_toc/" + host + path for path in sorted(corpus)]
+
+def _failed(status, body):
+    return status != 200 or 'id="page-errors"' in body
+
+
+def run_load(name, client_factory, paths, requests, concurrency):
+    """ Makes requests for paths, in turn, from concurrency threads which each have a client from client_factory
+        A client is a function which takes a path and returns (status, body). One request is made before the timed
+        requests so that one-off costs, such as compiling the page template, are not included.
+    """
+    client_factory()(paths[0])
+    lock = threading.Lock()
+    issued = [0]
+    latencies = []
+    errors = [0]
+
+    def worker():
+        client = client_factory()
+        own_latencies = []
+        own_errors = 0
+        while True:
+            with lock:
+                index = issued[0]
+                if index >= requests:
+                    break
+                issued[0] += 1
+            before = clock()
+            try:
+                status, body = client(paths[index % len(paths)])
+                failed = _failed(status, body)
+            except Exception:
+                failed = True
+            own_latencies.append(clock() - before)
+            own_errors += failed
+        with lock:
+            latencies.extend(own_latencies)
+            errors[0] += own_errors
+
+    threads = [threading.Thread(target=worker, name="wiki_toc-load-%d" % index) for index in range(concurrency)]
+    rss = PeakRss()
+    started = clock()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(name, latencies, clock() - started, errors[0], rss=rss, concurrency=concurrency)
+
+
+def webtest_client_factory(app):
+    def factory():
+        test_app = TestApp(app)
+        def client(path):
+            response = test_app.get(path, status="*")
+            return response.status_int, response.text
+        return client
+    return factory
+
+def http_client_factory(host, port, timeout=30.0):
+    """ Clients which make requests over a keep-alive connection, reconnecting after an error
+    """
+    def factory():
+        state = dict(connection=None)
+        def client(path):
+            if state["connection"] is None:
+                state["connection"] = httplib.HTTPConnection(host, port, timeout=timeout)
+            try:
+                state["connection"].request("GET", path)
+                response = state["connection"].getresponse()
+                return response.status, response.read()
+            except Exception:
+                state["connection"].close()
+                state["connection"] = None
+                raise
+        return client
+    return factory
+
+
+class WaitressServer(object):
+    """ Serves app with waitress on a local port from a background thread
+    """
+
+    def __init__(self, app, threads=4, host="127.0.0.1"):
+        self._server = waitress.create_server(app, host=host, port=0, threads=threads,
+                                              clear_untrusted_proxy_headers=True)
+        self.host = host
+        self.port = self._server.effective_port
+        self._thread = threading.Thread(target=self._server.run, name="wiki_toc-waitress")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.task_dispatcher.shutdown()
+        self._server.close()
+
+
+def run_load_benchmarks(corpus, upstream, requests=500, concurrency=8, cache=False, waitress_threads=8):
+    """ Returns the results of the load tests through WebTest and waitress for an app fetching from upstream
+    """
+    paths = request_paths(corpus)
+    results = []
+    suffix = ".cached" if cache else ""
+
+    app = make_app(app_settings(upstream, cache))
+    try:
+        results.append(run_load("load.webtest" + suffix, webtest_client_factory(app), paths, requests, concurrency))
+    finally:
+        close_app(app)
+
+    app = make_app(app_settings(upstream, cache))
+    server = WaitressServer(app, threads=waitress_threads).start()
+    try:
+        results.append(run_load("load.waitress" + suffix, http_client_factory(server.host, server.port), paths,
+                                requests, concurrency))
+    finally:
+        server.stop()
+        close_app(app)
+    return results
@@ -0,0 +1,84 @@
+""" Micro-benchmarks of the individual steps of getting a table of contents, run against the pages of a corpus.
+"""
+import timeit
+import urlparse
+
+from bs4 import BeautifulSoup
+
+from ..extractor import extract_toc, iter_sections, render_toc_html
+from ..fetcher import FetchedPage
+from ..views import HrefRewriter, UrlManager
+from .report import PeakRss, summarize
+
+clock = timeit.default_timer
+
+
+def time_operation(name, operation, inputs, min_time=1.0, min_operations=10):
+    """ Calls operation with each of inputs in turn until it has been called at least min_operations times and for at
+        least min_time seconds. Returns the summary of the call durations.
+    """
+    latencies = []
+    rss = PeakRss()
+    started = clock()
+    index = 0
+    while True:
+        item = inputs[index % len(inputs)]
+        before = clock()
+        operation(item)
+        latencies.append(clock() - before)
+        index += 1
+        if index >= min_operations and clock() - started >= min_time:
+            break
+    return summarize(name, latencies, clock() - started, rss=rss)
+
+
+def _url_manager_rewrite(page):
+    """ The href rewriting done before HrefRewriter: a UrlManager for every link
+    """
+    url, hrefs = page
+    reference_url_object = urlparse.urlparse(url)
+    for href in hrefs:
+        url_manager = UrlManager(href)
+        url_manager.to_list()[5]
+        if url_manager.url_is_relative():
+            url_manager.absolute_url(reference_url_object)
+
+def _href_rewriter_rewrite(page):
+    url, hrefs = page
+    rewriter = HrefRewriter(url)
+    for href in hrefs:
+        rewriter.rewrite(href)
+
+def _normalize_uncached(url):
+    UrlManager._normalized.pop(url, None)
+    return UrlManager.normalize(url)
+
+
+def run_micro(corpus, min_time=1.0, base_url="https://en.wikipedia.org"):
+    """ Returns the results of the micro-benchmarks for the {wiki path: html} of corpus
+    """
+    html = [corpus[path] for path in sorted(corpus)]
+    urls = [base_url + path for path in sorted(corpus)]
+    # The pages without a table of contents are dropped together with their urls so that each toc keeps its url
+    pages = [(url, extract_toc(FetchedPage(page).iter_chunks())) for url, page in zip(urls, html)]
+    pages = [(url, toc) for url, toc in pages if toc]
+    if not pages:
+        raise ValueError("None of the pages in the corpus have a table of contents")
+    tocs = [toc for _, toc in pages]
+    links = [(url, [section["href"] for section in iter_sections(toc["sections"]) if section["href"]])
+             for url, toc in pages]
+    hrefs = [href for _, page_hrefs in links for href in page_hrefs]
+    reference_url_object = urlparse.urlparse(urls[0])
+
+    benchmarks = [
+        ("url_manager.absolute_url", lambda href: UrlManager(href).absolute_url(reference_url_object), hrefs),
+        ("href_rewriter.rewrite", HrefRewriter(urls[0]).rewrite, hrefs),
+        ("url_manager.normalize", UrlManager.normalize, urls),
+        ("url_manager.normalize_uncached", _normalize_uncached, urls),
+        ("rewrite_page.url_manager", _url_manager_rewrite, links),
+        ("rewrite_page.href_rewriter", _href_rewriter_rewrite, links),
+        ("parse.beautifulsoup_lxml", lambda page: BeautifulSoup(page, "lxml"), html),
+        ("extract_toc", lambda page: extract_toc(FetchedPage(page).iter_chunks()), html),
+        ("render_toc_html", render_toc_html, tocs),
+    ]
+    return [time_operation("micro." + name, operation, inputs, min_time) for name, operation, inputs in benchmarks]
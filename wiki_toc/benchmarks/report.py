@@ -0,0 +1,117 @@
+""" Summaries of benchmark timings in a form which can be printed or saved as json and compared between runs.
+"""
+import json
+import platform
+import resource
+import sys
+import time
+
+
+def percentile(sorted_values, fraction):
+    """ Returns the value at fraction (0 to 1) of sorted_values using the nearest rank
+    """
+    if not sorted_values:
+        return None
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+def process_peak_rss_mb():
+    """ Returns the peak resident set size of this process since it started in megabytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+class PeakRss(object):
+    """ Measures the peak resident set size of this process from when it is created, ie: during a single benchmark
+        ru_maxrss only ever grows, so linux's high water mark, VmHWM, is reset instead. Where that is not possible
+        peak_mb returns None.
+    """
+
+    def __init__(self):
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            self.supported = True
+        except (IOError, OSError):
+            self.supported = False
+
+    def peak_mb(self):
+        if not self.supported:
+            return None
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+        return None
+
+
+def summarize(name, latencies, elapsed, errors=0, rss=None, **extra):
+    """ Returns the result of a benchmark as a dict
+        latencies are the durations of the individual operations and elapsed is the wall clock time for all of them,
+        which is less than their sum when they were run concurrently. rss is the PeakRss created when the benchmark
+        started.
+    """
+    latencies = sorted(latencies)
+    result = dict(
+        name=name,
+        operations=len(latencies),
+        errors=errors,
+        elapsed_seconds=elapsed,
+        throughput=len(latencies) / elapsed if elapsed > 0 else None,
+        mean_ms=sum(latencies) / len(latencies) * 1000 if latencies else None,
+        p50_ms=percentile(latencies, 0.50) * 1000 if latencies else None,
+        p99_ms=percentile(latencies, 0.99) * 1000 if latencies else None,
+        max_ms=latencies[-1] * 1000 if latencies else None,
+        peak_rss_mb=rss.peak_mb() if rss is not None else None,
+        process_peak_rss_mb=process_peak_rss_mb(),
+    )
+    result.update(extra)
+    return result
+
+
+def new_report(parameters):
+    return dict(
+        created=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        parameters=parameters,
+        results=[],
+    )
+
+def save_report(report, path):
+    with open(path, "wb") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+def load_report(path):
+    with open(path, "rb") as f:
+        return json.load(f)
+
+
+def _format(value, width, precision=2):
+    if value is None:
+        return "-".rjust(width)
+    if isinstance(value, float):
+        return ("%.*f" % (precision, value)).rjust(width)
+    return str(value).rjust(width)
+
+def format_results(results, baseline=None):
+    """ Returns the results as a table. With a baseline report, the change in throughput and p99 latency from the
+        result of the same name in the baseline is included.
+    """
+    previous = dict((result["name"], result) for result in (baseline or {}).get("results", []))
+    lines = ["%-36s %10s %12s %10s %10s %10s %8s %9s" % (
+        "benchmark", "ops", "ops/s", "p50 ms", "p99 ms", "max ms", "errors", "peak MB")]
+    for result in results:
+        line = "%-36s %10s %12s %10s %10s %10s %8s %9s" % (
+            result["name"], _format(result["operations"], 10), _format(result["throughput"], 12, 1),
+            _format(result["p50_ms"], 10, 3), _format(result["p99_ms"], 10, 3), _format(result["max_ms"], 10, 3),
+            _format(result["errors"], 8), _format(result["peak_rss_mb"], 9, 1))
+        before = previous.get(result["name"])
+        if before and before.get("throughput") and result["throughput"] and before.get("p99_ms") and result["p99_ms"]:
+            line += "  throughput %+.1f%% p99 %+.1f%%" % (
+                (result["throughput"] / before["throughput"] - 1) * 100, (result["p99_ms"] / before["p99_ms"] - 1) * 100)
+        lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,64 @@
+""" The wiki_toc_benchmark command. See the package documentation.
+"""
+import argparse
+import logging
+import sys
+
+from .corpus import CorpusServer, generate_corpus, load_corpus
+from .load import run_load_benchmarks
+from .micro import run_micro
+from .report import format_results, load_report, new_report, save_report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the wiki_toc pipeline against a local stand-in for wikipedia.")
+    parser.add_argument("--corpus", default=None,
+                        help="a directory of saved article html to use instead of generated articles")
+    parser.add_argument("--pages", type=int, default=50, help="the number of generated articles")
+    parser.add_argument("--sections", type=int, default=30, help="the number of sections in each generated article")
+    parser.add_argument("--payload-size", type=int, default=100 * 1024, help="the size in bytes of each generated article")
+    parser.add_argument("--seed", type=int, default=0, help="the seed for generating articles")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the stand-in server waits before responding")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many more seconds are added to --latency")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="the fraction of responses from the stand-in server which are errors")
+    parser.add_argument("--error-status", type=int, default=503, help="the status of the injected errors")
+    parser.add_argument("--micro-time", type=float, default=1.0, help="seconds to run each micro-benchmark for")
+    parser.add_argument("--requests", type=int, default=500, help="the number of requests made by each load test")
+    parser.add_argument("--concurrency", type=int, default=8, help="the number of concurrent clients in the load tests")
+    parser.add_argument("--waitress-threads", type=int, default=8, help="the number of waitress threads")
+    parser.add_argument("--cache", action="store_true", help="run the load tests with the toc cache enabled")
+    parser.add_argument("--only", choices=["micro", "load"], default=None, help="run only one kind of benchmark")
+    parser.add_argument("--output", default=None, help="write the results to this file as json")
+    parser.add_argument("--baseline", default=None, help="a file written by --output to compare the results with")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.CRITICAL)
+    if args.corpus:
+        corpus = load_corpus(args.corpus)
+    else:
+        corpus = generate_corpus(args.pages, args.sections, args.payload_size, args.seed)
+    if not corpus:
+        parser.error("the corpus is empty")
+
+    report = new_report(dict((name, value) for name, value in vars(args).items() if name not in ("output", "baseline")))
+    if args.only != "load":
+        report["results"].extend(run_micro(corpus, args.micro_time))
+    if args.only != "micro":
+        server = CorpusServer(corpus, args.latency, args.jitter, error_rate=args.error_rate,
+                              error_status=args.error_status).start()
+        try:
+            report["results"].extend(run_load_benchmarks(corpus, server.url, args.requests, args.concurrency,
+                                                         args.cache, args.waitress_threads))
+        finally:
+            server.stop()
+
+    baseline = load_report(args.baseline) if args.baseline else None
+    sys.stdout.write(format_results(report["results"], baseline) + "\n")
+    if args.output:
+        save_report(report, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
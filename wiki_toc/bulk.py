@@ -0,0 +1,301 @@
+""" Offline extraction of tables of contents from local copies of wikipedia pages.
+
+    Usage: wiki_toc_bulk [options] SOURCE OUTPUT
+
+    SOURCE may be any of the following:
+        * A directory of saved article html. Files named *.html or *.htm, optionally gzip compressed, are read and the
+          wiki location of each is its path relative to the directory, without the extension, appended to --base-url
+          eg: with --base-url https://en.wikipedia.org/wiki the file Satchel.html becomes en.wikipedia.org/wiki/Satchel
+          Without --base-url the directory is expected to be laid out by location eg: en.wikipedia.org/wiki/Satchel.html
+        * An html dump in the newline delimited json form published by wikimedia, in which each line is an object with
+          the article's 'url' and its html in 'article_body.html' (or 'html'). The dump may be gzip or bz2 compressed.
+        * A tar archive of either of the above, eg: enwiki-NS0-ENTERPRISE-HTML.json.tar.gz
+
+    The pages are fanned out across a pool of processes which run the same extraction as the views, including making
+    relative hrefs absolute. The results are written to OUTPUT, one json object per line:
+        {"key": <normalized wiki location>, "toc": <tree or null if the page has no table of contents>}
+    OUTPUT is gzip compressed if it ends with '.gz'. Only a bounded number of pages are held in memory at a time so
+    dumps of any size can be processed.
+"""
+import argparse
+import bz2
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tarfile
+import threading
+import time
+import zlib
+
+from .cache import normalize_key
+from .extractor import extract_toc
+from .fetcher import FetchedPage
+from .views import get_wiki_location, rewrite_toc_links, wikipedia_scheme
+
+html_extensions = (".html", ".htm")
+chunk_size = 64 * 1024
+
+
+def open_compressed(path, mode="rb"):
+    """ Opens path, decompressing it if its name ends with '.gz' or '.bz2'
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    if path.endswith(".bz2"):
+        return bz2.BZ2File(path, mode)
+    return open(path, mode)
+
+def _strip_extensions(name):
+    """ Returns (name without its html and compression extensions, True if it is an html file)
+    """
+    for compression in (".gz", ".bz2"):
+        if name.endswith(compression):
+            name = name[:-len(compression)]
+    for extension in html_extensions:
+        if name.endswith(extension):
+            return name[:-len(extension)], True
+    return name, False
+
+def _skip(progress, description, reason):
+    """ Logs a record which cannot be processed and counts it in progress, if there is one, so that it does not abort
+        the run
+    """
+    logging.warning("Skipping %s: %s", description, reason)
+    if progress is not None:
+        progress.skip()
+
+def _location_from_path(relative_path, base_url):
+    """ Returns the wiki location of an html file or None if base_url is not a wikipedia url
+    """
+    if not base_url.endswith("/"):
+        base_url += "/"
+    return get_wiki_location(base_url + relative_path.replace(os.sep, "/").lstrip("/"))
+
+def _iter_html_file(relative_path, html, base_url, progress):
+    wiki_location = _location_from_path(relative_path, base_url)
+    if wiki_location is None:
+        _skip(progress, "'%s'" % relative_path, "'%s' is not a wikipedia url. Please provide --base-url" % base_url)
+    else:
+        yield wiki_location, html
+
+def iter_directory(directory, base_url, progress=None):
+    """ Yields (wiki location, html) for each html file in directory
+    """
+    for root, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            name, is_html = _strip_extensions(filename)
+            if not is_html:
+                continue
+            path = os.path.join(root, filename)
+            with open_compressed(path) as f:
+                html = f.read()
+            for page in _iter_html_file(os.path.relpath(os.path.join(root, name), directory), html, base_url, progress):
+                yield page
+
+def iter_ndjson(lines, progress=None):
+    """ Yields (wiki location, html) for each line of an html dump
+        Lines which are not json objects and urls which are not wikipedia urls are skipped.
+    """
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError, e:
+            _skip(progress, "line %d of the dump" % number, e)
+            continue
+        if not isinstance(record, dict):
+            _skip(progress, "line %d of the dump" % number, "it is not a json object")
+            continue
+        html = (record.get("article_body") or {}).get("html") or record.get("html")
+        url = record.get("url")
+        if not html or not url:
+            continue
+        wiki_location = get_wiki_location(url)
+        if wiki_location is None:
+            _skip(progress, "line %d of the dump" % number, "'%s' is not a wikipedia url" % url)
+            continue
+        if isinstance(html, unicode):
+            html = html.encode("utf-8")
+        yield wiki_location, html
+
+def _iter_decompressed(f, decompressor_class):
+    """ Yields the data of the compressed stream f, decompressed one chunk at a time
+        Streams which have been concatenated, eg: by pbzip2 or by appending gzip files, are all decompressed.
+    """
+    decompressor = decompressor_class()
+    for data in iter(lambda: f.read(chunk_size), ""):
+        while data:
+            try:
+                yield decompressor.decompress(data)
+            except EOFError:
+                # A bz2 stream ended exactly at the end of the previous chunk
+                decompressor = decompressor_class()
+                continue
+            data = decompressor.unused_data
+            if data:
+                decompressor = decompressor_class()
+    if hasattr(decompressor, "flush"):
+        yield decompressor.flush()
+
+def _iter_lines(chunks):
+    """ Yields the lines of an iterable of chunks of data
+    """
+    partial = ""
+    for chunk in chunks:
+        lines = (partial + chunk).split("\n")
+        partial = lines.pop()
+        for line in lines:
+            yield line
+    if partial:
+        yield partial
+
+def iter_tar(path, base_url, progress=None):
+    """ Yields (wiki location, html) for each dump or html file in a tar archive, reading it as a stream
+    """
+    with tarfile.open(path, "r|*") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            name, is_html = _strip_extensions(member.name)
+            f = archive.extractfile(member)
+            # Compressed members are decompressed as they are read so that only a chunk of each is held in memory
+            if member.name.endswith(".gz"):
+                chunks = _iter_decompressed(f, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+            elif member.name.endswith(".bz2"):
+                chunks = _iter_decompressed(f, bz2.BZ2Decompressor)
+            else:
+                chunks = iter(lambda: f.read(chunk_size), "")
+            if is_html:
+                for page in _iter_html_file(name, "".join(chunks), base_url, progress):
+                    yield page
+            else:
+                for page in iter_ndjson(_iter_lines(chunks), progress):
+                    yield page
+
+def iter_pages(source, base_url=None, progress=None):
+    """ Yields (wiki location, html) for every page in source. See the module documentation for the forms of source
+        Records which cannot be processed are logged and counted in progress instead of aborting the run.
+    """
+    if os.path.isdir(source):
+        return iter_directory(source, base_url or wikipedia_scheme, progress)
+    name, _ = _strip_extensions(source)
+    if name.endswith(".tar") or source.endswith(".tgz"):
+        return iter_tar(source, base_url or wikipedia_scheme, progress)
+    return iter_ndjson(open_compressed(source), progress)
+
+
+def extract_page(page):
+    """ Extracts the table of contents from one page. This is run in the worker processes.
+        Returns (key, tree or None, error message or None, number of bytes of html)
+    """
+    wiki_location, html = page
+    key = normalize_key(wiki_location)
+    try:
+        toc = extract_toc(FetchedPage(html).iter_chunks())
+        if toc:
+            rewrite_toc_links(toc, wikipedia_scheme + wiki_location)
+        return key, toc, None, len(html)
+    except Exception, e:
+        return key, None, str(e), len(html)
+
+
+class BulkProgress(object):
+    """ Counts the pages which have been processed and periodically reports the throughput
+    """
+
+    def __init__(self, interval=10.0, stream=None):
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.started = self.last_report = time.time()
+        self.pages = 0
+        self.tocs = 0
+        self.errors = 0
+        self.skipped = 0
+        self.bytes = 0
+
+    def add(self, toc, error, size):
+        self.pages += 1
+        self.bytes += size
+        if toc:
+            self.tocs += 1
+        if error:
+            self.errors += 1
+        now = time.time()
+        if self.interval and now - self.last_report >= self.interval:
+            self.report(now)
+
+    def skip(self):
+        """ Counts a record which was skipped before it could be extracted
+        """
+        self.skipped += 1
+
+    def report(self, now=None):
+        now = now or time.time()
+        self.last_report = now
+        elapsed = max(now - self.started, 1e-6)
+        self.stream.write("%d pages, %d tables of contents, %d errors, %d skipped in %.1fs (%.1f pages/s, %.2f MB/s)\n" % (
+            self.pages, self.tocs, self.errors, self.skipped, elapsed, self.pages / elapsed, self.bytes / elapsed / 1024 / 1024))
+
+
+def run_bulk(pages, output, processes=None, max_pending=1000, chunksize=16, progress=None):
+    """ Extracts the table of contents from each (wiki location, html) in pages using a pool of processes and writes
+        the results to the open file output. No more than max_pending pages are read ahead of the results.
+        Returns the BulkProgress.
+    """
+    progress = progress or BulkProgress()
+    processes = processes or multiprocessing.cpu_count()
+    max_pending = max(max_pending, processes * chunksize)
+    pending = threading.BoundedSemaphore(max_pending)
+
+    def bounded_pages():
+        # Pool.imap_unordered reads its input as fast as it can so hold it back until results have been written
+        for page in pages:
+            pending.acquire()
+            yield page
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for key, toc, error, size in pool.imap_unordered(extract_page, bounded_pages(), chunksize):
+            pending.release()
+            if error:
+                logging.error("Failed to extract the table of contents of '%s': %s", key, error)
+            else:
+                output.write(json.dumps(dict(key=key, toc=toc), separators=(",", ":")) + "\n")
+            progress.add(toc, error, size)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return progress
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract tables of contents from local copies of wikipedia pages.")
+    parser.add_argument("source", help="a directory of html files, an ndjson html dump or a tar archive of either")
+    parser.add_argument("output", help="the file to write the results to, gzip compressed if it ends with '.gz'")
+    parser.add_argument("--base-url", default=None,
+                        help="the url of the pages in a directory, eg: https://en.wikipedia.org/wiki")
+    parser.add_argument("--processes", type=int, default=None, help="the number of worker processes (default: cpus)")
+    parser.add_argument("--max-pending", type=int, default=1000,
+                        help="the maximum number of pages read ahead of the results")
+    parser.add_argument("--progress-interval", type=float, default=10.0, help="seconds between progress reports")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARN)
+    progress = BulkProgress(args.progress_interval)
+    with open_compressed(args.output, "wb") as output:
+        run_bulk(iter_pages(args.source, args.base_url, progress), output, args.processes, args.max_pending, progress=progress)
+    progress.report()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
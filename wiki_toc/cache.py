@@ -0,0 +1,314 @@
+""" Caching for finished tables of contents.
+
+    The 'wiki_toc' view stores the href-rewritten TOC tree for each wikipedia location so that popular pages are not
+    refetched and reparsed on every request. The in-process cache is a size bounded LRU with a TTL and it can
+    optionally be backed by a shared SQLite store so that all waitress workers share warm entries.
+
+    Expired entries are kept, along with the ETag and Last-Modified validators of the page they were extracted from,
+    until they are evicted. This allows the view to revalidate a stale entry with a conditional request instead of
+    downloading and parsing the whole page again.
+"""
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from pyramid.settings import asbool
+
+# Incremented whenever the form of the cached values changes so that shared stores discard values in the old form
+value_format_version = 3
+
+
+def normalize_key(wiki_location):
+    """ Returns the canonical cache key for a wiki_location such as 'en.wikipedia.org/wiki/Satchel'
+        Leading and trailing slashes are removed and the domain is lower cased since it is case insensitive
+    """
+    netloc, separator, path = wiki_location.strip("/").partition("/")
+    return netloc.lower() + separator + path
+
+
+class CacheEntry(object):
+    """ A single cached value along with the time (as returned by time.time()) at which it expires
+        etag and last_modified are the validators sent by wikipedia for the page that the value was extracted from
+    """
+    __slots__ = ('value', 'expires', 'etag', 'last_modified')
+
+    def __init__(self, value, expires, etag=None, last_modified=None):
+        self.value = value
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def is_fresh(self, now=None):
+        return (now or time.time()) < self.expires
+
+    def is_servable_stale(self, max_stale, now=None):
+        """ Returns True if the entry expired no more than max_stale seconds ago
+        """
+        return (now or time.time()) < self.expires + max_stale
+
+
+class SqliteCacheBackend(object):
+    """ A cache store shared between processes through a local SQLite database file.
+        Values must be serializable as json. Each thread uses its own connection since sqlite3 connections
+        cannot be shared between threads.
+        Once there are more than max_entries entries the least recently accessed are evicted, in a single batch, until
+        only the low_water fraction of max_entries remain. The entries are only counted when this worker's writes may
+        have taken the database over max_entries, or every count_interval writes to allow for the other workers.
+        Reads only write the time an entry was accessed once it is more than touch_interval seconds old so that most
+        reads do not wait for or block writers.
+    """
+
+    def __init__(self, path, max_entries=10000, timeout=5.0, low_water=0.9, count_interval=100, touch_interval=60.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.touch_interval = touch_interval
+        self.low_water_entries = int(math.ceil(max_entries * low_water))
+        self.count_interval = count_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._estimated_entries = None   # The last count plus the writes made since, or None before the first count
+        self._uncounted_writes = 0
+        connection = self._connection()
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS toc_cache ("
+                               "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS toc_cache_accessed ON toc_cache (accessed)")
+            # Databases created before validators were stored need the extra columns
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(toc_cache)")]
+            for column in ("etag", "last_modified"):
+                if column not in columns:
+                    connection.execute("ALTER TABLE toc_cache ADD COLUMN %s TEXT" % column)
+            if connection.execute("PRAGMA user_version").fetchone()[0] != value_format_version:
+                connection.execute("DELETE FROM toc_cache")
+                connection.execute("PRAGMA user_version = %d" % value_format_version)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            # WAL allows readers in other workers to continue while one worker writes
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        """ Returns the CacheEntry stored for key or None
+        """
+        connection = self._connection()
+        row = connection.execute("SELECT value, expires, etag, last_modified, accessed FROM toc_cache WHERE key = ?",
+                                 (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[4] > self.touch_interval:
+            with connection:
+                connection.execute("UPDATE toc_cache SET accessed = ? WHERE key = ?", (now, key))
+        return CacheEntry(json.loads(row[0]), row[1], row[2], row[3])
+
+    def set(self, key, entry):
+        """ Stores entry for key and returns the number of entries evicted to remain within max_entries
+        """
+        connection = self._connection()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO toc_cache (key, value, expires, accessed, etag, last_modified) "
+                               "VALUES (?, ?, ?, ?, ?, ?)",
+                               (key, json.dumps(entry.value), entry.expires, time.time(), entry.etag, entry.last_modified))
+            if not self._needs_count():
+                return 0
+            count = connection.execute("SELECT COUNT(*) FROM toc_cache").fetchone()[0]
+            evicted = 0
+            if count > self.max_entries:
+                # Remove the least recently accessed entries down to the low water mark
+                cursor = connection.execute("DELETE FROM toc_cache WHERE key IN ("
+                                            "SELECT key FROM toc_cache ORDER BY accessed LIMIT ?)",
+                                            (count - self.low_water_entries,))
+                evicted = max(cursor.rowcount, 0)
+        with self._lock:
+            self._estimated_entries = count - evicted
+        return evicted
+
+    def _needs_count(self):
+        """ Counts a write and returns True if the entries should be counted to see whether any must be evicted
+        """
+        with self._lock:
+            self._uncounted_writes += 1
+            if self._estimated_entries is not None:
+                self._estimated_entries += 1
+                if self._estimated_entries <= self.max_entries and self._uncounted_writes < self.count_interval:
+                    return False
+            self._uncounted_writes = 0
+            return True
+
+    def touch(self, key, expires):
+        """ Sets a new expiry time for key without rewriting its value
+        """
+        connection = self._connection()
+        with connection:
+            connection.execute("UPDATE toc_cache SET expires = ?, accessed = ? WHERE key = ?", (expires, time.time(), key))
+
+    def delete(self, key):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM toc_cache WHERE key = ?", (key,))
+
+    def clear(self):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM toc_cache")
+        with self._lock:
+            self._estimated_entries = None
+
+
+class TocCache(object):
+    """ A thread safe, size bounded LRU cache with a TTL.
+        When a backend is given, misses in the local cache are looked up in the backend and every value set is
+        also written to the backend so that other processes can use it.
+        negative_ttl is the TTL used by callers for failures and pages without a table of contents. max_stale is the
+        number of seconds after expiry for which callers may serve an entry while it is refreshed in the background.
+    """
+
+    def __init__(self, ttl=3600, max_entries=1000, backend=None, negative_ttl=60, max_stale=0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.backend = backend
+        self.negative_ttl = negative_ttl
+        self.max_stale = max_stale
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidations = 0
+
+    def _store_locally(self, key, entry):
+        """ Must be called while holding self._lock
+        """
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_entry(self, key, count=True):
+        """ Returns the CacheEntry for key, which may have expired, or None if there is no entry at all
+            Only fresh entries count as hits. Stale entries count as misses but can still be revalidated.
+            Lookups which are not made for a client, eg: by the warm-up, pass count=False to leave the counters alone.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # Reinsert the entry so that it becomes the most recently used
+                self._entries[key] = entry
+                if entry.is_fresh(now):
+                    self.hits += count
+                    return entry
+
+        if self.backend is not None:
+            try:
+                shared_entry = self.backend.get(key)
+            except sqlite3.Error, e:
+                logging.error("Failed to read '%s' from the shared toc cache: %s", key, str(e))
+                shared_entry = None
+            # Another worker may have refreshed the entry
+            if shared_entry is not None and (entry is None or shared_entry.expires > entry.expires):
+                entry = shared_entry
+                with self._lock:
+                    self._store_locally(key, entry)
+                    if entry.is_fresh(now):
+                        self.hits += count
+                        return entry
+
+        with self._lock:
+            self.misses += count
+        return entry
+
+    def get(self, key):
+        """ Returns the cached value for key or None if there is no fresh value
+        """
+        entry = self.get_entry(key)
+        if entry is not None and entry.is_fresh():
+            return entry.value
+        return None
+
+    def set(self, key, value, ttl=None, etag=None, last_modified=None):
+        entry = CacheEntry(value, time.time() + (self.ttl if ttl is None else ttl), etag, last_modified)
+        with self._lock:
+            self._store_locally(key, entry)
+
+        if self.backend is not None:
+            try:
+                evicted = self.backend.set(key, entry)
+            except sqlite3.Error, e:
+                logging.error("Failed to write '%s' to the shared toc cache: %s", key, str(e))
+                evicted = 0
+            with self._lock:
+                self.evictions += evicted
+
+    def revalidated(self, key, ttl=None):
+        """ Marks the entry for key as fresh again after the page was found to be unmodified and returns its value
+            Returns None if the entry has been evicted in the meantime
+        """
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry.expires = expires
+            self.revalidations += 1
+
+        if self.backend is not None:
+            try:
+                self.backend.touch(key, expires)
+            except sqlite3.Error, e:
+                logging.error("Failed to update '%s' in the shared toc cache: %s", key, str(e))
+        return entry.value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        """ Returns the hit, miss and eviction counters along with the current number of local entries
+        """
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                revalidations=self.revalidations,
+                entries=len(self._entries),
+                backend=self.backend.__class__.__name__ if self.backend is not None else None,
+            )
+
+
+def cache_from_settings(settings):
+    """ Creates a TocCache from the 'wiki_toc.cache.*' settings in the .ini file or returns None if caching is disabled
+    """
+    if not asbool(settings.get("wiki_toc.cache.enabled", True)):
+        return None
+
+    ttl = int(settings.get("wiki_toc.cache.ttl", 3600))
+    max_entries = int(settings.get("wiki_toc.cache.max_entries", 1000))
+    negative_ttl = int(settings.get("wiki_toc.cache.negative_ttl", 60))
+    max_stale = int(settings.get("wiki_toc.cache.max_stale", 0))
+
+    backend = None
+    backend_name = settings.get("wiki_toc.cache.backend", "memory")
+    if backend_name == "sqlite":
+        path = settings.get("wiki_toc.cache.sqlite_path", os.path.join(os.getcwd(), "toc_cache.sqlite"))
+        backend_max_entries = int(settings.get("wiki_toc.cache.sqlite_max_entries", max_entries * 10))
+        # The eviction order only needs to be approximate so reads record an access at most every tenth of the ttl
+        backend = SqliteCacheBackend(path, max_entries=backend_max_entries, touch_interval=ttl / 10.0)
+    elif backend_name != "memory":
+        raise ValueError("Unknown wiki_toc.cache.backend '%s'" % backend_name)
+
+    return TocCache(ttl=ttl, max_entries=max_entries, backend=backend, negative_ttl=negative_ttl, max_stale=max_stale)
@@ -0,0 +1,182 @@
+""" A bounded pool of worker threads which fetch and extract tables of contents.
+
+    Fetching a page spends most of its time waiting on the network. Doing that in the view ties up one of waitress's
+    few threads for as long as wikipedia takes to respond. Views instead submit the work to a FetchEngine and wait for
+    it with a deadline. The number of jobs waiting for a worker is bounded; when the queue is full EngineBusy is raised
+    immediately so that the view can respond with a 503 rather than letting requests pile up.
+"""
+import logging
+import sys
+import threading
+import Queue
+
+from pyramid.settings import asbool
+
+
+class EngineBusy(Exception):
+    """ Raised by FetchEngine.submit when the queue of jobs is full
+    """
+
+class EngineTimeout(Exception):
+    """ Raised by Job.wait when the job has not finished before the deadline
+    """
+
+
+class Job(object):
+    """ A function call which will be run by one of the engine's workers
+    """
+
+    def __init__(self, function, args, kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.exc_info = None
+        self.cancelled = False
+        self.started = False
+        self._finished = threading.Event()
+
+    def run(self):
+        self.started = True
+        try:
+            self.result = self.function(*self.args, **self.kwargs)
+        except BaseException:
+            self.exc_info = sys.exc_info()
+        finally:
+            self._finished.set()
+
+    def done(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """ Returns the result of the job, raises the error it raised or raises EngineTimeout
+            A job that times out before a worker has started it is cancelled.
+        """
+        if not self._finished.wait(timeout):
+            if not self.started:
+                self.cancelled = True
+            raise EngineTimeout("The job did not finish within %s seconds" % timeout)
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class FetchEngine(object):
+    """ Runs jobs on a fixed number of worker threads
+        queue_size is the number of jobs which may wait for a worker and timeout is the default deadline for call()
+        name is the prefix of the names of the worker threads.
+    """
+
+    def __init__(self, workers=8, queue_size=32, timeout=15.0, name="wiki_toc-fetch"):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.name = name
+        self._queue = Queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.busy_workers = 0
+
+    def start(self):
+        for index in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._work, name="%s-%d" % (self.name, len(self._threads)))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        """ Stops the workers once the jobs which have already been queued are finished
+        """
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            if job.cancelled:
+                continue
+            with self._lock:
+                self.busy_workers += 1
+            try:
+                job.run()
+            except BaseException, e:
+                logging.error("Unexpected error in fetch engine worker: %s", str(e))
+            finally:
+                with self._lock:
+                    self.busy_workers -= 1
+
+    def submit(self, function, *args, **kwargs):
+        """ Queues function(*args, **kwargs) and returns its Job, or raises EngineBusy if the queue is full
+        """
+        job = Job(function, args, kwargs)
+        try:
+            self._queue.put_nowait(job)
+        except Queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise EngineBusy("The fetch queue is full")
+        with self._lock:
+            self.submitted += 1
+        return job
+
+    def call(self, function, *args, **kwargs):
+        """ Runs function on a worker and returns its result, waiting no longer than the engine's timeout
+        """
+        return self.wait(self.submit(function, *args, **kwargs))
+
+    def wait(self, job):
+        """ Returns the result of job, which may be anything with a wait(timeout) method such as a Job, waiting no
+            longer than the engine's timeout
+        """
+        try:
+            return job.wait(self.timeout)
+        except EngineTimeout:
+            with self._lock:
+                self.timed_out += 1
+            raise
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                workers=len(self._threads),
+                busy_workers=self.busy_workers,
+                queued=self._queue.qsize(),
+                submitted=self.submitted,
+                rejected=self.rejected,
+                timed_out=self.timed_out,
+            )
+
+
+def engine_from_settings(settings):
+    """ Creates and starts a FetchEngine from the 'wiki_toc.engine.*' settings or returns None if it is disabled
+        Without an engine, pages are fetched by the waitress thread handling the request.
+    """
+    if not asbool(settings.get("wiki_toc.engine.enabled", True)):
+        return None
+    return FetchEngine(
+        workers=int(settings.get("wiki_toc.engine.workers", 8)),
+        queue_size=int(settings.get("wiki_toc.engine.queue_size", 32)),
+        timeout=float(settings.get("wiki_toc.engine.timeout", 15.0)),
+    ).start()
+
+def batch_engine_from_settings(settings):
+    """ Creates and starts the FetchEngine used by /wiki_toc_batch from the 'wiki_toc.batch.*' settings or returns None
+        if it is disabled. Batches have their own workers and queue so that they cannot hold up the pages requested by
+        the other views.
+    """
+    if not asbool(settings.get("wiki_toc.batch.engine_enabled", True)):
+        return None
+    return FetchEngine(
+        workers=int(settings.get("wiki_toc.batch.workers", 8)),
+        queue_size=int(settings.get("wiki_toc.batch.queue_size", 64)),
+        name="wiki_toc-batch",
+    ).start()
@@ -0,0 +1,323 @@
+""" Incremental extraction of the table of contents from a wikipedia page.
+
+    The table of contents is near the top of a wikipedia page so there is no need to download and parse the whole
+    page. TocExtractor is fed the page one chunk at a time and stops as soon as div#toc has been closed. While div#toc
+    is being parsed the table of contents is built up as a tree of plain python objects taken from the markup that
+    wikipedia uses for it:
+
+        <li class="toclevel-1 tocsection-1"><a href="#History"><span class="tocnumber">1</span> <span class="toctext">History</span></a>
+
+    The tree can be rendered as json without any further processing, or as html with render_toc_html:
+
+        {"title": "Contents",
+         "sections": [{"level": 1, "section": "1", "number": "1", "text": "History", "anchor": "History",
+                       "href": "#History", "children": [...]}, ...],
+         "html": {"parts": ["<div class=\"toc\" id=\"toc\">...<a href=\"", "\" target=\"_NEW\">...", ...],
+                  "links": [0, "/wiki/Help:Contents", 1, ...]}}
+
+    "html" is only used for rendering and is not part of the tree returned to json clients. Its parts are the markup of
+    div#toc, serialized in the same way as BeautifulSoup, split at the href of each link. Each of its links is either
+    the index, in the order of iter_sections, of the section whose href is used or the href of a link which does not
+    belong to a section. render_toc_html joins them so that the markup which the tree does not describe, eg: <i> in the
+    text of a section or the toggle of the table of contents, is kept.
+
+    As in lxml, an li element which is not closed is closed by the next li in the same list or by the end of the list.
+
+    The events come from the standard library's incremental HTMLParser. lxml's html push parser cannot be used for
+    this since it stops producing events until it is closed once a <meta charset> tag has been parsed.
+"""
+import cgi
+import codecs
+from HTMLParser import HTMLParser
+
+
+# Elements which never have a closing tag, as BeautifulSoup treats them
+void_elements = frozenset(["area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link", "menuitem",
+                           "meta", "param", "source", "track", "wbr", "basefont", "bgsound", "command", "frame",
+                           "image", "isindex", "nextid", "spacer"])
+
+
+class _TocClosed(Exception):
+    """ Raised from within HTMLParser.feed to stop parsing the rest of the chunk
+    """
+
+
+def _classes(attrs):
+    for name, value in attrs:
+        if name == "class" and value:
+            return value.split()
+    return []
+
+def _escape_text(text):
+    return text.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u">", u"&gt;")
+
+def _quote_attribute(value):
+    """ Returns an attribute value quoted in the same way as BeautifulSoup
+    """
+    value = _escape_text(value)
+    if u'"' not in value:
+        return u'"%s"' % value
+    if u"'" not in value:
+        return u"'%s'" % value
+    return u'"%s"' % value.replace(u'"', u"&quot;")
+
+def _start_tag(tag, attrs):
+    """ Returns the parts of a start tag, serialized in the same way as BeautifulSoup, either side of the value of its
+        href attribute, or a single part if it has none
+        Links open in a new window.
+    """
+    attributes = {}
+    for name, value in attrs:
+        if name == "class" and value:
+            # class is a multi-valued attribute
+            value = u" ".join(value.split())
+        attributes.setdefault(name, value or u"")
+    if tag == "a":
+        attributes["target"] = u"_NEW"
+    parts = [u"<" + tag]
+    for name in sorted(attributes):
+        if name == "href" and tag == "a":
+            parts[-1] += u' href="'
+            parts.append(u'"')
+        else:
+            parts[-1] += u" %s=%s" % (name, _quote_attribute(attributes[name]))
+    parts[-1] += u"/>" if tag in void_elements else u">"
+    return parts
+
+
+class TocExtractor(HTMLParser):
+    """ Accepts chunks of html through feed() until done is True
+        encoding may be given when it is known from the Content-Type header, otherwise utf-8 is assumed
+    """
+
+    def __init__(self, encoding=None):
+        HTMLParser.__init__(self)
+        try:
+            decoder_class = codecs.getincrementaldecoder(encoding or "utf-8")
+        except LookupError:
+            decoder_class = codecs.getincrementaldecoder("utf-8")
+        self._decoder = decoder_class("replace")
+        self._toc = None        # The tree for the table of contents once div#toc has been found
+        self._depth = 0         # The number of open div elements in the table of contents
+        self._sections = []     # The sections whose li elements are open, innermost last
+        self._open = []         # The (index, list depth) of each of the open sections
+        self._section_count = 0
+        self._list_depth = 0    # The number of open ul and ol elements
+        self._capture = None    # The name of the field that text is currently being added to
+        self._capture_depth = 0
+        self._html = []         # The markup of the table of contents, split at the href of each link
+        self._links = []        # The section index or href for each split in the markup
+        self.done = False
+
+    def feed(self, data):
+        """ Parses the next chunk of html. Returns True once the table of contents has been closed
+        """
+        if self.done:
+            return True
+        if isinstance(data, str):
+            data = self._decoder.decode(data)
+        try:
+            HTMLParser.feed(self, data)
+        except _TocClosed:
+            self.done = True
+        return self.done
+
+    def close(self):
+        """ Finishes parsing once the whole page has been fed without the table of contents being closed
+        """
+        if not self.done:
+            try:
+                HTMLParser.feed(self, self._decoder.decode("", True))
+                HTMLParser.close(self)
+            except _TocClosed:
+                pass
+            self.done = True
+
+    def toc(self):
+        """ Returns the tree for the table of contents or None if the page did not contain one
+        """
+        if self._toc is not None:
+            self._toc["title"] = self._toc["title"].strip() or u"Contents"
+            self._toc["html"] = dict(parts=[u"".join(parts) for parts in self._html], links=list(self._links))
+        return self._toc
+
+    def _add_markup(self, markup):
+        self._html[-1].append(markup)
+
+    def _close_sections(self, list_depth):
+        """ Implicitly closes the li elements of the open sections in lists at list_depth or deeper
+        """
+        while self._open and self._open[-1][1] >= list_depth:
+            self._add_markup(u"</li>")
+            self._pop_section()
+
+    def _pop_section(self):
+        self._sections.pop()
+        self._open.pop()
+
+    def handle_starttag(self, tag, attrs):
+        if self._toc is None:
+            if tag == "div" and dict(attrs).get("id") == "toc":
+                self._toc = dict(title=u"", sections=[])
+                self._depth = 1
+                self._html.append(_start_tag(tag, attrs))
+            return
+
+        if tag == "li" and self._capture is None:
+            self._close_sections(self._list_depth)
+        start_tag = _start_tag(tag, attrs)
+        if len(start_tag) == 2:
+            self._add_markup(start_tag[0])
+            self._html.append([start_tag[1]])
+            if self._capture is None and self._sections and self._sections[-1]["href"] is None:
+                # The href of a section's link is taken from the tree when rendering
+                self._links.append(self._open[-1][0])
+            else:
+                self._links.append(dict(attrs).get("href") or u"")
+        else:
+            self._add_markup(u"".join(start_tag))
+
+        if self._capture is not None:
+            # Markup within the text of a section, eg: <i>, is reduced to its text
+            if tag not in void_elements:
+                self._capture_depth += 1
+            return
+
+        if tag == "div":
+            self._depth += 1
+        elif tag in ("ul", "ol"):
+            self._list_depth += 1
+        elif tag == "h2" and not self._toc["sections"]:
+            self._capture = "title"
+            self._capture_depth = 1
+        elif tag == "li":
+            level = section = None
+            for css_class in _classes(attrs):
+                if css_class.startswith("toclevel-") and css_class[len("toclevel-"):].isdigit():
+                    level = int(css_class[len("toclevel-"):])
+                elif css_class.startswith("tocsection-"):
+                    section = css_class[len("tocsection-"):]
+            node = dict(level=level or len(self._sections) + 1, section=section, number=u"", text=u"",
+                        anchor=None, href=None, children=[])
+            parent = self._sections[-1]["children"] if self._sections else self._toc["sections"]
+            parent.append(node)
+            self._sections.append(node)
+            self._open.append((self._section_count, self._list_depth))
+            self._section_count += 1
+        elif tag == "a" and self._sections and self._sections[-1]["href"] is None:
+            self._sections[-1]["href"] = dict(attrs).get("href") or u""
+        elif tag == "span" and self._sections:
+            classes = _classes(attrs)
+            if "tocnumber" in classes:
+                self._capture = "number"
+                self._capture_depth = 1
+            elif "toctext" in classes:
+                self._capture = "text"
+                self._capture_depth = 1
+
+    def handle_endtag(self, tag):
+        if self._toc is None:
+            return
+        if tag in ("ul", "ol") and self._capture is None:
+            self._close_sections(self._list_depth)
+            self._list_depth = max(self._list_depth - 1, 0)
+        if tag not in void_elements:
+            self._add_markup(u"</%s>" % tag)
+
+        if self._capture is not None:
+            if tag in void_elements:
+                return
+            self._capture_depth -= 1
+            if self._capture_depth == 0:
+                self._capture = None
+            return
+
+        if tag == "li" and self._sections:
+            self._pop_section()
+        elif tag == "div":
+            self._depth -= 1
+            if self._depth == 0:
+                raise _TocClosed()
+
+    def _add_text(self, text):
+        if self._capture == "title":
+            self._toc["title"] += text
+        elif self._capture is not None and self._sections:
+            self._sections[-1][self._capture] += text
+
+    def handle_data(self, data):
+        if self._toc is not None:
+            self._add_markup(_escape_text(data))
+        if self._capture is not None:
+            self._add_text(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape(u"&%s;" % name))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape(u"&#%s;" % name))
+
+    def handle_comment(self, data):
+        if self._toc is not None:
+            self._add_markup(u"<!--%s-->" % data)
+
+
+def extract_toc(chunks, encoding=None):
+    """ Returns the tree for the table of contents from an iterable of html chunks or None if there is no table of contents
+        No more chunks are read once the table of contents has been closed.
+    """
+    extractor = TocExtractor(encoding)
+    for chunk in chunks:
+        if extractor.feed(chunk):
+            break
+    else:
+        extractor.close()
+    return extractor.toc()
+
+
+def iter_sections(sections):
+    """ Yields every section in a tree, parents before their children
+    """
+    for section in sections:
+        yield section
+        for child in iter_sections(section["children"]):
+            yield child
+
+
+def _render_sections(sections, parts):
+    parts.append(u'<ul>\n')
+    for index, section in enumerate(sections):
+        if index:
+            parts.append(u'\n')
+        css_class = u"toclevel-%d" % section["level"]
+        if section["section"]:
+            css_class += u" tocsection-%s" % section["section"]
+        parts.append(u'<li class="%s"><a href="%s" target="_NEW"><span class="tocnumber">%s</span> <span class="toctext">%s</span></a>' % (
+            css_class, cgi.escape(section["href"] or u"", True), cgi.escape(section["number"]), cgi.escape(section["text"])))
+        if section["children"]:
+            parts.append(u'\n')
+            _render_sections(section["children"], parts)
+            parts.append(u'\n')
+        parts.append(u'</li>')
+    parts.append(u'\n</ul>')
+
+def render_toc_html(toc):
+    """ Renders the tree for a table of contents as html in the same form as wikipedia's markup
+        Links open in a new window. The markup of the page is used when the tree has it, otherwise, eg: for a tree
+        cached before it was kept, the markup which is rendered only has the title and the sections.
+    """
+    html = toc.get("html")
+    if isinstance(html, dict):
+        sections = list(iter_sections(toc["sections"]))
+        parts = [html["parts"][0]]
+        for link, markup in zip(html["links"], html["parts"][1:]):
+            href = link if isinstance(link, basestring) else sections[link]["href"] or u""
+            parts.append(_escape_text(href).replace(u'"', u"&quot;"))
+            parts.append(markup)
+        return u"".join(parts)
+
+    parts = [u'<div class="toc" id="toc">\n<div id="toctitle">\n<h2>%s</h2>\n</div>\n' % cgi.escape(toc["title"])]
+    if toc["sections"]:
+        _render_sections(toc["sections"], parts)
+    parts.append(u'\n</div>')
+    return u"".join(parts)
@@ -0,0 +1,359 @@
+""" A pooled, keep-alive http client used to fetch wikipedia pages.
+
+    urllib2.urlopen opens a new connection for every request, never times out by default and does not ask for
+    compressed responses. HttpFetcher keeps idle connections to each host for reuse, asks for gzip encoded
+    responses, enforces connect and read timeouts and refuses to read bodies larger than a configured size.
+
+    Errors are reported in the same way as urllib2 so that callers can continue to handle them as before:
+    statuses other than 2xx or 3xx raise urllib2.HTTPError and connection failures raise urllib2.URLError.
+"""
+import httplib
+import socket
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+import zlib
+
+from .upstream import guard_from_settings, parse_retry_after
+
+CHUNK_SIZE = 64 * 1024
+
+default_user_agent = "wiki_toc/0.0 (table of contents scraper)"
+
+
+class NotModified(Exception):
+    """ Raised when wikipedia reports that the page has not changed since it was last fetched
+    """
+
+class ResponseTooLarge(Exception):
+    """ Raised when a response body is larger than the fetcher's max_body_size
+    """
+
+class InvalidRequest(urllib2.URLError):
+    """ Raised when a url cannot be requested, eg: it has an unsupported scheme, without anything being sent
+    """
+
+def quote_path(path):
+    """ Returns path, with any query, percent-encoded as utf-8 so that it can be sent in a request line
+        Characters which are already percent-encoded and the reserved characters are left as they are.
+    """
+    if isinstance(path, unicode):
+        path = path.encode("utf-8")
+    return urllib.quote(path, safe="/%:@!$&'()*+,;=?~")
+
+def check_url(url):
+    """ Returns the urlsplit parts of url or raises InvalidRequest if it cannot be requested
+    """
+    parts = urlparse.urlsplit(url)
+    if parts.scheme not in ("http", "https"):
+        raise InvalidRequest("unsupported url scheme '%s'" % parts.scheme)
+    if not parts.hostname:
+        raise InvalidRequest("no host given")
+    try:
+        parts.port
+    except ValueError:
+        raise InvalidRequest("invalid port in '%s'" % parts.netloc)
+    return parts
+
+def parse_charset(content_type):
+    """ Returns the charset parameter of a Content-Type header or None
+    """
+    for parameter in (content_type or "").split(";")[1:]:
+        name, _, value = parameter.partition("=")
+        if name.strip().lower() == "charset":
+            return value.strip().strip('"') or None
+    return None
+
+
+class FetchedPage(object):
+    """ The html of a page along with the validators that wikipedia sent for it
+        This provides the same interface for reading the body as an open FetchResponse
+    """
+    __slots__ = ('html', 'etag', 'last_modified', 'charset')
+
+    def __init__(self, html, etag=None, last_modified=None, charset=None):
+        self.html = html
+        self.etag = etag
+        self.last_modified = last_modified
+        self.charset = charset
+
+    def iter_chunks(self, chunk_size=None):
+        chunk_size = chunk_size or CHUNK_SIZE
+        for start in range(0, len(self.html), chunk_size):
+            yield self.html[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class FetchResponse(object):
+    """ An open response whose body can be read incrementally with iter_chunks
+        The response must be closed once it is no longer needed. The connection is only returned to the pool if the
+        whole body was read.
+    """
+
+    def __init__(self, fetcher, pool_key, connection, response, url):
+        self.url = url
+        self.status = response.status
+        self.etag = response.getheader("etag")
+        self.last_modified = response.getheader("last-modified")
+        self.charset = parse_charset(response.getheader("content-type"))
+        self.bytes_read = 0
+        self._fetcher = fetcher
+        self._pool_key = pool_key
+        self._connection = connection
+        self._response = response
+        self._complete = False
+        if response.getheader("content-encoding", "").lower() == "gzip":
+            # 16 + MAX_WBITS tells zlib to expect a gzip header
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decompressor = None
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        """ Yields the decoded body in chunks
+            Raises ResponseTooLarge once more than max_body_size bytes have been decoded
+        """
+        max_body_size = self._fetcher.max_body_size
+        size = 0
+        try:
+            while True:
+                data = self._response.read(chunk_size)
+                if not data:
+                    break
+                self.bytes_read += len(data)
+                if self._decompressor:
+                    # Limit the output of each step so that a small compressed body cannot inflate without bound
+                    data = self._decompressor.decompress(data, max_body_size + 1 - size)
+                    if self._decompressor.unconsumed_tail:
+                        raise ResponseTooLarge(self.url)
+                size += len(data)
+                if size > max_body_size:
+                    raise ResponseTooLarge(self.url)
+                if data:
+                    yield data
+            if self._decompressor:
+                data = self._decompressor.flush()
+                if data:
+                    yield data
+            self._complete = True
+        except (socket.error, httplib.HTTPException), e:
+            raise urllib2.URLError(e)
+
+    def read(self):
+        return "".join(self.iter_chunks())
+
+    def close(self):
+        if self._connection is None:
+            return
+        reusable = self._complete and not self._response.will_close
+        self._response.close()
+        self._fetcher._release(self._pool_key, self._connection, reusable)
+        self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class HttpFetcher(object):
+    """ Fetches pages over pooled keep-alive connections
+        pool_size is the maximum number of idle connections kept for each host
+        upstream is the url of a server, eg: 'http://127.0.0.1:8000', which receives every request in place of the
+        host in the requested url. The requested host is sent in the Host header. This lets a stand-in for wikipedia
+        be used for benchmarks and tests.
+        guard is an UpstreamGuard which rate limits requests to each host and stops making them to failing hosts.
+    """
+
+    def __init__(self, pool_size=4, connect_timeout=5.0, read_timeout=10.0, max_body_size=10 * 1024 * 1024,
+                 max_redirects=5, user_agent=default_user_agent, upstream=None, guard=None):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_body_size = max_body_size
+        self.max_redirects = max_redirects
+        self.user_agent = user_agent
+        self.upstream = urlparse.urlsplit(upstream) if upstream else None
+        self.guard = guard
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    def _acquire(self, pool_key):
+        """ Returns (connection, reused) for pool_key = (scheme, host, port)
+        """
+        with self._lock:
+            idle = self._idle.get(pool_key)
+            if idle:
+                self.connections_reused += 1
+                return idle.pop(), True
+            self.connections_opened += 1
+
+        scheme, host, port = pool_key
+        connection_class = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+        connection = connection_class(host, port, timeout=self.connect_timeout)
+        try:
+            connection.connect()
+        except (socket.error, httplib.HTTPException), e:
+            raise urllib2.URLError(e)
+        # The connect timeout has been applied so switch to the read timeout for the rest of the connection's life
+        connection.sock.settimeout(self.read_timeout)
+        return connection, False
+
+    def _release(self, pool_key, connection, reusable):
+        if reusable:
+            with self._lock:
+                idle = self._idle.setdefault(pool_key, [])
+                if len(idle) < self.pool_size:
+                    idle.append(connection)
+                    return
+        connection.close()
+
+    def close(self):
+        """ Closes all idle connections
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _request(self, url, headers):
+        """ Sends a single GET request and returns a FetchResponse without following redirects
+        """
+        parts = check_url(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        path = quote_path(path)
+        if self.upstream is not None:
+            headers = dict(headers, Host=parts.netloc)
+            parts = self.upstream
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        pool_key = (parts.scheme, parts.hostname, port)
+
+        connection, reused = self._acquire(pool_key)
+        try:
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+        except (httplib.InvalidURL, UnicodeError), e:
+            # Nothing was sent but the connection is part way through a request so it cannot be reused
+            connection.close()
+            raise InvalidRequest(e)
+        except (socket.error, httplib.HTTPException), e:
+            connection.close()
+            if reused and not isinstance(e, socket.timeout):
+                # The server may have closed the idle connection so retry with another one
+                return self._request(url, headers)
+            raise urllib2.URLError(e)
+        return FetchResponse(self, pool_key, connection, response, url)
+
+    def _guarded_request(self, url, headers):
+        """ _request, raising UpstreamUnavailable instead if the guard does not allow a request to the url's host
+            and recording the outcome with the guard. Urls which could not be requested are not failures of the host.
+        """
+        if self.guard is None:
+            return self._request(url, headers)
+        host = check_url(url).hostname
+        self.guard.acquire(host)
+        started = time.time()
+        try:
+            response = self._request(url, headers)
+        except InvalidRequest:
+            self.guard.release(host)
+            raise
+        except urllib2.URLError:
+            self.guard.record(host, time.time() - started, True)
+            raise
+        except BaseException:
+            # Any other error, eg: ssl.CertificateError, says nothing about the health of the host but must not leave
+            # the breaker waiting for the outcome of a trial request forever
+            self.guard.release(host)
+            raise
+        retry_after = None
+        if response.status in (429, 503):
+            retry_after = parse_retry_after(response._response.getheader("retry-after"))
+        self.guard.record(host, time.time() - started, response.status == 429 or response.status >= 500, retry_after)
+        return response
+
+    def open(self, url, etag=None, last_modified=None):
+        """ Requests url, following redirects, and returns an open FetchResponse for a successful response
+            If either of the validators from a previous fetch are provided the request is made conditional and
+            NotModified is raised when the page has not changed.
+        """
+        headers = {
+            "Accept-Encoding": "gzip",
+            "Connection": "keep-alive",
+            "User-Agent": self.user_agent,
+        }
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        for _ in range(self.max_redirects + 1):
+            response = self._guarded_request(url, headers)
+            if response.status in (301, 302, 303, 307, 308):
+                location = response._response.getheader("location")
+                # Read the (usually tiny) redirect body so that the connection can be reused
+                response.read()
+                response.close()
+                if not location:
+                    raise urllib2.HTTPError(url, response.status, "redirect without a location", None, None)
+                url = urlparse.urljoin(url, location)
+                continue
+            if response.status == 304:
+                response.read()
+                response.close()
+                raise NotModified(url)
+            if not 200 <= response.status < 300:
+                reason = response._response.reason
+                # Error pages are small so read them to allow the connection to be reused
+                response.read()
+                response.close()
+                raise urllib2.HTTPError(url, response.status, reason, response._response.msg, None)
+            return response
+        raise urllib2.HTTPError(url, response.status, "too many redirects", None, None)
+
+    def fetch(self, url, etag=None, last_modified=None):
+        """ Returns a FetchedPage with the whole body of url
+        """
+        with self.open(url, etag, last_modified) as response:
+            return FetchedPage(response.read(), response.etag, response.last_modified, response.charset)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(
+                connections_opened=self.connections_opened,
+                connections_reused=self.connections_reused,
+                idle_connections=sum(len(connections) for connections in self._idle.values()),
+            )
+        if self.guard is not None:
+            stats["upstream"] = self.guard.stats()
+        return stats
+
+
+def fetcher_from_settings(settings):
+    """ Creates an HttpFetcher from the 'wiki_toc.fetch.*' settings in the .ini file
+    """
+    return HttpFetcher(
+        pool_size=int(settings.get("wiki_toc.fetch.pool_size", 4)),
+        connect_timeout=float(settings.get("wiki_toc.fetch.connect_timeout", 5.0)),
+        read_timeout=float(settings.get("wiki_toc.fetch.read_timeout", 10.0)),
+        max_body_size=int(settings.get("wiki_toc.fetch.max_body_size", 10 * 1024 * 1024)),
+        max_redirects=int(settings.get("wiki_toc.fetch.max_redirects", 5)),
+        user_agent=settings.get("wiki_toc.fetch.user_agent", default_user_agent),
+        upstream=settings.get("wiki_toc.fetch.upstream") or None,
+        guard=guard_from_settings(settings),
+    )
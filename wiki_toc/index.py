@@ -0,0 +1,227 @@
+""" A precomputed index of tables of contents which the web app reads through a memory map.
+
+    Usage: wiki_toc_index SOURCE OUTPUT
+
+    SOURCE is the output of wiki_toc_bulk. OUTPUT is written to a temporary file beside it and renamed into place so
+    that a running app picks up the new index on its next check without being restarted; requests which are using the
+    old index finish with it since the renamed file stays mapped until nothing refers to it.
+
+    The file is laid out as:
+
+        header      magic, format version, number of keys and the offset of the key table
+        payload     one record per key: the length of the key, the key and the zlib compressed json of its tree
+        key table   (64 bit hash of the key, offset of the record, length of the record) sorted by hash
+
+    A lookup hashes the key, binary searches the key table in the map and only decompresses the record that matches.
+    Nothing is read into memory when the index is opened so an index of millions of pages opens instantly and is
+    shared between processes by the page cache.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from .bulk import open_compressed
+
+index_magic = "WTOCIDX\x00"
+index_format_version = 1
+
+_header = struct.Struct("<8sIQQ")      # magic, version, number of keys, offset of the key table
+_table_entry = struct.Struct("<QQI")   # hash of the key, offset of the record, length of the record
+_key_length = struct.Struct("<I")
+
+
+class IndexFormatError(Exception):
+    """ Raised when a file is not a toc index written by this version of wiki_toc
+    """
+
+
+def hash_key(key):
+    """ Returns the 64 bit hash used to order the key table
+    """
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return struct.unpack("<Q", hashlib.md5(key).digest()[:8])[0]
+
+
+def write_index(records, path):
+    """ Writes an index of the (key, tree or None) pairs in records to path and returns the number of keys
+        The index is written to a temporary file which replaces path once it is complete. When a key occurs more than
+        once the last record for it is used.
+    """
+    temporary_path = "%s.%d.tmp" % (path, os.getpid())
+    entries = []
+    try:
+        with open(temporary_path, "wb") as f:
+            f.write(_header.pack(index_magic, index_format_version, 0, 0))
+            offset = _header.size
+            for sequence, (key, toc) in enumerate(records):
+                if isinstance(key, unicode):
+                    key = key.encode("utf-8")
+                record = _key_length.pack(len(key)) + key + zlib.compress(json.dumps(toc, separators=(",", ":")))
+                f.write(record)
+                # The later of two records for the same key sorts first so that it is the one found
+                entries.append((hash_key(key), -sequence, offset, len(record)))
+                offset += len(record)
+            entries.sort()
+            for key_hash, _, record_offset, record_length in entries:
+                f.write(_table_entry.pack(key_hash, record_offset, record_length))
+            f.seek(0)
+            f.write(_header.pack(index_magic, index_format_version, len(entries), offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    return len(entries)
+
+
+def iter_bulk_output(lines):
+    """ Yields (key, tree or None) for each line written by wiki_toc_bulk
+    """
+    for line in lines:
+        line = line.strip()
+        if line:
+            record = json.loads(line)
+            yield record["key"], record["toc"]
+
+
+class _MappedIndex(object):
+    """ One open index file. Lookups do not take any locks
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.stat = os.fstat(f.fileno())
+            if self.stat.st_size < _header.size:
+                raise IndexFormatError("'%s' is too short to be a toc index" % path)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, self.table_offset = _header.unpack_from(self.map, 0)
+        if magic != index_magic or version != index_format_version:
+            self.map.close()
+            raise IndexFormatError("'%s' is not a version %d toc index" % (path, index_format_version))
+        if self.table_offset + self.count * _table_entry.size > self.stat.st_size:
+            self.map.close()
+            raise IndexFormatError("'%s' is truncated" % path)
+
+    def _entry(self, position):
+        return _table_entry.unpack_from(self.map, self.table_offset + position * _table_entry.size)
+
+    def lookup(self, key):
+        """ Returns (True, tree or None) if key is in the index or (False, None) if it is not
+        """
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        key_hash = hash_key(key)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[0] < key_hash:
+                low = middle + 1
+            else:
+                high = middle
+        # Keys whose hashes collide are adjacent in the table
+        while low < self.count:
+            entry_hash, offset, length = self._entry(low)
+            if entry_hash != key_hash:
+                break
+            key_length, = _key_length.unpack_from(self.map, offset)
+            start = offset + _key_length.size
+            if self.map[start:start + key_length] == key:
+                return True, json.loads(zlib.decompress(self.map[start + key_length:offset + length]))
+            low += 1
+        return False, None
+
+
+class TocIndex(object):
+    """ Looks up tables of contents in the index at path
+        Every check_interval seconds the file is checked and, if it has been replaced, the new index is mapped. The
+        index may not exist when the app starts, in which case every lookup misses until it has been built.
+    """
+
+    def __init__(self, path, check_interval=30.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._index = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.reload()
+
+    def reload(self):
+        """ Maps the index file if it has changed since it was last mapped
+            The previous map is not closed since other threads may be reading it; it is released once they finish.
+        """
+        with self._lock:
+            self._checked = time.time()
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                self._index = None
+                return
+            current = self._index
+            if current is not None and (current.stat.st_ino, current.stat.st_mtime, current.stat.st_size) == \
+                    (stat.st_ino, stat.st_mtime, stat.st_size):
+                return
+            try:
+                self._index = _MappedIndex(self.path)
+                self.reloads += 1
+            except (IOError, OSError, IndexFormatError, ValueError), e:
+                logging.error("Failed to open the toc index '%s': %s", self.path, str(e))
+
+    def lookup(self, key):
+        """ Returns (True, tree or None) if key is in the index or (False, None) if it is not
+        """
+        if time.time() - self._checked >= self.check_interval:
+            self.reload()
+        index = self._index
+        found, toc = index.lookup(key) if index is not None else (False, None)
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found, toc
+
+    def __len__(self):
+        index = self._index
+        return index.count if index is not None else 0
+
+    def stats(self):
+        return dict(keys=len(self), hits=self.hits, misses=self.misses, reloads=self.reloads)
+
+
+def index_from_settings(settings):
+    """ Returns a TocIndex for the 'wiki_toc.index.*' settings or None if no index has been configured
+    """
+    path = settings.get("wiki_toc.index.path")
+    if not path:
+        return None
+    return TocIndex(path, check_interval=float(settings.get("wiki_toc.index.check_interval", 30.0)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the index of tables of contents read by the web app.")
+    parser.add_argument("source", help="the output of wiki_toc_bulk, gzip compressed if it ends with '.gz'")
+    parser.add_argument("output", help="the index to write; an existing index is replaced atomically")
+    args = parser.parse_args(argv)
+
+    started = time.time()
+    with open_compressed(args.source) as source:
+        count = write_index(iter_bulk_output(source), args.output)
+    sys.stderr.write("Indexed %d pages in %.1fs\n" % (count, time.time() - started))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,307 @@
+""" Latency, size and error metrics for the pipeline which turns a wikipedia page into a table of contents.
+
+    Each request is given a RequestTimer by the metrics tween. The views and load_toc time their stages with it:
+
+        cache   looking the page up in the toc cache and the precomputed index
+        fetch   connecting to wikipedia and waiting for the response headers
+        read    reading the body of the page from the network
+        parse   parsing the page and building the tree for its table of contents, excluding the time spent reading
+        rewrite making the hrefs in the table of contents absolute
+        render  rendering the table of contents and the page template
+
+    When the request is finished the time spent in each stage is added to the histograms in Metrics, which are served
+    in the Prometheus text format by the 'metrics' route. Requests which take longer than slow_request_seconds are
+    logged with the time spent in each stage.
+"""
+import logging
+import threading
+import time
+import urllib2
+from contextlib import contextmanager
+
+from pyramid.settings import asbool
+
+from .engine import EngineBusy, EngineTimeout
+from .upstream import UpstreamUnavailable
+
+stages = ("cache", "fetch", "read", "parse", "rewrite", "render")
+
+# Upper bounds of the histogram buckets
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+size_buckets = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# The environ key under which the metrics tween stores the RequestTimer for a request
+timer_environ_key = "wiki_toc.timer"
+
+
+def error_class(e):
+    """ Returns the label that an error raised while getting a table of contents is counted under
+        HTTPError is checked before URLError since it is a subclass of it
+    """
+    if isinstance(e, urllib2.HTTPError):
+        return "http_error"
+    if isinstance(e, urllib2.URLError):
+        return "url_error"
+    if isinstance(e, EngineTimeout):
+        return "timeout"
+    if isinstance(e, EngineBusy):
+        return "busy"
+    if isinstance(e, UpstreamUnavailable):
+        return "upstream_unavailable"
+    return "other"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                              for name, value in labels)
+
+
+class Histogram(object):
+    """ Counts observations in cumulative buckets for each combination of label values
+    """
+
+    def __init__(self, name, documentation, label_names=(), buckets=latency_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._series = {}   # label values -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            return series[2] if series else 0
+
+    def render(self, lines):
+        lines.append("# HELP %s %s" % (self.name, self.documentation))
+        lines.append("# TYPE %s histogram" % self.name)
+        with self._lock:
+            series = sorted((key, (list(value[0]), value[1], value[2])) for key, value in self._series.items())
+        for label_values, (counts, total, count) in series:
+            labels = zip(self.label_names, label_values)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append("%s_bucket%s %d" % (self.name, _format_labels(labels + [("le", _format_value(bound))]), cumulative))
+            lines.append("%s_sum%s %s" % (self.name, _format_labels(labels), _format_value(total)))
+            lines.append("%s_count%s %d" % (self.name, _format_labels(labels), count))
+
+
+class Counter(object):
+    """ A count for each combination of label values
+    """
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def render(self, lines):
+        lines.append("# HELP %s %s" % (self.name, self.documentation))
+        lines.append("# TYPE %s counter" % self.name)
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            lines.append("%s%s %d" % (self.name, _format_labels(zip(self.label_names, label_values)), value))
+
+
+class Metrics(object):
+    """ The metrics collected by the app
+        slow_request_seconds is the duration above which requests are logged with a breakdown of their stages or None
+    """
+
+    def __init__(self, slow_request_seconds=None):
+        self.slow_request_seconds = slow_request_seconds
+        self.request_seconds = Histogram("wiki_toc_request_seconds", "Time taken to respond to a request", ("route",))
+        self.stage_seconds = Histogram("wiki_toc_stage_seconds",
+                                       "Time spent in each stage of getting and rendering a table of contents", ("stage",))
+        self.page_bytes = Histogram("wiki_toc_page_bytes", "Bytes of html parsed for each page", buckets=size_buckets)
+        self.fetched_bytes = Counter("wiki_toc_fetched_bytes_total", "Bytes received from wikipedia, before decompression")
+        self.errors = Counter("wiki_toc_errors_total", "Errors while getting a table of contents by class of error",
+                              ("class",))
+
+    def render(self):
+        """ Returns the metrics in the Prometheus text format
+        """
+        lines = []
+        for metric in (self.request_seconds, self.stage_seconds, self.page_bytes, self.fetched_bytes, self.errors):
+            metric.render(lines)
+        return "\n".join(lines) + "\n"
+
+
+class RequestTimer(object):
+    """ Accumulates the time spent in each stage of a single request
+        Time spent in a stage nested within another is only counted in the inner stage. Stages may be timed by a fetch
+        engine worker on behalf of the request; anything recorded after the request has finished is ignored.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.started = time.time()
+        self.durations = {}
+        self.page_bytes = 0
+        self.finished = False
+        self._render_started = None
+        self._nested = threading.local()
+
+    @contextmanager
+    def stage(self, name):
+        nested = getattr(self._nested, "stack", None)
+        if nested is None:
+            nested = self._nested.stack = []
+        nested.append(0.0)
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            inner = nested.pop()
+            if nested:
+                nested[-1] += elapsed
+            if not self.finished:
+                self.durations[name] = self.durations.get(name, 0.0) + elapsed - inner
+
+    def timed_chunks(self, chunks):
+        """ Yields the chunks of a page, timing each read as the 'read' stage and counting the bytes
+        """
+        chunks = iter(chunks)
+        while True:
+            with self.stage("read"):
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return
+            self.page_bytes += len(chunk)
+            yield chunk
+
+    def page_finished(self, page):
+        """ Records the size of a page once it has been read
+        """
+        if self.finished:
+            return
+        self.metrics.page_bytes.observe(self.page_bytes)
+        self.page_bytes = 0
+        fetched = getattr(page, "bytes_read", None)
+        if fetched:
+            self.metrics.fetched_bytes.inc(fetched)
+
+    def count_error(self, e):
+        self.metrics.errors.inc(1, error_class(e))
+
+    def render_started(self):
+        self._render_started = time.time()
+
+    def finish(self, route_name, status=None):
+        """ Adds the request's timings to the histograms and logs the request if it was slow
+        """
+        now = time.time()
+        if self._render_started is not None:
+            self.durations["render"] = self.durations.get("render", 0.0) + now - self._render_started
+        self.finished = True
+        total = now - self.started
+        self.metrics.request_seconds.observe(total, route_name)
+        for name, duration in self.durations.items():
+            self.metrics.stage_seconds.observe(duration, name)
+        slow = self.metrics.slow_request_seconds
+        if slow is not None and total >= slow:
+            breakdown = " ".join("%s=%.3fs" % (name, self.durations[name]) for name in stages if name in self.durations)
+            logging.warning("Slow request to %s (status %s) took %.3fs: %s", route_name, status, total,
+                            breakdown or "no stages")
+
+
+class NullTimer(object):
+    """ Stands in for a RequestTimer when metrics are disabled, or outside of a request
+    """
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def timed_chunks(self, chunks):
+        return chunks
+
+    def page_finished(self, page):
+        pass
+
+    def count_error(self, e):
+        pass
+
+    def render_started(self):
+        pass
+
+null_timer = NullTimer()
+
+
+def get_timer(request):
+    """ Returns the RequestTimer for request or null_timer if metrics are not being collected
+    """
+    return request.environ.get(timer_environ_key) or null_timer
+
+
+def metrics_tween_factory(handler, registry):
+    """ Times every request and records its stages in registry.metrics
+    """
+    metrics = registry.metrics
+
+    def metrics_tween(request):
+        timer = request.environ[timer_environ_key] = RequestTimer(metrics)
+        status = None
+        try:
+            response = handler(request)
+            status = response.status_int
+            return response
+        except BaseException, e:
+            status = getattr(e, "status_int", 500)
+            raise
+        finally:
+            route = getattr(request, "matched_route", None)
+            timer.finish(route.name if route is not None else "none", status)
+    return metrics_tween
+
+
+def before_render(event):
+    """ Marks the start of template rendering so that it is counted in the 'render' stage
+    """
+    request = event.get("request")
+    if request is not None:
+        get_timer(request).render_started()
+
+
+def metrics_from_settings(settings):
+    """ Returns Metrics for the 'wiki_toc.metrics.*' settings or None if metrics are disabled
+    """
+    if not asbool(settings.get("wiki_toc.metrics.enabled", True)):
+        return None
+    slow_request_seconds = settings.get("wiki_toc.metrics.slow_request_seconds")
+    return Metrics(slow_request_seconds=float(slow_request_seconds) if slow_request_seconds else None)
+
@@ -0,0 +1,68 @@
+""" Background refreshing of stale tables of contents.
+
+    When a cached table of contents has expired, but not by more than the cache's max_stale, the view returns it
+    straight away and asks a Refresher to fetch the page again in the background. Only one refresh is scheduled for a
+    key at a time however many requests see the stale entry.
+"""
+import logging
+import threading
+
+from .engine import EngineBusy
+
+
+class Refresher(object):
+    """ Runs refreshes on a FetchEngine's workers, or on a thread of their own when there is no engine
+    """
+
+    def __init__(self):
+        self._pending = set()
+        self._lock = threading.Lock()
+        self.scheduled = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def schedule(self, key, engine, function, *args):
+        """ Runs function(*args) in the background unless a refresh of key is already pending
+            Returns True if the refresh was scheduled. A refresh is dropped when the engine's queue is full since the
+            stale value can continue to be served until a later request schedules another.
+        """
+        with self._lock:
+            if key in self._pending:
+                self.skipped += 1
+                return False
+            self._pending.add(key)
+            self.scheduled += 1
+
+        try:
+            if engine is not None:
+                engine.submit(self._run, key, function, args)
+            else:
+                thread = threading.Thread(target=self._run, args=(key, function, args), name="wiki_toc-refresh")
+                thread.daemon = True
+                thread.start()
+        except EngineBusy:
+            with self._lock:
+                self._pending.discard(key)
+                self.scheduled -= 1
+                self.skipped += 1
+            return False
+        return True
+
+    def _run(self, key, function, args):
+        try:
+            function(*args)
+        except BaseException, e:
+            with self._lock:
+                self.failed += 1
+            logging.error("Failed to refresh the table of contents for '%s': %s", key, str(e))
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def stats(self):
+        with self._lock:
+            return dict(scheduled=self.scheduled, skipped=self.skipped, failed=self.failed, pending=len(self._pending))
@@ -0,0 +1,214 @@
+""" Caching of the rendered html pages of the 'wiki_toc' route.
+
+    Even when its table of contents is cached, rendering a page through the templates takes longer than the rest of the
+    request. The bytes of each successfully rendered page are therefore cached for ttl seconds, along with gzip (and,
+    when the brotli module is installed, brotli) encoded copies which are compressed once when the page is stored.
+    Every response from the cache has an ETag, Cache-Control and Vary header so that browsers and CDNs can reuse it and
+    a request whose If-None-Match matches the cached page is answered with a 304 without rendering anything.
+
+    Each encoding of a page has its own strong ETag: the identity ETag with '-gzip' or '-br' appended before the closing
+    quote. If-None-Match is compared against the identity ETag after removing these suffixes, as is done by Apache.
+"""
+import hashlib
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from pyramid.response import Response
+from pyramid.settings import asbool
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# The view sets this in the wsgi environ when the page it returns may be cached
+cacheable_environ_key = "wiki_toc.cacheable"
+
+encoding_suffixes = {"gzip": "-gzip", "br": "-br"}
+
+
+def mark_cacheable(request):
+    """ Marks the page being rendered for request as one which may be served from the response cache
+    """
+    request.environ[cacheable_environ_key] = True
+
+def gzip_compress(body, level=9):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+class RenderedPage(object):
+    """ The bytes of a rendered page, keyed by content encoding, and the time (as returned by time.time()) at which
+        they expire
+    """
+    __slots__ = ('bodies', 'etag', 'content_type', 'expires')
+
+    def __init__(self, body, content_type, expires, use_brotli=True):
+        self.bodies = {"identity": body, "gzip": gzip_compress(body)}
+        if brotli is not None and use_brotli:
+            self.bodies["br"] = brotli.compress(body)
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()[:20]
+        self.content_type = content_type
+        self.expires = expires
+
+    def is_fresh(self, now=None):
+        return (now or time.time()) < self.expires
+
+    def etag_for(self, encoding):
+        suffix = encoding_suffixes.get(encoding)
+        return self.etag[:-1] + suffix + '"' if suffix else self.etag
+
+    def matches(self, if_none_match):
+        """ Returns True if the If-None-Match header if_none_match matches any encoding of the page
+        """
+        if not if_none_match:
+            return False
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag == "*":
+                return True
+            # If-None-Match uses the weak comparison
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            for suffix in encoding_suffixes.values():
+                if tag.endswith(suffix + '"'):
+                    tag = tag[:-len(suffix) - 1] + '"'
+                    break
+            if tag == self.etag:
+                return True
+        return False
+
+    def size(self):
+        return sum(len(body) for body in self.bodies.values())
+
+
+def choose_encoding(request, available):
+    """ Returns the best of the available content encodings which is acceptable to the client, or 'identity'
+        Clients which do not send Accept-Encoding receive the page unencoded.
+    """
+    if "Accept-Encoding" not in request.headers:
+        return "identity"
+    offers = [encoding for encoding in ("br", "gzip", "identity") if encoding in available]
+    acceptable = request.accept_encoding.acceptable_offers(offers)
+    return acceptable[0][0] if acceptable else "identity"
+
+
+class ResponseCache(object):
+    """ A thread safe, size bounded LRU cache of RenderedPages with a TTL
+        max_age is the number of seconds for which clients are told that they may reuse a response.
+    """
+
+    def __init__(self, ttl=300, max_entries=1000, max_age=300, use_brotli=True):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.use_brotli = use_brotli
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Returns the fresh RenderedPage for key or None
+        """
+        now = time.time()
+        with self._lock:
+            page = self._entries.pop(key, None)
+            if page is not None and page.is_fresh(now):
+                # Reinsert the page so that it becomes the most recently used
+                self._entries[key] = page
+                self.hits += 1
+                return page
+            self.misses += 1
+            return None
+
+    def set(self, key, body, content_type, ttl=None):
+        """ Stores body, compressing it once for each encoding, and returns the RenderedPage
+        """
+        page = RenderedPage(body, content_type, time.time() + (self.ttl if ttl is None else ttl), self.use_brotli)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = page
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return page
+
+    def response(self, request, page):
+        """ Returns the response to request for page: a 304 if request's If-None-Match matches it, otherwise the page in
+            the best encoding that the client accepts
+        """
+        encoding = choose_encoding(request, page.bodies)
+        headers = [("ETag", page.etag_for(encoding)),
+                   ("Cache-Control", "public, max-age=%d" % self.max_age),
+                   ("Vary", "Accept-Encoding")]
+        if page.matches(request.headers.get("If-None-Match")):
+            with self._lock:
+                self.not_modified += 1
+            return Response(status=304, headerlist=headers)
+        if encoding != "identity":
+            headers.append(("Content-Encoding", encoding))
+        headers.append(("Content-Type", page.content_type))
+        return Response(body=page.bodies[encoding], headerlist=headers)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                not_modified=self.not_modified,
+                evictions=self.evictions,
+                entries=len(self._entries),
+                bytes=sum(page.size() for page in self._entries.values()),
+                encodings=sorted(["identity", "gzip"] + (["br"] if brotli is not None and self.use_brotli else [])),
+            )
+
+
+def response_cache_key(request):
+    """ Returns the key of the page for request, or None if it has no wiki location
+        The host is part of the key since the rendered page contains absolute links to the app. The wiki location is
+        not normalized since the page shows it as it was typed.
+    """
+    wiki_location = "/".join(request.matchdict.get("wiki_location") or ())
+    if not wiki_location:
+        return None
+    return request.host_url + "/" + wiki_location
+
+def cached_response(view):
+    """ A view decorator which serves the rendered pages of view from the registry's response cache
+        view must call mark_cacheable for the pages which may be stored. Other pages are returned as they were rendered.
+    """
+    def cached_view(context, request):
+        response_cache = getattr(request.registry, "response_cache", None)
+        key = response_cache_key(request) if request.method in ("GET", "HEAD") else None
+        if response_cache is None or key is None:
+            return view(context, request)
+
+        page = response_cache.get(key)
+        if page is None:
+            response = view(context, request)
+            if response.status_int != 200 or not request.environ.get(cacheable_environ_key):
+                return response
+            page = response_cache.set(key, response.body, response.headers["Content-Type"])
+        return response_cache.response(request, page)
+    return cached_view
+
+def responses_from_settings(settings):
+    """ Creates a ResponseCache from the 'wiki_toc.responses.*' settings or returns None if it is disabled
+    """
+    if not asbool(settings.get("wiki_toc.responses.enabled", True)):
+        return None
+    return ResponseCache(
+        ttl=int(settings.get("wiki_toc.responses.ttl", 300)),
+        max_entries=int(settings.get("wiki_toc.responses.max_entries", 1000)),
+        max_age=int(settings.get("wiki_toc.responses.max_age", 300)),
+        use_brotli=asbool(settings.get("wiki_toc.responses.brotli", True)),
+    )
@@ -0,0 +1,100 @@
+""" Coalescing of concurrent calls for the same key.
+
+    When a page is popular many waitress threads ask for its table of contents at the same time. SingleFlight lets
+    the first of them do the work while the others wait for it and share its result, or its error.
+"""
+import sys
+import threading
+
+from .engine import EngineTimeout
+
+
+class _Call(object):
+    __slots__ = ('finished', 'result', 'exc_info', 'waiters')
+
+    def __init__(self):
+        self.finished = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.waiters = 0
+
+    def wait(self, timeout=None):
+        """ Returns the result of the call, raises the error it raised or raises EngineTimeout
+            The call carries on after a timeout and its result is still shared with the calls which join it.
+        """
+        if not self.finished.wait(timeout):
+            raise EngineTimeout("The call did not finish within %s seconds" % timeout)
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class SingleFlight(object):
+    """ Runs at most one call at a time for each key
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, function, *args, **kwargs):
+        """ Returns function(*args, **kwargs) unless a call for key is already in progress, in which case the result
+            of that call is returned instead. Errors are raised in every thread that waited for the call.
+        """
+        call, leader = self._join(key)
+        if not leader:
+            return call.wait()
+        return self._run(key, call, function, args, kwargs)
+
+    def submit(self, key, engine, function, *args, **kwargs):
+        """ Runs function(*args, **kwargs) as a job in engine, unless a call for key is already in progress, and returns
+            the call, whose wait method returns its result. The flight lasts until the job finishes, however long its
+            callers wait for it, so a caller which gives up waiting does not lead to the function being called again.
+            Raises EngineBusy if the engine's queue is full.
+        """
+        call, leader = self._join(key)
+        if leader:
+            try:
+                engine.submit(self._run, key, call, function, args, kwargs)
+            except BaseException:
+                self._finish(key, call, sys.exc_info())
+                raise
+        return call
+
+    def _join(self, key):
+        """ Returns (the call in progress for key, False) or (a new call for key, True)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+                return call, True
+            call.waiters += 1
+            self.coalesced += 1
+            return call, False
+
+    def _finish(self, key, call, exc_info=None):
+        call.exc_info = exc_info
+        with self._lock:
+            del self._calls[key]
+        call.finished.set()
+
+    def _run(self, key, call, function, args, kwargs):
+        try:
+            call.result = function(*args, **kwargs)
+        except BaseException:
+            self._finish(key, call, sys.exc_info())
+            raise
+        self._finish(key, call)
+        return call.result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def stats(self):
+        with self._lock:
+            return dict(calls=self.calls, coalesced=self.coalesced, in_flight=len(self._calls))
@@ -1,18 +1,28 @@
+import time
 import unittest
 
 from pyramid import testing
 
-def get_dummy_soup(url):
-    """ This function will be used to bypass the call to urllib2 in views.get_soup and return some predefined html
+from .views import open_page
+
+satchel_etag = '"satchel-1"'
+
+def get_dummy_page(url, etag=None, last_modified=None, fetcher=None):
+    """ This function will be used to bypass the fetcher in views.open_page and return some predefined html
+        It behaves as though the Satchel page never changes so conditional requests with its etag are not modified
     """
+    from .fetcher import FetchedPage, NotModified
+    if url and url.endswith("test_no_toc"):
+        return FetchedPage("<html><body><p>This page has no table of contents</p></body></html>")
     if not url or not url.endswith("en.wikipedia.org/wiki/Satchel"):
         if url and url.endswith("test_url_error"):
             from urllib2 import URLError
             raise URLError(str(url))
         else:
             raise Exception(str(url))
-            
-    from bs4 import BeautifulSoup
+
+    if etag == satchel_etag:
+        raise NotModified(url)
     html = """<div id="toc" class="toc">
 <div id="toctitle">
 <h2>Contents</h2>
@@ -26,7 +36,7 @@ def get_dummy_soup(url):
 <li class="toclevel-1 tocsection-6"><a href="#References"><span class="tocnumber">6</span> <span class="toctext">References</span></a></li>
 </ul>
 </div>"""
-    return BeautifulSoup(html, 'lxml')
+    return FetchedPage(html, satchel_etag, "Sat, 01 Jan 2000 00:00:00 GMT")
 
 class ViewTests(unittest.TestCase):
     def setUp(self):
@@ -103,7 +113,7 @@ class ViewTests(unittest.TestCase):
     def test_wiki_toc(self):
         from . import views
         # Make sure to bypass urllib2
-        views.get_soup=get_dummy_soup
+        views.open_page=get_dummy_page
         request = testing.DummyRequest()
         
         # Test with a blank wiki_location
@@ -144,7 +154,905 @@ class ViewTests(unittest.TestCase):
         self.assertEqual(info['title'], 'test_any_error')
         self.assertEqual(str(info['toc']), "")
         self.assertEqual(info['errors'], ["Could not get the table of contents for 'test_any_error'"])
-        
+
+        request.matchdict["wiki_location"] = ('test_no_toc',)
+        info = views.wiki_toc(request)
+        self.assertEqual(info['toc'], '')
+        self.assertEqual(info['errors'], ["No table of contents is available."])
+
+    def test_wiki_toc_json(self):
+        from . import views
+        views.open_page=get_dummy_page
+        request = testing.DummyRequest()
+
+        request.matchdict["wiki_location"] = ('en.wikipedia.org', 'wiki', 'Satchel')
+        info = views.wiki_toc_json(request)
+        self.assertEqual(request.response.status_int, 200)
+        self.assertEqual(info['wiki_location'], 'en.wikipedia.org/wiki/Satchel')
+        self.assertEqual(info['errors'], [])
+        self.assertEqual(info['toc']['title'], 'Contents')
+        # The markup which is only used for rendering is not returned
+        self.assertEqual(sorted(info['toc']), ['sections', 'title'])
+        self.assertEqual(info['toc']['sections'][1], dict(level=1, section="2", number="2", text="School bag",
+                                                         anchor="School_bag", children=[],
+                                                         href="https://en.wikipedia.org/wiki/Satchel#School_bag"))
+
+        # The rendered html is the same as wiki_toc's
+        html = views.wiki_toc(request)['toc']
+        from .extractor import render_toc_html
+        self.assertEqual(render_toc_html(info['toc']), html)
+
+        for wiki_location, status, errors in [
+                ((), 400, ['No wikipedia location has been provided.']),
+                (('test_no_toc',), 404, ['No table of contents is available.']),
+                (('test_url_error',), 502, ["The url 'test_url_error' does not appear to be valid"]),
+                (('test_any_error',), 502, ["Could not get the table of contents for 'test_any_error'"])]:
+            request = testing.DummyRequest()
+            request.matchdict["wiki_location"] = wiki_location
+            info = views.wiki_toc_json(request)
+            self.assertEqual((request.response.status_int, info['toc'], info['errors']), (status, None, errors))
+
+    def test_wiki_toc_cached(self):
+        from . import views
+        from .cache import TocCache
+        views.open_page=get_dummy_page
+        request = testing.DummyRequest()
+        request.registry.toc_cache = TocCache(ttl=60, max_entries=10)
+
+        request.matchdict["wiki_location"] = ('en.wikipedia.org', 'wiki', 'Satchel')
+        first = views.wiki_toc(request)
+        self.assertEqual(request.registry.toc_cache.stats()["misses"], 1)
+
+        # The second request must not fetch the page; the domain is case insensitive
+        views.open_page=None
+        request.matchdict["wiki_location"] = ('EN.wikipedia.org', 'wiki', 'Satchel')
+        second = views.wiki_toc(request)
+        self.assertEqual(str(second['toc']), str(first['toc']))
+        self.assertEqual(second['errors'], [])
+        self.assertEqual(request.registry.toc_cache.stats()["hits"], 1)
+
+        # Unexpected errors are not cached
+        views.open_page=get_dummy_page
+        request.matchdict["wiki_location"] = ('en.wikipedia.org', 'wiki', 'Other')
+        views.wiki_toc(request)
+        self.assertEqual(request.registry.toc_cache.get_entry("en.wikipedia.org/wiki/Other"), None)
+
+    def test_wiki_toc_negative_cached(self):
+        import socket
+        import urllib2
+        from . import views
+        from .cache import TocCache
+        fetches = []
+        def counting_page(url, etag=None, last_modified=None, fetcher=None):
+            fetches.append(url)
+            if url.endswith("Missing"):
+                raise urllib2.HTTPError(url, 404, "Not Found", None, None)
+            if url.endswith("Unavailable"):
+                raise urllib2.HTTPError(url, 503, "Service Unavailable", None, None)
+            if url.endswith("Slow"):
+                raise urllib2.URLError(socket.timeout("timed out"))
+            return get_dummy_page(url, etag, last_modified)
+        views.open_page=counting_page
+        request = testing.DummyRequest()
+        request.registry.toc_cache = TocCache(ttl=60, max_entries=10, negative_ttl=30)
+
+        # Unreachable pages, missing pages and pages without a table of contents are only fetched once
+        for wiki_location, error in [(('test_url_error',), "The url 'test_url_error' does not appear to be valid"),
+                                     (('en.wikipedia.org', 'wiki', 'Missing'), "The url 'en.wikipedia.org/wiki/Missing' does not appear to be valid"),
+                                     (('test_no_toc',), "No table of contents is available.")]:
+            request.matchdict["wiki_location"] = wiki_location
+            for _ in range(2):
+                self.assertEqual(views.wiki_toc(request)['errors'], [error])
+        self.assertEqual(len(fetches), 3)
+        entry = request.registry.toc_cache.get_entry("test_no_toc")
+        self.assertEqual(entry.value, None)
+        self.assertTrue(entry.expires - time.time() <= 30)
+
+        # Other http errors and timeouts are not cached
+        for wiki_location in [('en.wikipedia.org', 'wiki', 'Unavailable'), ('en.wikipedia.org', 'wiki', 'Slow')]:
+            request.matchdict["wiki_location"] = wiki_location
+            views.wiki_toc(request)
+            views.wiki_toc(request)
+        self.assertEqual(len(fetches), 7)
+        self.assertEqual(request.registry.toc_cache.get_entry("en.wikipedia.org/wiki/Slow"), None)
+
+    def test_wiki_toc_stale(self):
+        import threading
+        from . import views
+        from .cache import TocCache
+        from .refresher import Refresher
+        fetched = threading.Event()
+        release = threading.Event()
+        def refreshing_page(url, etag=None, last_modified=None, fetcher=None):
+            fetched.set()
+            release.wait()
+            return get_dummy_page(url, None, last_modified)
+        views.open_page=get_dummy_page
+        request = testing.DummyRequest()
+        request.registry = self.config.registry
+        request.registry.toc_cache = TocCache(ttl=-1, max_entries=10, max_stale=60)
+        request.registry.toc_refresher = refresher = Refresher()
+        request.matchdict["wiki_location"] = ('en.wikipedia.org', 'wiki', 'Satchel')
+        first = views.wiki_toc(request)
+
+        # The expired table of contents is returned without waiting for the page while it is refreshed
+        views.open_page=refreshing_page
+        try:
+            second = views.wiki_toc(request)
+            self.assertEqual((str(second['toc']), second['errors']), (str(first['toc']), []))
+            fetched.wait(5)
+            # A refresh is already pending so another is not scheduled
+            views.wiki_toc(request)
+            self.assertEqual((refresher.scheduled, refresher.skipped), (1, 1))
+        finally:
+            release.set()
+        while refresher.pending():
+            time.sleep(0.01)
+        self.assertEqual(request.registry.toc_cache.get_entry("en.wikipedia.org/wiki/Satchel").etag, satchel_etag)
+
+        # Entries which expired longer ago than max_stale are fetched in the foreground
+        request.registry.toc_cache.max_stale = 0
+        views.open_page=get_dummy_page
+        self.assertEqual(views.wiki_toc(request)['errors'], [])
+        self.assertEqual(refresher.scheduled, 1)
+
+    def test_wiki_toc_upstream_unavailable(self):
+        from pyramid.httpexceptions import HTTPServiceUnavailable
+        from . import views
+        from .cache import TocCache
+        from .upstream import UpstreamUnavailable
+        def suspended_page(url, etag=None, last_modified=None, fetcher=None):
+            raise UpstreamUnavailable("en.wikipedia.org", 12.5, "the circuit breaker is open")
+        views.open_page=suspended_page
+        request = testing.DummyRequest()
+        request.matchdict["wiki_location"] = ('en.wikipedia.org', 'wiki', 'Satchel')
+        try:
+            views.wiki_toc(request)
+            self.fail("HTTPServiceUnavailable was not raised")
+        except HTTPServiceUnavailable, e:
+            self.assertEqual(e.headers["Retry-After"], "13")
+            self.assertTrue("try again in 13 seconds" in e.message)
+        result = views.wiki_toc_json(request)
+        self.assertEqual((request.response.status_int, request.response.headers["Retry-After"]), (503, "13"))
+        self.assertEqual(result["errors"], ["Wikipedia is not being sent requests at the moment. Please try again in 13 seconds."])
+
+        # An expired table of contents is served, however old, rather than failing
+        request = testing.DummyRequest()
+        request.registry.toc_cache = TocCache(ttl=-1, max_entries=10, max_stale=0)
+        request.matchdict["wiki_location"] = ('en.wikipedia.org', 'wiki', 'Satchel')
+        views.open_page=get_dummy_page
+        first = views.wiki_toc(request)
+        views.open_page=suspended_page
+        second = views.wiki_toc(request)
+        self.assertEqual((str(second['toc']), second['errors']), (str(first['toc']), []))
+
+    def test_wiki_toc_indexed(self):
+        import os
+        import shutil
+        import tempfile
+        from . import views
+        from .index import TocIndex, write_index
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "toc_index.bin")
+            write_index([("en.wikipedia.org/wiki/Indexed", dict(title=u"Contents", sections=[])),
+                         ("en.wikipedia.org/wiki/Empty", None)], path)
+            request = testing.DummyRequest()
+            request.registry.toc_index = TocIndex(path)
+
+            # Pages in the index are not fetched, including those without a table of contents
+            views.open_page=None
+            request.matchdict["wiki_location"] = ('en.wikipedia.org', 'wiki', 'Indexed')
+            info = views.wiki_toc(request)
+            self.assertEqual((info['toc'], info['errors']), (u'<div class="toc" id="toc">\n<div id="toctitle">\n<h2>Contents</h2>\n</div>\n\n</div>', []))
+            request.matchdict["wiki_location"] = ('en.wikipedia.org', 'wiki', 'Empty')
+            self.assertEqual(views.wiki_toc(request)['errors'], ["No table of contents is available."])
+
+            # Other pages are fetched
+            views.open_page=get_dummy_page
+            request.matchdict["wiki_location"] = ('en.wikipedia.org', 'wiki', 'Satchel')
+            self.assertTrue('School bag' in views.wiki_toc(request)['toc'])
+            self.assertEqual(request.registry.toc_index.stats()["hits"], 2)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_wiki_toc_revalidated(self):
+        from . import views
+        from .cache import TocCache
+        fetches = []
+        def counting_page(url, etag=None, last_modified=None, fetcher=None):
+            fetches.append(etag)
+            return get_dummy_page(url, etag, last_modified)
+        views.open_page=counting_page
+        request = testing.DummyRequest()
+        request.registry.toc_cache = TocCache(ttl=-1, max_entries=10)    # Every entry is stale as soon as it is stored
+
+        request.matchdict["wiki_location"] = ('en.wikipedia.org', 'wiki', 'Satchel')
+        first = views.wiki_toc(request)
+        entry = request.registry.toc_cache.get_entry("en.wikipedia.org/wiki/Satchel")
+        self.assertEqual(entry.etag, satchel_etag)
+        self.assertEqual(entry.last_modified, "Sat, 01 Jan 2000 00:00:00 GMT")
+
+        # The stale entry is revalidated with a conditional request and reused
+        second = views.wiki_toc(request)
+        self.assertEqual(fetches, [None, satchel_etag])
+        self.assertEqual(str(second['toc']), str(first['toc']))
+        self.assertEqual(second['errors'], [])
+        self.assertEqual(request.registry.toc_cache.stats()["revalidations"], 1)
+
+    def test_wiki_toc_coalesced(self):
+        import threading
+        from . import views
+        from .singleflight import SingleFlight
+        release = threading.Event()
+        fetches = []
+        def slow_page(url, etag=None, last_modified=None, fetcher=None):
+            fetches.append(url)
+            release.wait()
+            return get_dummy_page(url, etag, last_modified)
+        views.open_page=slow_page
+        request = testing.DummyRequest()
+        request.registry = self.config.registry     # The registry is otherwise looked up per thread
+        request.registry.toc_flights = SingleFlight()
+        request.matchdict["wiki_location"] = ('en.wikipedia.org', 'wiki', 'Satchel')
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(views.wiki_toc(request))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        # Wait for the other requests to join the first one
+        while request.registry.toc_flights.stats()["coalesced"] < 4:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(fetches), 1)
+        self.assertEqual(len(set(str(info['toc']) for info in results)), 1)
+        self.assertEqual([info['errors'] for info in results], [[]] * 5)
+
+    def test_wiki_toc_engine(self):
+        import threading
+        from . import views
+        from .engine import FetchEngine
+        from pyramid.httpexceptions import HTTPServiceUnavailable
+        views.open_page=get_dummy_page
+        request = testing.DummyRequest()
+        request.registry.fetch_engine = engine = FetchEngine(workers=1, queue_size=1, timeout=0.2).start()
+        release = threading.Event()
+        try:
+            request.matchdict["wiki_location"] = ('en.wikipedia.org', 'wiki', 'Satchel')
+            info = views.wiki_toc(request)
+            self.assertTrue('id="toc"' in str(info['toc']))
+            self.assertEqual(engine.stats()["submitted"], 1)
+
+            # Occupy the only worker and the only queue slot
+            engine.submit(release.wait)
+            while engine.stats()["busy_workers"] < 1 or engine.stats()["queued"]:
+                threading.Event().wait(0.01)
+            engine.submit(release.wait)
+            self.assertRaises(HTTPServiceUnavailable, views.wiki_toc, request)
+            release.set()
+            while engine.stats()["busy_workers"] or engine.stats()["queued"]:
+                threading.Event().wait(0.01)
+
+            # A page which takes longer than the deadline is reported as an error
+            def slow_page(url, etag=None, last_modified=None, fetcher=None):
+                threading.Event().wait(1)
+                return get_dummy_page(url, etag, last_modified)
+            views.open_page=slow_page
+            request.matchdict["wiki_location"] = ('en.wikipedia.org', 'wiki', 'Slow')
+            info = views.wiki_toc(request)
+            self.assertEqual(info['errors'], ["Timed out while getting the table of contents for 'en.wikipedia.org/wiki/Slow'"])
+        finally:
+            release.set()
+            engine.stop()
+
+    def get_batch(self, request, urls):
+        import json
+        from . import views
+        request.json_body = urls
+        response = views.wiki_toc_batch(request)
+        self.assertEqual(response.content_type, "application/x-ndjson")
+        return sorted((json.loads(line) for line in response.app_iter), key=lambda result: result["index"])
+
+    def test_wiki_toc_batch(self):
+        from . import views
+        from .engine import FetchEngine
+        views.open_page=get_dummy_page
+        urls = ["https://en.wikipedia.org/wiki/Satchel", "/wiki/Satchel", "Anything", "en.wikipedia.org/test_url_error"]
+        for engine in (None, FetchEngine(workers=2, queue_size=1).start()):
+            request = testing.DummyRequest(post={})
+            request.registry.batch_engine = engine
+            request.registry.settings = {"wiki_toc.batch.parallelism": "2"}
+            results = self.get_batch(request, dict(urls=urls))
+            self.assertEqual([result["index"] for result in results], [0, 1, 2, 3])
+            self.assertEqual([result["url"] for result in results], urls)
+            self.assertEqual([result["wiki_location"] for result in results],
+                             ["en.wikipedia.org/wiki/Satchel", "wikipedia.org/wiki/Satchel", None, "en.wikipedia.org/test_url_error"])
+            self.assertEqual(results[0]["toc"]["sections"][0]["href"], "https://en.wikipedia.org/wiki/Satchel#History")
+            self.assertFalse("html" in results[0]["toc"])
+            self.assertEqual([result["error"] for result in results], [
+                None,
+                "Could not get the table of contents for 'wikipedia.org/wiki/Satchel'",
+                "'Anything' is not a valid wikipedia url.",
+                "The url 'en.wikipedia.org/test_url_error' does not appear to be valid",
+            ])
+            if engine is not None:
+                engine.stop()
+
+    def test_wiki_toc_batch_parallelism(self):
+        import threading
+        from . import views
+        lock = threading.Lock()
+        running = [0]
+        most_running = [0]
+        def slow_page(url, etag=None, last_modified=None, fetcher=None):
+            with lock:
+                running[0] += 1
+                most_running[0] = max(most_running[0], running[0])
+            threading.Event().wait(0.05)
+            with lock:
+                running[0] -= 1
+            return get_dummy_page("en.wikipedia.org/wiki/Satchel")
+        views.open_page=slow_page
+        # Without a batch engine each page is fetched by a thread of its own, up to parallelism at a time
+        request = testing.DummyRequest(post={})
+        request.registry = self.config.registry
+        request.registry.settings = {"wiki_toc.batch.parallelism": "3"}
+        results = self.get_batch(request, ["https://en.wikipedia.org/wiki/Batch_%d" % index for index in range(9)])
+        self.assertEqual([result["index"] for result in results], range(9))
+        self.assertEqual([result["error"] for result in results], [None] * 9)
+        self.assertEqual(most_running[0], 3)
+
+    def test_wiki_toc_batch_invalid(self):
+        from . import views
+        from pyramid.httpexceptions import HTTPBadRequest, HTTPRequestEntityTooLarge
+        request = testing.DummyRequest(post={})
+        for body in ({"other": []}, "en.wikipedia.org/wiki/Satchel", [1, 2]):
+            request.json_body = body
+            self.assertRaises(HTTPBadRequest, views.wiki_toc_batch, request)
+        request.registry.settings = {"wiki_toc.batch.max_urls": "1"}
+        request.json_body = ["/wiki/Satchel", "/wiki/Satchel"]
+        self.assertRaises(HTTPRequestEntityTooLarge, views.wiki_toc_batch, request)
+
+class MetricsTests(unittest.TestCase):
+    def test_request_timer(self):
+        from .metrics import Metrics, RequestTimer
+        metrics = Metrics()
+        timer = RequestTimer(metrics)
+        with timer.stage("parse"):
+            chunks = list(timer.timed_chunks(["<html>", "<body>"]))
+        self.assertEqual(chunks, ["<html>", "<body>"])
+        self.assertEqual(timer.page_bytes, 12)
+        timer.finish("wiki_toc", 200)
+        self.assertEqual(sorted(timer.durations), ["parse", "read"])
+        self.assertEqual((metrics.stage_seconds.count("parse"), metrics.stage_seconds.count("read")), (1, 1))
+        self.assertEqual(metrics.request_seconds.count("wiki_toc"), 1)
+
+        # Stages recorded after the request finished, eg: by a worker which overran the deadline, are ignored
+        with timer.stage("fetch"):
+            pass
+        self.assertTrue("fetch" not in timer.durations)
+
+    def test_error_class(self):
+        import urllib2
+        from .engine import EngineTimeout
+        from .metrics import error_class
+        self.assertEqual(error_class(urllib2.HTTPError("url", 404, "Not Found", {}, None)), "http_error")
+        self.assertEqual(error_class(urllib2.URLError("url")), "url_error")
+        self.assertEqual(error_class(EngineTimeout()), "timeout")
+        self.assertEqual(error_class(ValueError()), "other")
+
+    def test_metrics_route(self):
+        import logging
+        from webtest import TestApp
+        from . import main, views
+        class Records(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.messages = []
+            def emit(self, record):
+                self.messages.append(record.getMessage())
+        records = Records()
+        logging.getLogger().addHandler(records)
+        try:
+            views.open_page=get_dummy_page
+            app = TestApp(main({}, **{"wiki_toc.engine.enabled": "false", "wiki_toc.metrics.slow_request_seconds": "0"}))
+            self.assertTrue('School bag' in app.get('/wiki_toc/en.wikipedia.org/wiki/Satchel').text)
+            app.get('/wiki_toc/test_url_error')
+            app.get('/wiki_toc_json/en.wikipedia.org/wiki/Other', status=502)
+        finally:
+            logging.getLogger().removeHandler(records)
+
+        response = app.get('/metrics')
+        self.assertEqual(response.content_type, "text/plain")
+        lines = response.text.splitlines()
+        # Only the Satchel page was read, parsed and rewritten; the others failed to be fetched
+        for stage, count in [("cache", 3), ("fetch", 3), ("read", 1), ("parse", 1), ("rewrite", 1), ("render", 3)]:
+            self.assertTrue('wiki_toc_stage_seconds_count{stage="%s"} %d' % (stage, count) in lines, stage)
+        self.assertTrue('wiki_toc_request_seconds_count{route="wiki_toc"} 2' in lines)
+        self.assertTrue('wiki_toc_request_seconds_bucket{route="wiki_toc",le="+Inf"} 2' in lines)
+        self.assertTrue('wiki_toc_page_bytes_count 1' in lines)
+        self.assertTrue('wiki_toc_errors_total{class="url_error"} 1' in lines)
+        self.assertTrue('wiki_toc_errors_total{class="other"} 1' in lines)
+        # Every request was slow enough to be logged with its stages
+        slow = [message for message in records.messages if message.startswith("Slow request to wiki_toc (status 200)")]
+        self.assertEqual(len(slow), 2)
+        self.assertTrue(" fetch=" in slow[0] and " render=" in slow[0])
+
+class ResponseCacheTests(unittest.TestCase):
+    def test_rendered_page(self):
+        import gzip
+        from StringIO import StringIO
+        from .responses import RenderedPage
+        page = RenderedPage("<html>" + "x" * 1000 + "</html>", "text/html; charset=UTF-8", time.time() + 60)
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(page.bodies["gzip"])).read(), page.bodies["identity"])
+        self.assertTrue(len(page.bodies["gzip"]) < 100)
+        self.assertEqual(page.etag_for("gzip"), page.etag[:-1] + '-gzip"')
+        for if_none_match in [page.etag, page.etag_for("gzip"), "W/" + page.etag, '"other", ' + page.etag_for("br"), "*"]:
+            self.assertTrue(page.matches(if_none_match), if_none_match)
+        for if_none_match in [None, '"other"', '"other-gzip"', page.etag[:-1] + '-deflate"']:
+            self.assertFalse(page.matches(if_none_match), if_none_match)
+
+    def test_lru_ttl(self):
+        from .responses import ResponseCache
+        cache = ResponseCache(ttl=60, max_entries=2)
+        cache.set("a", "A", "text/html")
+        cache.set("b", "B", "text/html")
+        cache.get("a")
+        cache.set("c", "C", "text/html")
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a").bodies["identity"], "A")
+        cache.set("a", "A", "text/html", ttl=-1)
+        self.assertEqual(cache.get("a"), None)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"], stats["entries"]), (2, 2, 1, 1))
+
+    def test_wiki_toc_route(self):
+        import gzip
+        from StringIO import StringIO
+        from webob import Request
+        from webtest import TestApp
+        from . import main, views
+        rendered = []
+        def counting_page(url, etag=None, last_modified=None, fetcher=None):
+            rendered.append(url)
+            return get_dummy_page(url, etag, last_modified)
+        views.open_page=counting_page
+        wsgi_app = main({}, **{"wiki_toc.engine.enabled": "false", "wiki_toc.cache.enabled": "false",
+                               "wiki_toc.responses.max_age": "120"})
+        app = TestApp(wsgi_app)
+
+        plain = app.get('/wiki_toc/en.wikipedia.org/wiki/Satchel')
+        self.assertTrue('School bag' in plain.text)
+        self.assertEqual((plain.headers["Cache-Control"], plain.headers["Vary"]), ("public, max-age=120", "Accept-Encoding"))
+        self.assertFalse("Content-Encoding" in plain.headers)
+        self.assertEqual(plain.content_type, "text/html")
+
+        # The page is served from the response cache without being fetched again, even though the toc cache is off
+        # WebTest decodes responses so the app is called directly to see the encoded body
+        compressed = Request.blank('/wiki_toc/en.wikipedia.org/wiki/Satchel',
+                                   headers={"Accept-Encoding": "gzip, deflate"}).get_response(wsgi_app)
+        self.assertEqual(compressed.headers["Content-Encoding"], "gzip")
+        self.assertEqual(compressed.headers["ETag"], plain.headers["ETag"][:-1] + '-gzip"')
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(compressed.body)).read(), plain.body)
+        self.assertEqual(len(rendered), 1)
+
+        # Conditional requests with either etag are not modified
+        for etag in (plain.headers["ETag"], compressed.headers["ETag"]):
+            response = app.get('/wiki_toc/en.wikipedia.org/wiki/Satchel', headers={"If-None-Match": etag}, status=304)
+            self.assertEqual((response.body, response.headers["ETag"]), ("", plain.headers["ETag"]))
+        self.assertEqual(len(rendered), 1)
+
+        # The page shows the location as it was typed so a location which only differs in case is rendered separately
+        response = app.get('/wiki_toc/EN.wikipedia.org/wiki/Satchel/', headers={"If-None-Match": plain.headers["ETag"]})
+        self.assertTrue("<title>EN.wikipedia.org/wiki/Satchel</title>" in response.text)
+        self.assertEqual(len(rendered), 2)
+
+        # Pages with errors are not cached
+        for _ in range(2):
+            response = app.get('/wiki_toc/test_url_error')
+            self.assertTrue('id="page-errors"' in response.text)
+            self.assertFalse("ETag" in response.headers)
+        self.assertEqual(len(rendered), 4)
+
+        stats = app.get('/cache_stats').json["responses"]
+        self.assertEqual((stats["hits"], stats["not_modified"], stats["entries"]), (3, 2, 1))
+
+class SingleFlightTests(unittest.TestCase):
+    def run_concurrently(self, flights, function, count):
+        """ Calls flights.do from count threads while the first call is blocked and returns the results and errors
+        """
+        import threading
+        release = threading.Event()
+        def blocked():
+            release.wait()
+            return function()
+        outcomes = []
+        def call():
+            try:
+                outcomes.append(("result", flights.do("key", blocked)))
+            except Exception, e:
+                outcomes.append(("error", e))
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        while flights.stats()["coalesced"] < count - 1:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_shared_result(self):
+        from .singleflight import SingleFlight
+        flights = SingleFlight()
+        calls = []
+        outcomes = self.run_concurrently(flights, lambda: calls.append(1) or "toc", 4)
+        self.assertEqual(outcomes, [("result", "toc")] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flights.stats(), dict(calls=1, coalesced=3, in_flight=0))
+
+    def test_shared_error(self):
+        from .singleflight import SingleFlight
+        flights = SingleFlight()
+        error = ValueError("failed")
+        def fail():
+            raise error
+        outcomes = self.run_concurrently(flights, fail, 3)
+        self.assertEqual(outcomes, [("error", error)] * 3)
+        # Later calls are not affected by the failure
+        self.assertEqual(flights.do("key", lambda: "toc"), "toc")
+
+    def test_submit(self):
+        import threading
+        from pyramid import testing
+        from . import views
+        from .cache import TocCache
+        from .engine import EngineTimeout, FetchEngine
+        from .singleflight import SingleFlight
+        engine = FetchEngine(workers=2, queue_size=2, timeout=0.05).start()
+        release = threading.Event()
+        fetched = []
+        def slow_page(url, etag=None, last_modified=None, fetcher=None):
+            fetched.append(url)
+            release.wait(5)
+            return get_dummy_page(url, etag, last_modified)
+        views.open_page=slow_page
+        config = testing.setUp()
+        try:
+            config.registry.toc_cache = TocCache(ttl=3600, max_entries=10)
+            config.registry.toc_flights = flights = SingleFlight()
+            # Requests which give up waiting do not end the flight, so later requests share the fetch in progress
+            for _ in range(3):
+                self.assertRaises(EngineTimeout, views.get_toc, config.registry, "en.wikipedia.org/wiki/Satchel", engine)
+            self.assertEqual((len(fetched), flights.stats()["coalesced"], engine.stats()["timed_out"]), (1, 2, 3))
+            release.set()
+            engine.timeout = 5
+            self.assertTrue(views.get_toc(config.registry, "en.wikipedia.org/wiki/Satchel", engine) is not None)
+            self.assertEqual(len(fetched), 1)
+        finally:
+            release.set()
+            engine.stop()
+            testing.tearDown()
+
+class EngineTests(unittest.TestCase):
+    def setUp(self):
+        from .engine import FetchEngine
+        self.engine = FetchEngine(workers=2, queue_size=2, timeout=1).start()
+
+    def tearDown(self):
+        self.engine.stop()
+
+    def test_call(self):
+        self.assertEqual(self.engine.call(lambda a, b: a + b, 1, 2), 3)
+        self.assertRaises(ZeroDivisionError, self.engine.call, lambda: 1 / 0)
+
+    def test_backpressure(self):
+        import threading
+        from .engine import EngineBusy
+        release = threading.Event()
+        running = [self.engine.submit(release.wait) for _ in range(2)]
+        while self.engine.stats()["busy_workers"] < 2:
+            threading.Event().wait(0.01)
+        queued = [self.engine.submit(release.wait) for _ in range(2)]
+        self.assertRaises(EngineBusy, self.engine.submit, release.wait)
+        self.assertEqual(self.engine.stats()["rejected"], 1)
+        release.set()
+        for job in running + queued:
+            self.assertEqual(job.wait(1), True)
+
+    def test_timeout(self):
+        import threading
+        from .engine import EngineTimeout
+        release = threading.Event()
+        self.engine.timeout = 0.05
+        self.assertRaises(EngineTimeout, self.engine.call, release.wait)
+        self.assertEqual(self.engine.stats()["timed_out"], 1)
+        release.set()
+
+    def test_cancelled(self):
+        import threading
+        from .engine import EngineTimeout
+        release = threading.Event()
+        try:
+            for _ in range(2):
+                self.engine.submit(release.wait)
+            while self.engine.stats()["busy_workers"] < 2:
+                threading.Event().wait(0.01)
+            calls = []
+            job = self.engine.submit(calls.append, 1)
+            self.assertRaises(EngineTimeout, job.wait, 0.01)
+        finally:
+            release.set()
+        self.engine.call(lambda: None)
+        # The job timed out before a worker started it so it was never run
+        self.assertEqual(calls, [])
+
+    def test_engine_from_settings(self):
+        from .engine import engine_from_settings
+        self.assertEqual(engine_from_settings({"wiki_toc.engine.enabled": "false"}), None)
+        engine = engine_from_settings({"wiki_toc.engine.workers": "3", "wiki_toc.engine.queue_size": "5"})
+        self.assertEqual((engine.stats()["workers"], engine.queue_size), (3, 5))
+        engine.stop()
+
+class ExtractorTests(unittest.TestCase):
+    # A page with content before and after the table of contents similar to a real wikipedia article
+    page_template = """<!DOCTYPE html>
+<html class="client-nojs" lang="en" dir="ltr">
+<head>
+<meta charset="UTF-8"/>
+<title>Satchel - Wikipedia</title>
+<script>document.documentElement.className="client-js";</script>
+</head>
+<body class="mediawiki">
+<div id="content" class="mw-body" role="main">
+<h1 id="firstHeading" class="firstHeading" lang="en">Satchel</h1>
+<div id="toc-like" class="toc"><!-- Not the table of contents --></div>
+<p>A <b>satchel</b> is a bag &amp; often has a <a href="/wiki/Strap" title="Strap">strap</a>.</p>
+%s
+<h2><span class="mw-headline" id="History">History</span></h2>
+<p>%s</p>
+</div>
+</body>
+</html>"""
+
+    def get_page(self, toc=True):
+        toc_html = get_dummy_page("en.wikipedia.org/wiki/Satchel").html if toc else ""
+        return self.page_template % (toc_html, "Lorem ipsum dolor sit amet. " * 2000)
+
+    # A table of contents with nested sections, entities and markup in the section text
+    nested_toc = """<div id="toc" class="toc">
+<div id="toctitle">
+<h2>Contents</h2>
+</div>
+<ul>
+<li class="toclevel-1 tocsection-1"><a href="#History"><span class="tocnumber">1</span> <span class="toctext">History</span></a>
+<ul>
+<li class="toclevel-2 tocsection-2"><a href="#Early_.26_late"><span class="tocnumber">1.1</span> <span class="toctext">Early &amp; late</span></a></li>
+<li class="toclevel-2 tocsection-3"><a href="/wiki/Bag#Modern"><span class="tocnumber">1.2</span> <span class="toctext">Modern</span></a></li>
+</ul>
+</li>
+<li class="toclevel-1 tocsection-4"><a href="#See_also"><span class="tocnumber">2</span> <span class="toctext">See <i>also</i></span></a></li>
+</ul>
+</div>"""
+
+    # A table of contents with the markup that wikipedia uses for the title and the toggle which hides the contents
+    wikipedia_toc = """<div id="toc" class="toc" role="navigation" aria-labelledby="mw-toc-heading"><input type="checkbox" role="button" id="toctogglecheckbox" class="toctogglecheckbox" style="display:none" /><div class="toctitle" lang="en" dir="ltr"><h2 id="mw-toc-heading">Contents</h2><span class="toctogglespan"><label class="toctogglelabel" for="toctogglecheckbox"></label></span></div>
+<ul>
+<li class="toclevel-1 tocsection-1"><a href="#History"><span class="tocnumber">1</span> <span class="toctext">History</span></a></li>
+<li class="toclevel-1 tocsection-2"><a href="#Caf.C3.A9s"><span class="tocnumber">2</span> <span class="toctext">Coffeehouses  in <i>Europe</i></span></a>
+<ul>
+<li class="toclevel-2 tocsection-3"><a href="#Caf.C3.A9s_.E2.80.93_.22Paris.22_.26_.3CVienna.3E"><span class="tocnumber">2.1</span> <span class="toctext">Caf&#233;s &ndash; &quot;Paris&quot; &amp; &lt;Vienna&gt;</span></a></li>
+<!-- section 2.2 has been removed -->
+<li class="toclevel-2  tocsection-4"><a href="/wiki/Coffee#Culture" title="Coffee"><span class="tocnumber">2.2</span> <span class="toctext"><span>Culture</span><br>of <b>coffee</b></span></a></li>
+</ul>
+</li>
+</ul>
+</div>"""
+
+    def soup_toc(self, html, url):
+        """ Extracts the table of contents by parsing the whole page. This is how it was originally done.
+        """
+        from urlparse import urlparse
+        from bs4 import BeautifulSoup
+        from .views import UrlManager
+        toc = BeautifulSoup(html, 'lxml').find_all('div', id="toc", limit=1)[0]
+        for a in toc.find_all('a'):
+            url_manager = UrlManager(a["href"])
+            if url_manager.url_is_relative():
+                a["href"] = url_manager.absolute_url(urlparse(url))
+            a["target"] = "_NEW"
+        return unicode(toc)
+
+    def streamed_toc(self, html, url, chunk_size):
+        """ Extracts the table of contents in the same way as the views
+        """
+        from . import views
+        from .fetcher import FetchedPage
+        class ChunkedPage(FetchedPage):
+            def iter_chunks(self, size=None):
+                return FetchedPage.iter_chunks(self, chunk_size)
+        views.open_page = lambda url, etag=None, last_modified=None, fetcher=None: ChunkedPage(html)
+        return views.load_toc(url, "key")
+
+    def test_identical_to_soup(self):
+        from .extractor import render_toc_html
+        url = "https://en.wikipedia.org/wiki/Satchel"
+        satchel = get_dummy_page("en.wikipedia.org/wiki/Satchel").html
+        for html in (satchel, self.get_page()):
+            for chunk_size in (1, 7, 64 * 1024):
+                toc = self.streamed_toc(html, url, chunk_size)
+                self.assertEqual(render_toc_html(toc), self.soup_toc(html, url))
+
+    def test_tree(self):
+        from .extractor import render_toc_html
+        url = "https://en.wikipedia.org/wiki/Satchel"
+        toc = self.streamed_toc(self.nested_toc, url, 16)
+        self.assertEqual(toc["title"], "Contents")
+        self.assertEqual([(section["level"], section["number"], section["text"], section["anchor"], section["href"])
+                          for section in toc["sections"]],
+                         [(1, "1", "History", "History", "https://en.wikipedia.org/wiki/Satchel#History"),
+                          (1, "2", "See also", "See_also", "https://en.wikipedia.org/wiki/Satchel#See_also")])
+        self.assertEqual(toc["sections"][0]["children"], [
+            dict(level=2, section="2", number="1.1", text="Early & late", anchor="Early_.26_late",
+                 href="https://en.wikipedia.org/wiki/Satchel#Early_.26_late", children=[]),
+            dict(level=2, section="3", number="1.2", text="Modern", anchor="Modern",
+                 href="https://en.wikipedia.org/wiki/Bag#Modern", children=[]),
+        ])
+        # The markup within the text of a section is kept when rendering
+        self.assertEqual(render_toc_html(toc), self.soup_toc(self.nested_toc, url))
+        # Trees without the markup of the page, eg: those cached before it was kept, are rendered from the tree alone
+        del toc["html"]
+        self.assertEqual(render_toc_html(toc), self.soup_toc(self.nested_toc, url).replace("<i>also</i>", "also"))
+
+    def test_identical_to_soup_wikipedia_markup(self):
+        from .extractor import render_toc_html
+        url = "https://en.wikipedia.org/wiki/Caf%C3%A9"
+        html = self.page_template % (self.wikipedia_toc, "Lorem ipsum dolor sit amet. " * 200)
+        for chunk_size in (1, 7, 64 * 1024):
+            toc = self.streamed_toc(html, url, chunk_size)
+            self.assertEqual(toc["sections"][1]["children"][0]["text"], u"Caf\xe9s \u2013 \"Paris\" & <Vienna>")
+            self.assertEqual(render_toc_html(toc), self.soup_toc(html, url))
+
+    def test_identical_to_soup_other_links(self):
+        from .extractor import render_toc_html
+        url = "https://en.wikipedia.org/wiki/Satchel"
+        # Links which do not belong to a section are made absolute and kept, and li elements which are not closed are
+        # closed by the next li or the end of their list, as lxml does
+        toc_html = """<div id="toc" class="toc"><div id="toctitle"><h2>Contents</h2> <a href="/wiki/Help:TOC">help</a></div>
+<ul>
+<li class="toclevel-1 tocsection-1"><a href="#History"><span class="tocnumber">1</span> <span class="toctext">History</span></a> <a href="#Notes">notes</a>
+<ul>
+<li class="toclevel-2 tocsection-2"><a href="#Early"><span class="tocnumber">1.1</span> <span class="toctext">Early</span></a>
+<li class="toclevel-2 tocsection-3"><a href="#Late"><span class="tocnumber">1.2</span> <span class="toctext">Late</span></a>
+</ul>
+<li class="toclevel-1 tocsection-4"><a href="https://example.com/Bag"><span class="tocnumber">2</span> <span class="toctext">Bags</span></a>
+</ul>
+</div>"""
+        html = self.page_template % (toc_html, "Lorem ipsum dolor sit amet. " * 200)
+        for chunk_size in (1, 7, 64 * 1024):
+            toc = self.streamed_toc(html, url, chunk_size)
+            self.assertEqual([(section["number"], [child["number"] for child in section["children"]])
+                              for section in toc["sections"]], [("1", ["1.1", "1.2"]), ("2", [])])
+            rendered = render_toc_html(toc)
+            self.assertEqual(rendered, self.soup_toc(html, url))
+            self.assertTrue('<a href="https://en.wikipedia.org/wiki/Help:TOC" target="_NEW">help</a>' in rendered)
+
+    def test_stops_after_toc(self):
+        from .extractor import extract_toc
+        from .fetcher import FetchedPage
+        html = self.get_page()
+        chunks = FetchedPage(html).iter_chunks(1024)
+        self.assertTrue(extract_toc(chunks))
+        # The remaining chunks, which include the body of the article, were not read
+        self.assertTrue(len("".join(chunks)) > len(html) / 2)
+
+    def test_no_toc(self):
+        from .extractor import extract_toc
+        from .fetcher import FetchedPage
+        self.assertEqual(extract_toc(FetchedPage(self.get_page(toc=False)).iter_chunks(1024)), None)
+        self.assertEqual(extract_toc([]), None)
+
+    def test_encoding(self):
+        from .extractor import extract_toc
+        html = get_dummy_page("en.wikipedia.org/wiki/Satchel").html.replace("History", u"Histoire \u00e9t\u00e9".encode("latin-1"))
+        toc = extract_toc([html], "latin-1")
+        self.assertEqual(toc["sections"][0]["text"], u"Histoire \u00e9t\u00e9")
+        # Unknown encodings fall back to utf-8
+        self.assertTrue(extract_toc([get_dummy_page("en.wikipedia.org/wiki/Satchel").html], "unknown"))
+
+class CacheTests(unittest.TestCase):
+    def test_normalize_key(self):
+        from .cache import normalize_key
+        self.assertEqual(normalize_key("/EN.Wikipedia.org/wiki/Satchel/"), "en.wikipedia.org/wiki/Satchel")
+        self.assertEqual(normalize_key("en.wikipedia.org"), "en.wikipedia.org")
+
+    def test_ttl(self):
+        from .cache import TocCache
+        cache = TocCache(ttl=60, max_entries=10)
+        cache.set("a", u"toc")
+        self.assertEqual(cache.get("a"), u"toc")
+        cache.set("b", u"toc", ttl=-1)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_lru_eviction(self):
+        from .cache import TocCache
+        cache = TocCache(ttl=60, max_entries=2)
+        cache.set("a", u"1")
+        cache.set("b", u"2")
+        cache.get("a")          # "b" is now the least recently used entry
+        cache.set("c", u"3")
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), u"1")
+        self.assertEqual(cache.get("c"), u"3")
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_sqlite_backend(self):
+        import os
+        import shutil
+        import tempfile
+        from .cache import CacheEntry, TocCache, SqliteCacheBackend
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "cache.sqlite")
+            writer = TocCache(ttl=60, max_entries=10, backend=SqliteCacheBackend(path, max_entries=2))
+            reader = TocCache(ttl=60, max_entries=10, backend=SqliteCacheBackend(path, max_entries=2))
+            writer.set("a", u"1")
+            # Another worker sees the entry through the shared backend
+            self.assertEqual(reader.get("a"), u"1")
+            writer.set("b", u"2")
+            writer.set("c", u"3")
+            self.assertEqual(writer.stats()["evictions"], 1)
+            self.assertEqual(reader.get("c"), u"3")
+
+            # Once there are more than max_entries, the least recently accessed are evicted down to the low water mark
+            backend = SqliteCacheBackend(os.path.join(directory, "batch.sqlite"), max_entries=10, low_water=0.5)
+            evicted = [backend.set("key_%d" % index, CacheEntry(index, time.time() + 60)) for index in range(12)]
+            self.assertEqual(evicted, [0] * 10 + [6, 0])
+            self.assertEqual(backend.get("key_5"), None)
+            self.assertEqual(backend.get("key_6").value, 6)
+
+            # Reads only record an access once the last one is more than touch_interval seconds old
+            def accessed(key):
+                return backend._connection().execute("SELECT accessed FROM toc_cache WHERE key = ?", (key,)).fetchone()[0]
+            with backend._connection() as connection:
+                connection.execute("UPDATE toc_cache SET accessed = ? WHERE key = ?", (time.time() - 30, "key_7"))
+            before = accessed("key_7")
+            backend.get("key_7")
+            self.assertEqual(accessed("key_7"), before)
+            with backend._connection() as connection:
+                connection.execute("UPDATE toc_cache SET accessed = ? WHERE key = ?", (time.time() - 120, "key_7"))
+            backend.get("key_7")
+            self.assertTrue(accessed("key_7") > time.time() - 5)
+
+            # Validators are shared and revalidating a stale entry makes it fresh for every worker
+            writer.set("d", u"4", ttl=-1, etag='"d"', last_modified="Sat, 01 Jan 2000 00:00:00 GMT")
+            entry = reader.get_entry("d")
+            self.assertFalse(entry.is_fresh())
+            self.assertEqual((entry.value, entry.etag, entry.last_modified), (u"4", '"d"', "Sat, 01 Jan 2000 00:00:00 GMT"))
+            self.assertEqual(reader.revalidated("d"), u"4")
+            self.assertEqual(writer.get("d"), u"4")
+
+            # Values stored in an older form are discarded
+            import sqlite3
+            connection = sqlite3.connect(path)
+            connection.execute("PRAGMA user_version = 1")
+            connection.close()
+            self.assertEqual(TocCache(backend=SqliteCacheBackend(path)).get("d"), None)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_cache_from_settings(self):
+        from .cache import cache_from_settings
+        self.assertEqual(cache_from_settings({"wiki_toc.cache.enabled": "false"}), None)
+        cache = cache_from_settings({"wiki_toc.cache.ttl": "30", "wiki_toc.cache.max_entries": "5"})
+        self.assertEqual((cache.ttl, cache.max_entries, cache.backend), (30, 5, None))
+        self.assertRaises(ValueError, cache_from_settings, {"wiki_toc.cache.backend": "other"})
+
 class UrlManagerTests(unittest.TestCase):
     def test_init(self):
         from .views import UrlManager
@@ -198,4 +1106,733 @@ class UrlManagerTests(unittest.TestCase):
         um = UrlManager("#test")
         self.assertEqual(um.absolute_url(reference_url), "https://www.google.com/path/index.htm?query=1#test", "absolute_url should duplicate the full url for relative anchor tags")
 
+    def test_normalize(self):
+        from .views import UrlManager, get_wiki_location
+        self.assertEqual(UrlManager.normalize("https://EN.wikipedia.org/wiki/Satchel/"),
+                         ("EN.wikipedia.org/wiki/Satchel", "en.wikipedia.org/wiki/Satchel"))
+        self.assertEqual(UrlManager.normalize("https://www.google.com/"), None)
+        self.assertEqual(get_wiki_location("/wiki/Satchel"), "wikipedia.org/wiki/Satchel")
+        # Results are memoized
+        self.assertEqual(UrlManager._normalized["/wiki/Satchel"], ("wikipedia.org/wiki/Satchel", "wikipedia.org/wiki/Satchel"))
+
+    def test_href_rewriter(self):
+        """ The fast path for fragments must give exactly the same results as UrlManager
+        """
+        from .views import HrefRewriter, UrlManager
+        from urlparse import urlparse
+        for url in ["https://en.wikipedia.org/wiki/Satchel", "https://en.wikipedia.org/wiki/Satchel?action=view#top",
+                    "https://en.wikipedia.org/wiki/Satchel;params?q=1", "https://en.wikipedia.org"]:
+            rewriter = HrefRewriter(url)
+            for href in [u"#History", u"#", u"#a#b", u"#Caf%C3%A9", u"#S\xe9ance", u"/wiki/Handbag", u"/wiki/Handbag#Bags",
+                         u"?action=edit", u"//de.wikipedia.org/wiki/Tasche#History", u"https://example.com/x#y"]:
+                url_manager = UrlManager(href)
+                expected_href = url_manager.absolute_url(urlparse(url)) if url_manager.url_is_relative() else href
+                expected = (url_manager.to_list()[5] or None, expected_href)
+                self.assertEqual(rewriter.rewrite(href), expected)
+                self.assertEqual(type(rewriter.rewrite(href)[1]), type(expected[1]))
+
+
+
+class StandInWikipedia(object):
+    """ A local http server which stands in for wikipedia
+        Paths are served as follows:
+            /wiki/Satchel  - the Satchel page, gzip encoded when requested, with an etag honoured by If-None-Match
+            /slow          - waits longer than any test read timeout before responding
+            /large         - a body of 1MB
+            /redirect      - redirects to /wiki/Satchel
+            /wiki/Caf%C3%A9 - a body of 'Caf\xc3\xa9'
+            anything else  - 404
+    """
+
+    def __init__(self):
+        import threading
+        import BaseHTTPServer
+        import SocketServer
+
+        stand_in = self
+        self.requests = []
+        self.connections = set()
+        self.satchel = get_dummy_page("en.wikipedia.org/wiki/Satchel")
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"       # Keep connections alive
+
+            def log_message(self, *args):
+                pass
+
+            def send_body(self, status, body, headers=()):
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                import gzip
+                import time
+                from StringIO import StringIO
+                stand_in.requests.append((self.path, dict(self.headers)))
+                stand_in.connections.add(self.client_address)
+                if self.path == "/wiki/Satchel":
+                    if self.headers.get("If-None-Match") == stand_in.satchel.etag:
+                        return self.send_body(304, "", [("ETag", stand_in.satchel.etag)])
+                    headers = [("ETag", stand_in.satchel.etag), ("Last-Modified", stand_in.satchel.last_modified)]
+                    body = stand_in.satchel.html
+                    if "gzip" in self.headers.get("Accept-Encoding", ""):
+                        compressed = StringIO()
+                        with gzip.GzipFile(fileobj=compressed, mode="wb") as f:
+                            f.write(body)
+                        body = compressed.getvalue()
+                        headers.append(("Content-Encoding", "gzip"))
+                    return self.send_body(200, body, headers)
+                if self.path == "/slow":
+                    time.sleep(1)
+                    return self.send_body(200, "slow")
+                if self.path == "/large":
+                    return self.send_body(200, "x" * 1024 * 1024)
+                if self.path == "/wiki/Caf%C3%A9":
+                    return self.send_body(200, "Caf\xc3\xa9")
+                if self.path == "/redirect":
+                    return self.send_body(301, "", [("Location", "/wiki/Satchel")])
+                return self.send_body(404, "Not found")
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                # Clients abandoning connections (eg: after a timeout) is expected
+                pass
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class FetcherTests(unittest.TestCase):
+    def setUp(self):
+        from .fetcher import HttpFetcher
+        self.wikipedia = StandInWikipedia()
+        self.fetcher = HttpFetcher(pool_size=2, connect_timeout=1, read_timeout=0.5, max_body_size=512 * 1024)
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.wikipedia.stop()
+
+    def test_fetch_gzip(self):
+        page = self.fetcher.fetch(self.wikipedia.url + "/wiki/Satchel")
+        self.assertEqual(page.html, self.wikipedia.satchel.html)
+        self.assertEqual(page.etag, self.wikipedia.satchel.etag)
+        self.assertEqual(page.last_modified, self.wikipedia.satchel.last_modified)
+        self.assertEqual(self.wikipedia.requests[0][1]["accept-encoding"], "gzip")
+
+    def test_keep_alive(self):
+        for _ in range(3):
+            self.fetcher.fetch(self.wikipedia.url + "/wiki/Satchel")
+        self.assertEqual(len(self.wikipedia.connections), 1)
+        self.assertEqual(self.fetcher.stats()["connections_opened"], 1)
+        self.assertEqual(self.fetcher.stats()["connections_reused"], 2)
+
+    def test_not_modified(self):
+        from .fetcher import NotModified
+        self.assertRaises(NotModified, self.fetcher.fetch, self.wikipedia.url + "/wiki/Satchel", self.wikipedia.satchel.etag)
+        # The connection is still usable after a 304
+        self.assertEqual(self.fetcher.fetch(self.wikipedia.url + "/wiki/Satchel").html, self.wikipedia.satchel.html)
+
+    def test_redirect(self):
+        page = self.fetcher.fetch(self.wikipedia.url + "/redirect")
+        self.assertEqual(page.html, self.wikipedia.satchel.html)
+
+    def test_errors(self):
+        from urllib2 import HTTPError, URLError
+        from .fetcher import ResponseTooLarge
+        try:
+            self.fetcher.fetch(self.wikipedia.url + "/missing")
+            self.fail("HTTPError was not raised")
+        except HTTPError, e:
+            self.assertEqual(e.code, 404)
+        self.assertEqual(self.fetcher.stats()["idle_connections"], 1)
+        self.assertRaises(URLError, self.fetcher.fetch, self.wikipedia.url + "/slow")
+        self.assertRaises(ResponseTooLarge, self.fetcher.fetch, self.wikipedia.url + "/large")
+        # Connections that were abandoned are not returned to the pool
+        self.assertEqual(self.fetcher.stats()["idle_connections"], 0)
+
+    def test_non_ascii_path(self):
+        for path in [u"/wiki/Caf\xe9", "/wiki/Caf\xc3\xa9", "/wiki/Caf%C3%A9"]:
+            self.assertEqual(self.fetcher.fetch(self.wikipedia.url + path).html, "Caf\xc3\xa9")
+        self.assertEqual([path for path, headers in self.wikipedia.requests], ["/wiki/Caf%C3%A9"] * 3)
+
+    def test_guard(self):
+        from urllib2 import HTTPError
+        from .fetcher import HttpFetcher, InvalidRequest
+        from .upstream import UpstreamGuard
+        fetcher = HttpFetcher(guard=UpstreamGuard(failure_threshold=1))
+        try:
+            # Urls which cannot be requested are not failures of the host
+            self.assertRaises(InvalidRequest, fetcher.fetch, "ftp://127.0.0.1/wiki/Satchel")
+            self.assertEqual(fetcher.fetch(self.wikipedia.url + u"/wiki/Caf\xe9").html, "Caf\xc3\xa9")
+            self.assertEqual(fetcher.guard.stats()["hosts"]["127.0.0.1"]["state"], "closed")
+            self.assertRaises(HTTPError, fetcher.fetch, self.wikipedia.url + "/missing")
+            self.assertEqual(fetcher.guard.stats()["hosts"]["127.0.0.1"]["state"], "closed")
+        finally:
+            fetcher.close()
+
+    def test_guard_trial_released(self):
+        import threading
+        from .fetcher import HttpFetcher, InvalidRequest
+        from .upstream import UpstreamGuard
+        fetcher = HttpFetcher(guard=UpstreamGuard(failure_threshold=1, reset_timeout=0.05))
+        request = fetcher._request
+        def failing_request(url, headers):
+            raise ValueError("not a failure of the host")
+        try:
+            fetcher.guard.acquire("127.0.0.1")
+            fetcher.guard.record("127.0.0.1", 0.1, True)
+            threading.Event().wait(0.1)
+            # Urls with an invalid port are rejected before a trial request is allowed
+            self.assertRaises(InvalidRequest, fetcher.fetch, "http://127.0.0.1:abc/wiki/Satchel")
+            # Other errors from the trial request let another request be the trial
+            fetcher._request = failing_request
+            self.assertRaises(ValueError, fetcher.fetch, self.wikipedia.url + "/wiki/Satchel")
+            self.assertEqual(fetcher.guard.stats()["hosts"]["127.0.0.1"]["state"], "half_open")
+            fetcher._request = request
+            self.assertEqual(fetcher.fetch(self.wikipedia.url + "/wiki/Satchel").html, self.wikipedia.satchel.html)
+            self.assertEqual(fetcher.guard.stats()["hosts"]["127.0.0.1"]["state"], "closed")
+        finally:
+            fetcher.close()
+
+    def test_upstream(self):
+        from .fetcher import HttpFetcher
+        fetcher = HttpFetcher(upstream=self.wikipedia.url)
+        try:
+            page = fetcher.fetch("https://en.wikipedia.org/wiki/Satchel")
+        finally:
+            fetcher.close()
+        self.assertEqual(page.html, self.wikipedia.satchel.html)
+        path, headers = self.wikipedia.requests[-1]
+        self.assertEqual((path, headers["host"]), ("/wiki/Satchel", "en.wikipedia.org"))
+
+    def test_fetcher_from_settings(self):
+        from .fetcher import fetcher_from_settings
+        fetcher = fetcher_from_settings({"wiki_toc.fetch.pool_size": "3", "wiki_toc.fetch.read_timeout": "2.5"})
+        self.assertEqual((fetcher.pool_size, fetcher.read_timeout), (3, 2.5))
+
+class UpstreamTests(unittest.TestCase):
+    def test_parse_retry_after(self):
+        from .upstream import parse_retry_after
+        self.assertEqual(parse_retry_after("120"), 120.0)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT", now=1445412420.0), 60.0)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT", now=1445412600.0), 0.0)
+        self.assertEqual(parse_retry_after("soon"), None)
+        self.assertEqual(parse_retry_after(None), None)
+
+    def test_token_bucket(self):
+        from .upstream import TokenBucket
+        bucket = TokenBucket(rate=2.0, burst=3, now=100.0)
+        self.assertEqual([bucket.take(now=100.0) for _ in range(3)], [0.0, 0.0, 0.0])
+        self.assertEqual(bucket.take(now=100.0), 0.5)
+        # Tokens are added at rate a second, up to burst
+        self.assertEqual(bucket.take(now=100.5), 0.0)
+        self.assertEqual(bucket.take(now=110.0), 0.0)
+        self.assertEqual(bucket.tokens, 2.0)
+
+    def test_circuit_breaker(self):
+        from .upstream import CircuitBreaker
+        breaker = CircuitBreaker(failure_threshold=2, slow_seconds=5.0, reset_timeout=30.0)
+        breaker.record(0.1, True, now=100.0)
+        breaker.record(0.1, False, now=100.0)
+        breaker.record(0.1, True, now=100.0)
+        self.assertEqual((breaker.state, breaker.allow(now=100.0)), ("closed", 0.0))
+        # Slow responses are failures
+        breaker.record(6.0, False, now=100.0)
+        self.assertEqual((breaker.state, breaker.allow(now=100.0), breaker.trips), ("open", 30.0, 1))
+
+        # After reset_timeout a single trial request is allowed
+        self.assertEqual(breaker.allow(now=130.0), 0.0)
+        self.assertEqual(breaker.state, "half_open")
+        self.assertTrue(breaker.allow(now=130.0) > 0)
+        breaker.record(0.1, True, now=130.5)
+        self.assertEqual((breaker.state, breaker.allow(now=131.0), breaker.trips), ("open", 29.5, 2))
+        self.assertEqual(breaker.allow(now=161.0), 0.0)
+        breaker.record(0.1, False, now=161.0)
+        self.assertEqual((breaker.state, breaker.failures, breaker.allow(now=161.0)), ("closed", 0, 0.0))
+
+        # The breaker opens for as long as the host asks in Retry-After
+        breaker.record(0.1, True, retry_after=120.0, now=200.0)
+        self.assertEqual((breaker.state, breaker.allow(now=300.0)), ("open", 20.0))
+
+    def test_guard(self):
+        from .upstream import UpstreamGuard, UpstreamUnavailable
+        guard = UpstreamGuard(rate=0.001, burst=2, failure_threshold=1, max_retry_after=60.0)
+        guard.acquire("en.wikipedia.org")
+        guard.acquire("en.wikipedia.org")
+        self.assertRaises(UpstreamUnavailable, guard.acquire, "en.wikipedia.org")
+        # Each host has its own limit and breaker
+        guard.acquire("de.wikipedia.org")
+        guard.record("de.wikipedia.org", 0.1, True, retry_after=3600.0)
+        try:
+            guard.acquire("de.wikipedia.org")
+            self.fail("UpstreamUnavailable was not raised")
+        except UpstreamUnavailable, e:
+            self.assertEqual(e.host, "de.wikipedia.org")
+            self.assertTrue(55 < e.retry_after <= 60)
+        stats = guard.stats()
+        self.assertEqual((stats["rate_limited"], stats["short_circuited"]), (1, 1))
+        self.assertEqual(stats["hosts"]["de.wikipedia.org"], dict(state="open", failures=1, trips=1))
+
+    def test_guard_from_settings(self):
+        from .upstream import guard_from_settings
+        guard = guard_from_settings({"wiki_toc.upstream.rate": "2.5", "wiki_toc.upstream.failure_threshold": "3"})
+        self.assertEqual((guard.rate, guard.failure_threshold), (2.5, 3))
+        self.assertEqual(guard_from_settings({"wiki_toc.upstream.enabled": "false"}), None)
+
+    def test_fault_injection(self):
+        from webtest import TestApp
+        from . import views
+        from .benchmarks.corpus import CorpusServer, generate_corpus
+        from .benchmarks.load import app_settings, close_app, make_app
+        # Pages are fetched from the stand-in server rather than bypassing the fetcher as in ViewTests
+        views.open_page=open_page
+        server = CorpusServer(generate_corpus(pages=2, sections=3, payload_size=2000)).start()
+        app = make_app(app_settings(server.url, cache=True, **{"wiki_toc.upstream.failure_threshold": "2",
+                                                               "wiki_toc.cache.ttl": "-1"}))
+        try:
+            test_app = TestApp(app)
+            # A table of contents is cached before wikipedia starts failing
+            self.assertFalse('id="page-errors"' in test_app.get("/wiki_toc/en.wikipedia.org/wiki/Article_1").text)
+            server.error_rate, server.error_status = 1.0, 500
+            for _ in range(2):
+                self.assertTrue('id="page-errors"' in test_app.get("/wiki_toc/en.wikipedia.org/wiki/Article_0").text)
+            requests = server.requests
+
+            # The breaker is open so requests fail fast without being sent to wikipedia...
+            response = test_app.get("/wiki_toc/en.wikipedia.org/wiki/Article_0", status=503)
+            self.assertEqual(response.headers["Retry-After"], "30")
+            test_app.get("/wiki_toc_json/en.wikipedia.org/wiki/Article_0", status=503)
+            # ...except for those that can be served from the cache
+            self.assertFalse('id="page-errors"' in test_app.get("/wiki_toc/en.wikipedia.org/wiki/Article_1").text)
+            self.assertEqual(server.requests, requests)
+            self.assertEqual(test_app.get("/cache_stats").json["upstream"]["hosts"]["en.wikipedia.org"]["state"], "open")
+
+            # A 503 with Retry-After opens the breaker for as long as it asks
+            app.registry.fetcher.guard.record("en.wikipedia.org", 0.1, False)
+            server.error_status, server.retry_after = 503, 120
+            test_app.get("/wiki_toc/en.wikipedia.org/wiki/Article_0")
+            response = test_app.get("/wiki_toc/en.wikipedia.org/wiki/Article_0", status=503)
+            self.assertTrue(115 < int(response.headers["Retry-After"]) <= 120)
+        finally:
+            close_app(app)
+            server.stop()
+
+class WarmupTests(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.config = testing.setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        testing.tearDown()
+        shutil.rmtree(self.directory)
+
+    def test_popularity(self):
+        import os
+        from .warmup import Popularity
+        popularity = Popularity(half_life=100.0, now=1000.0)
+        for _ in range(3):
+            popularity.record("en.wikipedia.org/wiki/Satchel", now=1000.0)
+        popularity.record("EN.wikipedia.org/wiki/Handbag/", now=1000.0)
+        popularity.record("en.wikipedia.org/wiki/Backpack", now=1200.0)
+        # A request 2 half lives later is worth 4 of the earlier ones
+        self.assertEqual(popularity.most_requested(2, now=1200.0),
+                         [("en.wikipedia.org/wiki/Backpack", 1.0), ("en.wikipedia.org/wiki/Satchel", 0.75)])
+        self.assertEqual(popularity.stats(), dict(requests=5, locations=3))
+
+        popularity = Popularity(half_life=100.0)
+        for index, wiki_location in enumerate(["en.wikipedia.org/wiki/Handbag", "en.wikipedia.org/wiki/Satchel",
+                                               "en.wikipedia.org/wiki/Backpack"]):
+            for _ in range(index + 1):
+                popularity.record(wiki_location)
+        path = os.path.join(self.directory, "popularity.json")
+        popularity.save(path)
+        loaded = Popularity(half_life=100.0)
+        self.assertEqual(loaded.load(path), 3)
+        self.assertEqual([key for key, score in loaded.most_requested(3)],
+                         [key for key, score in popularity.most_requested(3)])
+        self.assertEqual(loaded.stats()["requests"], 0)
+        self.assertEqual(Popularity().load(os.path.join(self.directory, "missing.json")), 0)
+
+        # The least requested are forgotten when there are more than max_entries
+        popularity = Popularity(max_entries=4)
+        for index in range(5):
+            for _ in range(index + 1):
+                popularity.record("en.wikipedia.org/wiki/Page_%d" % index)
+        self.assertEqual(sorted(key for key, score in popularity.most_requested(5)),
+                         ["en.wikipedia.org/wiki/Page_%d" % index for index in (2, 3, 4)])
+
+    def test_read_access_log(self):
+        from .warmup import read_access_log
+        lines = ['127.0.0.1 - - [18/Oct/2026:10:00:00 +0000] "GET /wiki_toc/en.wikipedia.org/wiki/Satchel HTTP/1.1" 200 2048',
+                 '127.0.0.1 - - [18/Oct/2026:10:00:01 +0000] "GET /wiki_toc_json/de.wikipedia.org/wiki/Caf%C3%A9?x=1 HTTP/1.1" 200 512',
+                 '127.0.0.1 - - [18/Oct/2026:10:00:02 +0000] "GET /static/style.css HTTP/1.1" 200 100',
+                 '127.0.0.1 - - [18/Oct/2026:10:00:03 +0000] "HEAD /wiki_toc_json/de.wikipedia.org/wiki/Caf%C3%A9 HTTP/1.1" 200 0']
+        self.assertEqual(read_access_log(lines), ["de.wikipedia.org/wiki/Caf\xc3\xa9", "en.wikipedia.org/wiki/Satchel"])
+
+    def test_warm_up(self):
+        import threading
+        from . import views
+        from .cache import TocCache
+        from .upstream import UpstreamUnavailable
+        from .warmup import warm_up
+        registry = self.config.registry
+        registry.toc_cache = TocCache(ttl=3600, max_entries=10)
+        views.open_page=get_dummy_page
+        locations = ["en.wikipedia.org/wiki/Satchel", "test_url_error", "en.wikipedia.org/wiki/Other"]
+        self.assertEqual(warm_up(registry, locations, concurrency=2)["fetched"], 1)
+        self.assertTrue(registry.toc_cache.get_entry("en.wikipedia.org/wiki/Satchel", count=False).is_fresh())
+        # The warm-up does not count as hits or misses
+        self.assertEqual((registry.toc_cache.hits, registry.toc_cache.misses), (0, 0))
+
+        # Cached pages are skipped, unless they expire within lead_time, and errors which are cached negatively are not
+        # fetched again
+        stats = warm_up(registry, locations, concurrency=2)
+        self.assertEqual((stats["fetched"], stats["skipped"], stats["failed"]), (0, 2, 1))
+        self.assertEqual(warm_up(registry, locations[:1], lead_time=7200)["fetched"], 1)
+
+        # No more pages are started after the budget
+        release = threading.Event()
+        def slow_page(url, etag=None, last_modified=None, fetcher=None):
+            release.wait(5)
+            return get_dummy_page(url, etag, last_modified)
+        views.open_page=slow_page
+        try:
+            registry.toc_cache.clear()
+            stats = warm_up(registry, ["en.wikipedia.org/wiki/Page_%d" % index for index in range(5)], concurrency=2,
+                            budget=0.2)
+            self.assertEqual((stats["fetched"], stats["remaining"]), (0, 3))
+        finally:
+            release.set()
+
+        # Nothing more is fetched once wikipedia is not being sent requests
+        def suspended_page(url, etag=None, last_modified=None, fetcher=None):
+            raise UpstreamUnavailable("en.wikipedia.org", 30, "the circuit breaker is open")
+        views.open_page=suspended_page
+        stats = warm_up(registry, ["en.wikipedia.org/wiki/Article_%d" % index for index in range(5)], concurrency=1)
+        self.assertEqual((stats["failed"], stats["remaining"]), (1, 4))
+
+    def test_warm_up_rate_limit(self):
+        from . import views
+        from .cache import TocCache
+        from .fetcher import HttpFetcher
+        from .upstream import UpstreamGuard
+        from .warmup import warm_up
+        registry = self.config.registry
+        registry.toc_cache = TocCache(ttl=3600, max_entries=20)
+        registry.fetcher = HttpFetcher(guard=UpstreamGuard(rate=50, burst=10))
+        tokens = []
+        def guarded_page(url, etag=None, last_modified=None, fetcher=None):
+            fetcher.guard.acquire("en.wikipedia.org")
+            tokens.append(fetcher.guard._hosts["en.wikipedia.org"][0].tokens)
+            return get_dummy_page("https://en.wikipedia.org/wiki/Satchel")
+        views.open_page=guarded_page
+        # The warm-up waits rather than taking more than its share of the burst
+        stats = warm_up(registry, ["en.wikipedia.org/wiki/Rate_%d" % index for index in range(10)], concurrency=1,
+                        budget=5, rate_share=0.3)
+        self.assertEqual((stats["fetched"], stats["remaining"]), (10, 0))
+        self.assertTrue(min(tokens) >= 6.9, tokens)
+        self.assertEqual(registry.fetcher.guard.rate_limited, 0)
+
+        # Requests refused by the rate limit are retried rather than stopping the warm-up
+        registry.toc_cache.clear()
+        registry.fetcher.guard = UpstreamGuard(rate=50, burst=2)
+        stats = warm_up(registry, ["en.wikipedia.org/wiki/Rate_%d" % index for index in range(10)], concurrency=4,
+                        budget=5, rate_share=1)
+        self.assertEqual((stats["fetched"], stats["failed"], stats["remaining"]), (10, 0, 0))
+        self.assertTrue(registry.fetcher.guard.rate_limited > 0)
+
+    def test_startup(self):
+        import json
+        import os
+        from webtest import TestApp
+        from . import main, views
+        from .warmup import Popularity
+        path = os.path.join(self.directory, "popularity.json")
+        popularity = Popularity()
+        popularity.record("en.wikipedia.org/wiki/Satchel")
+        popularity.save(path)
+        views.open_page=get_dummy_page
+        app = main({}, **{"wiki_toc.engine.enabled": "false", "wiki_toc.warmup.popularity_path": path,
+                          "wiki_toc.warmup.blocking": "true", "wiki_toc.warmup.prefetch_count": "10"})
+        scheduler = app.registry.warmup_scheduler
+        scheduler.stop()
+        self.assertTrue(app.registry.toc_cache.get_entry("en.wikipedia.org/wiki/Satchel", count=False) is not None)
+
+        # Requests are counted, including those answered by the response cache, but not those which failed with an
+        # error status, and saved by the scheduler
+        test_app = TestApp(app)
+        for _ in range(2):
+            test_app.get('/wiki_toc/en.wikipedia.org/wiki/Handbag')
+            test_app.get('/wiki_toc_json/en.wikipedia.org/wiki/Backpack/', status=502)
+        for _ in range(3):
+            test_app.get('/wiki_toc/en.wikipedia.org/wiki/Satchel')
+        self.assertEqual(app.registry.toc_cache.hits, 1)
+        self.assertEqual(app.registry.popularity.stats(), dict(requests=5, locations=2))
+        # The scheduler prefetches popular pages which are about to expire
+        app.registry.toc_cache.set("en.wikipedia.org/wiki/Satchel", None, ttl=60)
+        scheduler.run_once()
+        self.assertEqual(scheduler.last_prefetch["fetched"], 1)
+        with open(path) as f:
+            self.assertEqual([key for key, score in json.load(f)["locations"]],
+                             ["en.wikipedia.org/wiki/Satchel", "en.wikipedia.org/wiki/Handbag"])
+        # The list is saved when the process exits, but not for this test
+        scheduler.path = None
+
+    def test_command(self):
+        import os
+        import sqlite3
+        from . import views
+        from .warmup import main
+        views.open_page=get_dummy_page
+        sqlite_path = os.path.join(self.directory, "toc_cache.sqlite")
+        config_uri = os.path.join(self.directory, "warmup.ini")
+        with open(config_uri, "w") as f:
+            f.write("[app:main]\nuse = call:wiki_toc:main\nwiki_toc.cache.backend = sqlite\n"
+                    "wiki_toc.cache.sqlite_path = %s\nwiki_toc.metrics.enabled = false\n" % sqlite_path)
+        access_log = os.path.join(self.directory, "access.log")
+        with open(access_log, "w") as f:
+            f.write('127.0.0.1 - - [18/Oct/2026:10:00:00 +0000] "GET /wiki_toc/en.wikipedia.org/wiki/Satchel HTTP/1.1" 200 2048\n')
+        self.assertEqual(main([config_uri, "--access-log", access_log, "--concurrency", "1"]), 0)
+        connection = sqlite3.connect(sqlite_path)
+        try:
+            self.assertEqual(connection.execute("SELECT key FROM toc_cache").fetchall(), [(u"en.wikipedia.org/wiki/Satchel",)])
+        finally:
+            connection.close()
+
+class BulkTests(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def read_output(self, path):
+        import json
+        from .bulk import open_compressed
+        with open_compressed(path) as f:
+            return dict((result["key"], result["toc"]) for result in map(json.loads, f))
+
+    def test_directory(self):
+        import gzip
+        import os
+        from .bulk import main
+        pages = os.path.join(self.directory, "pages", "en.wikipedia.org", "wiki")
+        os.makedirs(pages)
+        with open(os.path.join(pages, "Satchel.html"), "wb") as f:
+            f.write(get_dummy_page("en.wikipedia.org/wiki/Satchel").html)
+        with gzip.open(os.path.join(pages, "Empty.html.gz"), "wb") as f:
+            f.write("<html><body><p>No table of contents</p></body></html>")
+        with open(os.path.join(pages, "notes.txt"), "wb") as f:
+            f.write("Not a page")
+
+        output = os.path.join(self.directory, "tocs.ndjson.gz")
+        self.assertEqual(main([os.path.join(self.directory, "pages"), output, "--processes", "2", "--progress-interval", "0"]), 0)
+        results = self.read_output(output)
+        self.assertEqual(sorted(results), ["en.wikipedia.org/wiki/Empty", "en.wikipedia.org/wiki/Satchel"])
+        self.assertEqual(results["en.wikipedia.org/wiki/Empty"], None)
+        # The same extraction, including rewriting hrefs, as the views
+        self.assertEqual(results["en.wikipedia.org/wiki/Satchel"]["sections"][0]["href"],
+                         "https://en.wikipedia.org/wiki/Satchel#History")
+
+        # The location can be given by --base-url instead
+        output = os.path.join(self.directory, "tocs.ndjson")
+        main([pages, output, "--base-url", "https://de.wikipedia.org/wiki", "--progress-interval", "0"])
+        self.assertEqual(sorted(self.read_output(output)), ["de.wikipedia.org/wiki/Empty", "de.wikipedia.org/wiki/Satchel"])
+
+    def test_dump(self):
+        import json
+        import os
+        import tarfile
+        from StringIO import StringIO
+        from .bulk import iter_pages, run_bulk, BulkProgress
+        lines = [json.dumps(dict(name="Satchel %d" % index, url="https://en.wikipedia.org/wiki/Satchel_%d" % index,
+                                 article_body=dict(html=get_dummy_page("en.wikipedia.org/wiki/Satchel").html)))
+                 for index in range(50)]
+        lines.append(json.dumps(dict(name="Other", url="https://www.example.com/Other", article_body=dict(html="<p></p>"))))
+        dump = os.path.join(self.directory, "enwiki-NS0-ENTERPRISE-HTML.json.tar.gz")
+        with tarfile.open(dump, "w:gz") as archive:
+            data = "\n".join(lines)
+            member = tarfile.TarInfo("enwiki_namespace_0_0.ndjson")
+            member.size = len(data)
+            archive.addfile(member, StringIO(data))
+
+        output = StringIO()
+        progress = run_bulk(iter_pages(dump), output, processes=2, max_pending=4, chunksize=2,
+                            progress=BulkProgress(interval=0, stream=StringIO()))
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(sorted(result["key"] for result in results),
+                         sorted("en.wikipedia.org/wiki/Satchel_%d" % index for index in range(50)))
+        self.assertEqual(results[0]["toc"]["sections"][0]["anchor"], "History")
+        self.assertEqual((progress.pages, progress.tocs, progress.errors), (50, 50, 0))
+
+    def test_bad_records(self):
+        import bz2
+        import gzip
+        import json
+        import os
+        import tarfile
+        from StringIO import StringIO
+        from .bulk import iter_pages, run_bulk, BulkProgress
+
+        def gzip_compress(data):
+            f = StringIO()
+            with gzip.GzipFile(fileobj=f, mode="wb") as compressed:
+                compressed.write(data)
+            return f.getvalue()
+
+        page = json.dumps(dict(url="https://en.wikipedia.org/wiki/Satchel",
+                               article_body=dict(html=get_dummy_page("en.wikipedia.org/wiki/Satchel").html)))
+        data = "\n".join([page, "{not json", "[1, 2]", json.dumps(dict(url="https://www.example.com/Other", html="<p></p>")), page])
+        # Each member is two compressed streams concatenated, split within a line
+        half = len(data) // 2
+        dump = os.path.join(self.directory, "dump.tar")
+        with tarfile.open(dump, "w") as archive:
+            for name, member_data in [("part_0.ndjson.gz", gzip_compress(data[:half]) + gzip_compress(data[half:])),
+                                      ("part_1.ndjson.bz2", bz2.compress(data[:half]) + bz2.compress(data[half:])),
+                                      ("Satchel.html", get_dummy_page("en.wikipedia.org/wiki/Satchel").html)]:
+                member = tarfile.TarInfo(name)
+                member.size = len(member_data)
+                archive.addfile(member, StringIO(member_data))
+
+        # Without --base-url the location of the html file is not a wikipedia url
+        progress = BulkProgress(interval=0, stream=StringIO())
+        output = StringIO()
+        run_bulk(iter_pages(dump, progress=progress), output, processes=2, progress=progress)
+        self.assertEqual((progress.pages, progress.tocs, progress.errors, progress.skipped), (4, 4, 0, 7))
+        progress.report()
+        self.assertIn("7 skipped", progress.stream.getvalue())
+
+
+class IndexTests(unittest.TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "toc_index.bin")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def test_lookup(self):
+        from .index import TocIndex, write_index
+        records = [("en.wikipedia.org/wiki/Page_%d" % index, dict(title=u"Contents", sections=[dict(text=u"%d" % index)]))
+                   for index in range(1000)]
+        records.append(("en.wikipedia.org/wiki/Empty", None))
+        records.append(("en.wikipedia.org/wiki/Page_7", dict(title=u"Replaced", sections=[])))
+        self.assertEqual(write_index(records, self.path), 1002)
+
+        index = TocIndex(self.path)
+        self.assertEqual(len(index), 1002)
+        self.assertEqual(index.lookup("en.wikipedia.org/wiki/Page_500"),
+                         (True, dict(title=u"Contents", sections=[dict(text=u"500")])))
+        self.assertEqual(index.lookup(u"en.wikipedia.org/wiki/Empty"), (True, None))
+        # The last record for a key is the one which is found
+        self.assertEqual(index.lookup("en.wikipedia.org/wiki/Page_7")[1]["title"], u"Replaced")
+        self.assertEqual(index.lookup("en.wikipedia.org/wiki/Missing"), (False, None))
+        self.assertEqual((index.stats()["hits"], index.stats()["misses"]), (3, 1))
+
+    def test_replaced(self):
+        import os
+        from .index import TocIndex, write_index
+        # The index does not need to exist when the app starts
+        index = TocIndex(self.path, check_interval=0)
+        self.assertEqual(index.lookup("en.wikipedia.org/wiki/Satchel"), (False, None))
+
+        write_index([("en.wikipedia.org/wiki/Satchel", None)], self.path)
+        self.assertEqual(index.lookup("en.wikipedia.org/wiki/Satchel"), (True, None))
+
+        # A rebuilt index is swapped in on the next check while lookups of the old one still work
+        old = index._index
+        write_index([("en.wikipedia.org/wiki/Handbag", None)], self.path)
+        self.assertEqual(index.lookup("en.wikipedia.org/wiki/Handbag"), (True, None))
+        self.assertEqual(index.lookup("en.wikipedia.org/wiki/Satchel"), (False, None))
+        self.assertEqual(old.lookup("en.wikipedia.org/wiki/Satchel"), (True, None))
+        self.assertEqual(index.stats()["reloads"], 2)
+        self.assertEqual(os.listdir(self.directory), ["toc_index.bin"])
+
+        # A damaged index is not used
+        with open(self.path + ".damaged", "wb") as f:
+            f.write("not an index" * 10)
+        os.rename(self.path + ".damaged", self.path)
+        index.reload()
+        self.assertEqual(index.lookup("en.wikipedia.org/wiki/Handbag"), (True, None))
+
+    def test_build_from_bulk_output(self):
+        import gzip
+        import json
+        import os
+        from .index import TocIndex, main
+        source = os.path.join(self.directory, "tocs.ndjson.gz")
+        with gzip.open(source, "wb") as f:
+            f.write(json.dumps(dict(key="en.wikipedia.org/wiki/Satchel", toc=dict(title=u"Contents", sections=[]))) + "\n")
+        self.assertEqual(main([source, self.path]), 0)
+        self.assertEqual(TocIndex(self.path).lookup("en.wikipedia.org/wiki/Satchel"),
+                         (True, dict(title=u"Contents", sections=[])))
+
+
+class BenchmarkTests(unittest.TestCase):
+    def test_corpus(self):
+        from .benchmarks.corpus import generate_article
+        from .extractor import extract_toc, iter_sections
+        from .fetcher import FetchedPage
+        html = generate_article("Satchel", sections=20, payload_size=50000)
+        self.assertTrue(len(html) >= 50000)
+        self.assertEqual(html, generate_article("Satchel", sections=20, payload_size=50000))
+        sections = list(iter_sections(extract_toc(FetchedPage(html).iter_chunks())["sections"]))
+        self.assertEqual(len(sections), 20)
+        self.assertEqual([section["section"] for section in sections], [str(index) for index in range(1, 21)])
+
+    def test_run(self):
+        import json
+        import os
+        import shutil
+        import sys
+        import tempfile
+        from StringIO import StringIO
+        from . import views
+        from .benchmarks.run import main
+        # Pages are fetched from the stand-in server rather than bypassing the fetcher as in ViewTests
+        views.open_page=open_page
+        directory = tempfile.mkdtemp()
+        stdout = sys.stdout
+        try:
+            sys.stdout = StringIO()
+            output = os.path.join(directory, "benchmark.json")
+            arguments = ["--pages", "2", "--sections", "5", "--payload-size", "5000", "--micro-time", "0",
+                         "--requests", "6", "--concurrency", "2", "--waitress-threads", "2"]
+            self.assertEqual(main(arguments + ["--output", output]), 0)
+            with open(output) as f:
+                report = json.load(f)
+            # The results can be compared with an earlier run
+            self.assertEqual(main(arguments + ["--only", "load", "--baseline", output]), 0)
+            table = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            shutil.rmtree(directory)
 
+        results = dict((result["name"], result) for result in report["results"])
+        for name in ("micro.url_manager.absolute_url", "micro.href_rewriter.rewrite", "micro.extract_toc",
+                     "micro.parse.beautifulsoup_lxml", "load.webtest", "load.waitress"):
+            self.assertTrue(name in results, name)
+        self.assertEqual((results["load.waitress"]["operations"], results["load.waitress"]["errors"]), (6, 0))
+        self.assertEqual(results["load.webtest"]["errors"], 0)
+        for key in ("throughput", "p50_ms", "p99_ms", "peak_rss_mb", "process_peak_rss_mb"):
+            self.assertTrue(results["load.webtest"][key] > 0, key)
+        self.assertTrue("throughput" in table.splitlines()[-1])
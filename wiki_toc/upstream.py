@@ -0,0 +1,238 @@
+""" Protection of the upstream wikipedia hosts from more requests than they are willing to serve.
+
+    Each host, eg: en.wikipedia.org and de.wikipedia.org, has a token bucket which limits the rate of requests to it
+    and a circuit breaker. The breaker opens after failure_threshold consecutive failures, where responses slower than
+    slow_seconds, 429 and 5xx statuses and connection errors are failures. It also opens for as long as a host asks in
+    the Retry-After header of a 429 or 503 response. While a breaker is open, requests to its host fail immediately with
+    UpstreamUnavailable rather than tying up a thread waiting on a host that is struggling. After reset_timeout a
+    single trial request is let through; the breaker closes again if it succeeds.
+"""
+import email.utils
+import threading
+import time
+
+from pyramid.settings import asbool
+
+
+class UpstreamUnavailable(Exception):
+    """ Raised instead of making a request to a host which is rate limited or whose circuit breaker is open
+        retry_after is the number of seconds until a request may be made to the host again and rate_limited is True if
+        the request was refused by the rate limit rather than the circuit breaker.
+    """
+
+    def __init__(self, host, retry_after, reason, rate_limited=False):
+        Exception.__init__(self, "Requests to %s are suspended for %.1f seconds: %s" % (host, retry_after, reason))
+        self.host = host
+        self.retry_after = retry_after
+        self.reason = reason
+        self.rate_limited = rate_limited
+
+
+def parse_retry_after(value, now=None):
+    """ Returns the number of seconds given by a Retry-After header, which may be a number of seconds or a date, or None
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(email.utils.mktime_tz(parsed) - (now or time.time()), 0.0)
+
+
+class TokenBucket(object):
+    """ Allows an average of rate requests a second with bursts of up to burst requests
+        Not thread safe; UpstreamGuard serializes access to its buckets.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now or time.time()
+
+    def _refill(self, now=None):
+        now = now or time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now=None):
+        """ Takes a token and returns 0 or, if there is none, returns the number of seconds until there will be one
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def wait(self, reserve, now=None):
+        """ Returns the number of seconds until a token can be taken while leaving reserve tokens, without taking it
+        """
+        self._refill(now)
+        return max(reserve + 1 - self.tokens, 0.0) / self.rate
+
+
+class CircuitBreaker(object):
+    """ Tracks the health of a single host. Not thread safe; UpstreamGuard serializes access to its breakers.
+    """
+    closed = "closed"
+    open = "open"
+    half_open = "half_open"
+
+    def __init__(self, failure_threshold=5, slow_seconds=5.0, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.slow_seconds = slow_seconds
+        self.reset_timeout = reset_timeout
+        self.state = self.closed
+        self.failures = 0
+        self.open_until = 0.0
+        self.trial_in_progress = False
+        self.trips = 0
+
+    def allow(self, now=None):
+        """ Returns 0 if a request may be made or the number of seconds until one may be
+        """
+        now = now or time.time()
+        if self.state == self.open:
+            if now < self.open_until:
+                return self.open_until - now
+            self.state = self.half_open
+            self.trial_in_progress = False
+        if self.state == self.half_open:
+            if self.trial_in_progress:
+                # Wait for the outcome of the trial request
+                return min(self.reset_timeout, 1.0)
+            self.trial_in_progress = True
+        return 0.0
+
+    def _open(self, until):
+        if self.state != self.open:
+            self.trips += 1
+        self.state = self.open
+        self.open_until = max(self.open_until, until)
+        self.trial_in_progress = False
+
+    def record(self, elapsed, failed, retry_after=None, now=None):
+        """ Records the outcome of a request which took elapsed seconds
+            retry_after is the delay asked for by the host, which opens the breaker for that long
+        """
+        now = now or time.time()
+        if self.slow_seconds and elapsed >= self.slow_seconds:
+            failed = True
+        if retry_after:
+            self.failures += 1
+            self._open(now + retry_after)
+        elif failed:
+            self.failures += 1
+            if self.state == self.half_open or self.failures >= self.failure_threshold:
+                self._open(now + self.reset_timeout)
+        else:
+            self.failures = 0
+            self.state = self.closed
+            self.trial_in_progress = False
+
+
+class UpstreamGuard(object):
+    """ A token bucket and circuit breaker for each upstream host
+        rate is the number of requests a second allowed to each host, or 0 for no limit, and burst the number which may
+        be made at once. Retry-After delays are capped at max_retry_after seconds.
+    """
+
+    def __init__(self, rate=10.0, burst=20, failure_threshold=5, slow_seconds=5.0, reset_timeout=30.0,
+                 max_retry_after=300.0):
+        self.rate = rate
+        self.burst = burst
+        self.failure_threshold = failure_threshold
+        self.slow_seconds = slow_seconds
+        self.reset_timeout = reset_timeout
+        self.max_retry_after = max_retry_after
+        self._hosts = {}    # host -> (TokenBucket or None, CircuitBreaker)
+        self._lock = threading.Lock()
+        self.rate_limited = 0
+        self.short_circuited = 0
+
+    def _host(self, host):
+        """ Must be called while holding self._lock
+        """
+        state = self._hosts.get(host)
+        if state is None:
+            bucket = TokenBucket(self.rate, self.burst) if self.rate else None
+            breaker = CircuitBreaker(self.failure_threshold, self.slow_seconds, self.reset_timeout)
+            state = self._hosts[host] = (bucket, breaker)
+        return state
+
+    def acquire(self, host):
+        """ Raises UpstreamUnavailable unless a request may be made to host now
+        """
+        host = (host or "").lower()
+        with self._lock:
+            bucket, breaker = self._host(host)
+            wait = breaker.allow()
+            if wait:
+                self.short_circuited += 1
+                raise UpstreamUnavailable(host, wait, "the circuit breaker is open")
+            wait = bucket.take() if bucket is not None else 0
+            if wait:
+                if breaker.state == CircuitBreaker.half_open:
+                    breaker.trial_in_progress = False
+                self.rate_limited += 1
+                raise UpstreamUnavailable(host, wait, "the request rate limit has been reached", rate_limited=True)
+
+    def share_wait(self, host, share):
+        """ Returns the number of seconds until a request to host would leave at least (1 - share) of its burst for
+            other requests, or 0 if it would now. Background work such as the cache warm-up waits for this before each
+            request so that the requests of users are not rate limited by it.
+        """
+        host = (host or "").lower()
+        with self._lock:
+            bucket = self._host(host)[0]
+            if bucket is None or share >= 1:
+                return 0.0
+            # A reserve of the whole burst could never be met, so always allow a single request
+            return bucket.wait(min((1 - share) * self.burst, self.burst - 1))
+
+    def release(self, host):
+        """ Records that a request to host which was allowed by acquire was not made after all
+            If it was the trial request of a half open breaker another request may be the trial.
+        """
+        host = (host or "").lower()
+        with self._lock:
+            breaker = self._host(host)[1]
+            if breaker.state == CircuitBreaker.half_open:
+                breaker.trial_in_progress = False
+
+    def record(self, host, elapsed, failed, retry_after=None):
+        """ Records the outcome of a request to host which was allowed by acquire
+        """
+        host = (host or "").lower()
+        if retry_after is not None:
+            retry_after = min(retry_after, self.max_retry_after)
+        with self._lock:
+            self._host(host)[1].record(elapsed, failed, retry_after)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                rate_limited=self.rate_limited,
+                short_circuited=self.short_circuited,
+                hosts=dict((host, dict(state=breaker.state, failures=breaker.failures, trips=breaker.trips))
+                           for host, (bucket, breaker) in self._hosts.items()),
+            )
+
+
+def guard_from_settings(settings):
+    """ Creates an UpstreamGuard from the 'wiki_toc.upstream.*' settings or returns None if it is disabled
+    """
+    if not asbool(settings.get("wiki_toc.upstream.enabled", True)):
+        return None
+    return UpstreamGuard(
+        rate=float(settings.get("wiki_toc.upstream.rate", 10.0)),
+        burst=int(settings.get("wiki_toc.upstream.burst", 20)),
+        failure_threshold=int(settings.get("wiki_toc.upstream.failure_threshold", 5)),
+        slow_seconds=float(settings.get("wiki_toc.upstream.slow_seconds", 5.0)),
+        reset_timeout=float(settings.get("wiki_toc.upstream.reset_timeout", 30.0)),
+        max_retry_after=float(settings.get("wiki_toc.upstream.max_retry_after", 300.0)),
+    )
@@ -1,10 +1,25 @@
 from pyramid.view import view_config
 from pyramid import httpexceptions as exc
+from pyramid.response import Response
+import json
+import math
+import Queue
+import socket
+import threading
 import urlparse
 import urllib2
-from bs4 import BeautifulSoup
 import logging
 
+from .cache import normalize_key
+from .engine import EngineBusy, EngineTimeout
+from .extractor import extract_toc, iter_sections, render_toc_html
+from .fetcher import HttpFetcher, NotModified
+from .metrics import error_class, get_timer, null_timer
+from .refresher import Refresher
+from .responses import cached_response, mark_cacheable
+from .singleflight import SingleFlight
+from .upstream import UpstreamUnavailable
+
 # For this example app, there is no database so many of the paremters below are hardcoded throughout the app
 # even though it would be more useful to derive them from database configuration
 default_template_parameters = dict(
@@ -15,9 +30,22 @@ default_template_parameters = dict(
 wikipedia_scheme = "https://"
 wikipedia_domain = "wikipedia.org"
 
+# Used when the application has not been configured with a fetcher, single flight or refresher, eg: in tests
+default_fetcher = HttpFetcher()
+default_toc_flights = SingleFlight()
+default_refresher = Refresher()
+
+# Statuses which show that a page does not exist. These are cached for the cache's negative_ttl
+missing_page_statuses = frozenset([404, 410])
+
 class UrlManager(object):
     """ A simple helper class which provides functions for interogating and modifying urls
     """
+    __slots__ = ('_urlobj',)
+
+    # The results of normalize, shared by every request. The memo is emptied when it reaches max_memoized
+    _normalized = {}
+    max_memoized = 10000
 
     def __init__(self, url, fallback_scheme=None, fallback_netloc=None):
         # First check whether this url starts with 'http'. If it doesn't and there is a fallback scheme, attempt prepend this to the url
@@ -70,6 +98,69 @@ class UrlManager(object):
         # Return the result list converted to a url
         return urlparse.urlunparse(result)
 
+    @classmethod
+    def normalize(cls, target_wiki_page):
+        """ Returns (wiki location, cache key) for a url entered by a user or None if it is not a wikipedia url
+            eg: 'https://EN.wikipedia.org/wiki/Stuff' becomes ('EN.wikipedia.org/wiki/Stuff', 'en.wikipedia.org/wiki/Stuff')
+            The location is relative to the 'wiki_toc' route and the key is the one used by the toc cache. Results are
+            memoized since the same popular pages are requested over and over.
+        """
+        try:
+            return cls._normalized[target_wiki_page]
+        except KeyError:
+            pass
+
+        # Create an instance of UrlManager with fallback options for creating a full url from a partial one
+        # Eg: if '/wiki/Satchel' is provided convert it into 'https://wikipedia.org/wiki/Satchel'
+        #     if 'wiki/Satchel' is provided, assume that 'wiki' is the netloc
+        url_manager = cls(target_wiki_page, fallback_scheme=wikipedia_scheme, fallback_netloc=wikipedia_domain)
+
+        if url_manager.matches_domain(wikipedia_domain):
+            # Convert url_manager to a list and set its scheme to ''
+            url_parts = url_manager.to_list()
+            url_parts[0] = ""
+            # With the scheme removed, calculate a relative url path to the resource
+            wiki_location = urlparse.urlunparse(url_parts).strip("/")
+            normalized = (wiki_location, normalize_key(wiki_location))
+        else:
+            normalized = None
+
+        if len(cls._normalized) >= cls.max_memoized:
+            cls._normalized.clear()
+        cls._normalized[target_wiki_page] = normalized
+        return normalized
+
+class HrefRewriter(object):
+    """ Makes the hrefs in a page absolute relative to the page's url, which is parsed once for all of them
+        Most hrefs in a table of contents are '#fragment' so these are joined to a precomputed prefix. Any other href is
+        made absolute by UrlManager, which gives the same result for fragments.
+    """
+    __slots__ = ('_reference_url_object', '_fragment_prefix')
+
+    def __init__(self, url):
+        self._reference_url_object = reference = urlparse.urlparse(url)
+        # UrlManager.absolute_url keeps the page's scheme, netloc, path and query but not its params
+        self._fragment_prefix = urlparse.urlunparse((reference.scheme, reference.netloc, reference.path, "",
+                                                     reference.query, "")) + "#"
+
+    def rewrite(self, href):
+        """ Returns (the fragment of href or None, the absolute href)
+        """
+        if len(href) > 1 and href[0] == "#":
+            return href[1:], self._fragment_prefix + href[1:]
+        url_manager = UrlManager(href)
+        anchor = url_manager.to_list()[5] or None
+        if url_manager.url_is_relative():
+            href = url_manager.absolute_url(self._reference_url_object)
+        return anchor, href
+
+def get_wiki_location(target_wiki_page):
+    """ Returns the location of a wikipedia page relative to the 'wiki_toc' route or None if it is not a wikipedia url
+        eg: 'https://en.wikipedia.org/wiki/Stuff' becomes 'en.wikipedia.org/wiki/Stuff'
+    """
+    normalized = UrlManager.normalize(target_wiki_page)
+    return normalized[0] if normalized is not None else None
+
 def get_wiki_page_redirect(request, errors):
     """ This page accepts a form post containing the value 'target_wiki_page' and redirects to a site page matching the relative url of the wikipedia page
         eg: 'https://en.wikipedia.org/wiki/Stuff' becomes '<site url>/wiki_toc/en.wikipedia.org/wiki/Stuff'
@@ -88,17 +179,8 @@ def get_wiki_page_redirect(request, errors):
 
     # There is a post specifying a target page
     try:
-        # Create an instance of UrlManager with fallback options for creating a full url from a partial one
-        # Eg: if '/wiki/Satchel' is provided convert it into 'https://wikipedia.org/wiki/Satchel'
-        #     if 'wiki/Satchel' is provided, assume that 'wiki' is the netloc
-        url_manager = UrlManager(target_wiki_page, fallback_scheme=wikipedia_scheme, fallback_netloc=wikipedia_domain)
-
-        if url_manager.matches_domain(wikipedia_domain):
-            # Convert url_manager to a list and set its scheme to ''
-            url_parts = url_manager.to_list()
-            url_parts[0] = ""
-            # With the scheme removed, calculate a relative url path to the resource
-            wiki_location = urlparse.urlunparse(url_parts).strip("/")
+        wiki_location = get_wiki_location(target_wiki_page)
+        if wiki_location is not None:
             return exc.HTTPFound(request.route_url("wiki_toc", wiki_location=wiki_location))
         else:
             logging.error("User supplied url, '%s', is not a valid wikipedia url.", target_wiki_page)
@@ -110,13 +192,171 @@ def get_wiki_page_redirect(request, errors):
         errors.append("Cannot locate the wikipedia page for '%s'" % target_wiki_page)
         return None
 
-def get_soup(url):
-    """ Loads html from url and returns the parsed results
-        Throws any exeptions raised by urllib2 or BeautifulSoup
+def get_fetcher(registry):
+    """ Returns the HttpFetcher configured by wiki_toc.main or the default fetcher if there is none
+    """
+    return getattr(registry, "fetcher", None) or default_fetcher
+
+def open_page(url, etag=None, last_modified=None, fetcher=None):
+    """ Requests url and returns the page as soon as the response headers have been read
+        The body can then be read incrementally with iter_chunks and the page must be closed (or used in a with block).
+        If either of the validators from a previous fetch are provided, the request is made conditional and
+        NotModified is raised when the page has not changed.
+        Throws any exeptions raised by the fetcher; these are the same as those raised by urllib2
+    """
+    return (fetcher or default_fetcher).open(url, etag, last_modified)
+
+def get_toc_flights(registry):
+    """ Returns the SingleFlight used to coalesce concurrent fetches of the same page
+    """
+    return getattr(registry, "toc_flights", None) or default_toc_flights
+
+def get_refresher(registry):
+    """ Returns the Refresher used to refresh stale tables of contents in the background
+    """
+    return getattr(registry, "toc_refresher", None) or default_refresher
+
+def get_fetch_engine(registry):
+    """ Returns the FetchEngine started by wiki_toc.main or None, in which case pages are fetched by the calling thread
+    """
+    return getattr(registry, "fetch_engine", None)
+
+def rewrite_toc_links(toc, url):
+    """ Sets the anchor of each section in the tree for a table of contents and makes relative hrefs absolute
+        url is the url of the page that the table of contents was extracted from
+    """
+    rewriter = HrefRewriter(url)
+    for section in iter_sections(toc["sections"]):
+        if section["href"]:
+            section["anchor"], section["href"] = rewriter.rewrite(section["href"])
+    html = toc.get("html")
+    if html:
+        # The other links in the markup, eg: to help pages
+        html["links"] = [rewriter.rewrite(link)[1] if isinstance(link, basestring) and link else link
+                         for link in html["links"]]
+
+def json_toc(toc):
+    """ Returns the tree for a table of contents as it is returned to json clients, without the markup which is only
+        used to render it
+    """
+    if not toc or "html" not in toc:
+        return toc
+    return dict((name, value) for name, value in toc.items() if name != "html")
+
+def is_negative_error(e):
+    """ Returns True if e shows that a page is missing or cannot be reached, in which case it is cached negatively
+        rather than fetching the page again on every request. Other errors, eg: timeouts, are not cached.
+    """
+    if isinstance(e, urllib2.HTTPError):
+        return e.code in missing_page_statuses
+    # The fetcher reports timeouts as a URLError whose reason is the socket.timeout
+    return isinstance(e, urllib2.URLError) and not isinstance(e.reason, socket.timeout)
+
+def negative_value(e):
+    """ Returns the value cached for an error for which is_negative_error is True
+    """
+    return dict(error=str(e.reason), code=getattr(e, "code", None))
+
+def toc_from_cache(value, url):
+    """ Returns a cached table of contents or raises the error that was cached negatively in its place
+    """
+    if isinstance(value, dict) and "error" in value:
+        if value["code"]:
+            raise urllib2.HTTPError(url, value["code"], value["error"], None, None)
+        raise urllib2.URLError(value["error"])
+    return value
+
+def load_toc(url, cache_key, toc_cache=None, fetcher=None, cached_entry=None, timer=null_timer):
+    """ Fetches url and returns the tree for its table of contents, with hrefs linking to the original site, or None if
+        the page does not have a table of contents. See extractor.py for a description of the tree.
+        cached_entry is an expired entry from toc_cache which is revalidated rather than fetching the page again if
+        wikipedia reports that the page has not changed. Extracted tables of contents are stored in toc_cache.
+        Pages without a table of contents and pages which are missing or unreachable are stored for the cache's
+        negative_ttl. The time spent in each stage is recorded by timer.
+    """
+    page = None
+    try:
+        if cached_entry is not None:
+            try:
+                with timer.stage("fetch"):
+                    page = open_page(url, cached_entry.etag, cached_entry.last_modified, fetcher=fetcher)
+            except NotModified:
+                toc = toc_cache.revalidated(cache_key)
+                if toc is not None:
+                    return toc
+                # The entry was evicted while it was being revalidated
+        if page is None:
+            with timer.stage("fetch"):
+                page = open_page(url, fetcher=fetcher)
+
+        # Get the div containing the table of contents. The rest of the page is not downloaded or parsed
+        with page:
+            with timer.stage("parse"):
+                toc = extract_toc(timer.timed_chunks(page.iter_chunks()), page.charset)
+    except urllib2.URLError, e:
+        if toc_cache is not None and is_negative_error(e):
+            toc_cache.set(cache_key, negative_value(e), ttl=toc_cache.negative_ttl)
+        raise
+    timer.page_finished(page)
+
+    # Check that there is a table of contents
+    if not toc:
+        if toc_cache is not None:
+            toc_cache.set(cache_key, None, ttl=toc_cache.negative_ttl)
+        return None
+
+    # Fix any relative hrefs so that they link to the original site
+    with timer.stage("rewrite"):
+        rewrite_toc_links(toc, url)
+
+    # Only successfully extracted tables of contents are cached
+    if toc_cache is not None:
+        toc_cache.set(cache_key, toc, etag=page.etag, last_modified=page.last_modified)
+    return toc
+
+def get_toc(registry, wiki_location, engine=None, timer=null_timer):
+    """ Returns the tree for the table of contents for wiki_location or None if the page does not have one
+        The table of contents is served from the cache or the precomputed index when possible. Otherwise the page is fetched over a pooled
+        connection, in engine if one is given, and concurrent calls for the same page share a single fetch.
+        A table of contents which expired no more than the cache's max_stale seconds ago is returned straight away
+        while it is refreshed in the background. An expired table of contents of any age is returned rather than
+        raising UpstreamUnavailable when requests to wikipedia are suspended.
+        The time spent in each stage is recorded by timer, unless the fetch is shared with another request.
     """
-    page = urllib2.urlopen(url)
-    html = page.read()
-    return BeautifulSoup(html, 'lxml')
+    toc_cache = getattr(registry, "toc_cache", None)
+    cache_key = normalize_key(wiki_location)
+    url = wikipedia_scheme + wiki_location
+    with timer.stage("cache"):
+        cached_entry = toc_cache.get_entry(cache_key) if toc_cache is not None else None
+        if cached_entry is not None and cached_entry.is_fresh():
+            return toc_from_cache(cached_entry.value, url)
+
+        # Pages in the precomputed index are served from it without going to the network
+        toc_index = getattr(registry, "toc_index", None)
+        if toc_index is not None:
+            found, toc = toc_index.lookup(cache_key)
+            if found:
+                return toc
+
+    flights = get_toc_flights(registry)
+    if cached_entry is not None and cached_entry.value and "error" not in cached_entry.value and \
+            cached_entry.is_servable_stale(toc_cache.max_stale):
+        get_refresher(registry).schedule(cache_key, get_fetch_engine(registry), flights.do, cache_key, load_toc, url,
+                                         cache_key, toc_cache, get_fetcher(registry), cached_entry)
+        return cached_entry.value
+
+    try:
+        if engine is None:
+            return flights.do(cache_key, load_toc, url, cache_key, toc_cache, get_fetcher(registry), cached_entry, timer)
+        # The flight lasts as long as the fetch in the engine, rather than as long as this request waits for it, so
+        # requests made after this one times out share the fetch instead of queuing another
+        return engine.wait(flights.submit(cache_key, engine, load_toc, url, cache_key, toc_cache, get_fetcher(registry),
+                                          cached_entry, timer))
+    except UpstreamUnavailable:
+        # Wikipedia is not being sent requests so serve the expired table of contents however old it is
+        if cached_entry is not None and cached_entry.value and "error" not in cached_entry.value:
+            return cached_entry.value
+        raise
 
 @view_config(route_name='choose_wiki_page', renderer='templates/choose_wiki_page.pt')
 def choose_wiki_page(request):
@@ -135,8 +375,11 @@ def choose_wiki_page(request):
     template_parameters["errors"] = errors
     return template_parameters
 
-@view_config(route_name='wiki_toc', renderer='templates/view_wiki_toc.pt')
+@view_config(route_name='wiki_toc', renderer='templates/view_wiki_toc.pt', decorator=cached_response)
 def wiki_toc(request):
+    """ This view displays the table of contents for a wikipedia page
+        Pages which display a table of contents are stored in the response cache once they have been rendered.
+    """
     errors = []
     template_parameters = default_template_parameters.copy()
     
@@ -146,37 +389,47 @@ def wiki_toc(request):
         template_parameters["title"] = wiki_location
         template_parameters["toc"] = ''   # Set a default value
         
-        # Fetch the page  - not that the default timeout for urllib2 is being used
+        # Prepend the default wikipedia scheme to the url location (which should be 'https://')
+        url = wikipedia_scheme + wiki_location
+        timer = get_timer(request)
         try:
-            # Prepend the default wikipedia scheme to the url location (which should be 'https://')
-            url = wikipedia_scheme + wiki_location
-            reference_url_object = urlparse.urlparse(url)
-            soup = get_soup(url)
-            
-            # Get the div containing the table of contents
-            toc = soup.find_all('div', id="toc", limit=1)
-            
-            # Check that there is a table of contents
+            # The fetch is done by the fetch engine's workers so that this thread waits no longer than its deadline
+            toc = get_toc(request.registry, wiki_location, get_fetch_engine(request.registry), timer)
             if toc:
-                toc = toc[0]
-                # Fix any relative hrefs so that they link to the original site
-                for a in toc.find_all('a'):
-                    url_manager = UrlManager(a["href"])
-                    if url_manager.url_is_relative():
-                        a["href"] = url_manager.absolute_url(reference_url_object)
-                    a["target"] = "_NEW"
+                with timer.stage("render"):
+                    toc = render_toc_html(toc)
+                mark_cacheable(request)
             else:
-                template_parameters["toc"] = ''
+                toc = ''
                 errors.append("No table of contents is available.")
 
             template_parameters["toc"] = toc
+        except EngineBusy, e:
+            # Fail fast rather than queueing more requests than the workers can handle
+            timer.count_error(e)
+            logging.error("Rejected the request for '%s': %s", url, str(e))
+            raise exc.HTTPServiceUnavailable("Too many pages are being fetched. Please try again shortly.",
+                                             headers={"Retry-After": "1"})
+        except UpstreamUnavailable, e:
+            # Wikipedia is rate limited or failing so respond immediately rather than adding to its load
+            timer.count_error(e)
+            logging.error("Rejected the request for '%s': %s", url, str(e))
+            raise exc.HTTPServiceUnavailable(toc_error_message(e, wiki_location),
+                                             headers={"Retry-After": retry_after_header(e)})
+        except EngineTimeout, e:
+            timer.count_error(e)
+            logging.error("Failed to process the contents of '%s' due to timeout: %s", url, str(e))
+            errors.append("Timed out while getting the table of contents for '%s'" % wiki_location)
         except urllib2.URLError, e:
+            timer.count_error(e)
             logging.error("Failed to process the contents of '%s' due to url error: %s", url, str(e))
             errors.append("The url '%s' does not appear to be valid" % wiki_location)
         except urllib2.HTTPError, e:
+            timer.count_error(e)
             logging.error("Failed to process the contents of '%s' due to http error: %s", url, str(e))
             errors.append("Could not access the url '%s'" % wiki_location)
         except BaseException, e:
+            timer.count_error(e)
             logging.error("Failed to process the contents of '%s' due to error: %s", url, str(e))
             errors.append("Could not get the table of contents for '%s'" % wiki_location)
     else:
@@ -186,3 +439,176 @@ def wiki_toc(request):
 
     template_parameters["errors"] = errors
     return template_parameters
+
+def retry_after_header(e):
+    """ Returns the Retry-After header for an UpstreamUnavailable error in whole seconds
+    """
+    return str(max(int(math.ceil(e.retry_after)), 1))
+
+def toc_error_message(e, wiki_location):
+    """ Returns the message displayed by wiki_toc when getting the table of contents for wiki_location raised e
+    """
+    if isinstance(e, EngineTimeout):
+        return "Timed out while getting the table of contents for '%s'" % wiki_location
+    if isinstance(e, EngineBusy):
+        return "Too many pages are being fetched. Please try again shortly."
+    if isinstance(e, UpstreamUnavailable):
+        return "Wikipedia is not being sent requests at the moment. Please try again in %s seconds." % retry_after_header(e)
+    if isinstance(e, urllib2.URLError):
+        return "The url '%s' does not appear to be valid" % wiki_location
+    return "Could not get the table of contents for '%s'" % wiki_location
+
+def get_batch_result(registry, index, target_wiki_page):
+    """ Returns the result for one of the pages requested from wiki_toc_batch as a dict
+        The table of contents is returned as a tree in the same form as wiki_toc_json
+    """
+    result = dict(index=index, url=target_wiki_page, wiki_location=None, toc=None, error=None)
+    try:
+        wiki_location = get_wiki_location(target_wiki_page)
+        if wiki_location is None:
+            result["error"] = "'%s' is not a valid wikipedia url." % target_wiki_page
+            return result
+        result["wiki_location"] = wiki_location
+        result["toc"] = json_toc(get_toc(registry, wiki_location))
+        if not result["toc"]:
+            result["error"] = "No table of contents is available."
+    except BaseException, e:
+        metrics = getattr(registry, "metrics", None)
+        if metrics is not None:
+            metrics.errors.inc(1, error_class(e))
+        logging.error("Failed to process the contents of '%s' in a batch due to error: %s", target_wiki_page, str(e))
+        result["error"] = toc_error_message(e, result["wiki_location"] or target_wiki_page)
+    return result
+
+def iter_batch_results(registry, urls, parallelism, engine=None):
+    """ Yields a line of json for each of urls, in the order in which they complete
+        No more than parallelism pages are fetched at the same time, by the workers of engine, which should be the batch
+        engine rather than the one used by the other views, or by a thread for each page if there is no engine.
+    """
+    completed = Queue.Queue()
+    def run(index, target_wiki_page):
+        completed.put(get_batch_result(registry, index, target_wiki_page))
+
+    next_index = 0
+    pending = 0
+    while next_index < len(urls) or pending:
+        # Keep up to parallelism pages in flight
+        while next_index < len(urls) and pending < parallelism:
+            if engine is None:
+                thread = threading.Thread(target=run, args=(next_index, urls[next_index]), name="wiki_toc-batch")
+                thread.daemon = True
+                thread.start()
+            else:
+                try:
+                    engine.submit(run, next_index, urls[next_index])
+                except EngineBusy, e:
+                    if pending:
+                        # Wait for one of this batch's pages to finish before trying again
+                        break
+                    completed.put(dict(index=next_index, url=urls[next_index], wiki_location=None, toc=None,
+                                       error=toc_error_message(e, urls[next_index])))
+            next_index += 1
+            pending += 1
+        yield json.dumps(completed.get()) + "\n"
+        pending -= 1
+
+@view_config(route_name='wiki_toc_batch', request_method='POST')
+def wiki_toc_batch(request):
+    """ This view accepts a json list of wikipedia urls, or an object with the list as 'urls', and fetches their tables
+        of contents in parallel. The results are streamed back as one json object per line as each page completes:
+            {"index": <position in the list>, "url": ..., "wiki_location": ..., "toc": <tree or null>, "error": <message or null>}
+        The urls are interpreted in the same way as those posted to choose_wiki_page.
+    """
+    settings = request.registry.settings or {}
+    try:
+        urls = request.json_body
+        if isinstance(urls, dict):
+            urls = urls.get("urls")
+    except ValueError:
+        urls = None
+    if not isinstance(urls, list) or not all(isinstance(url, basestring) for url in urls):
+        raise exc.HTTPBadRequest("Expected a json list of wikipedia urls.")
+
+    max_urls = int(settings.get("wiki_toc.batch.max_urls", 10000))
+    if len(urls) > max_urls:
+        raise exc.HTTPRequestEntityTooLarge("No more than %d urls may be requested at once." % max_urls)
+
+    parallelism = int(settings.get("wiki_toc.batch.parallelism", 8))
+    app_iter = iter_batch_results(request.registry, urls, parallelism, getattr(request.registry, "batch_engine", None))
+    return Response(app_iter=app_iter, content_type="application/x-ndjson", charset="utf-8")
+
+@view_config(route_name='wiki_toc_json', renderer='json')
+def wiki_toc_json(request):
+    """ This view returns the table of contents for a wikipedia page as a json tree for machine clients
+        The tree is described in extractor.py. It is returned as it was extracted, without rendering any html:
+            {"wiki_location": ..., "toc": <tree or null>, "errors": [...]}
+        The status of the response is 404 if the page has no table of contents and 5xx if it could not be fetched.
+    """
+    wiki_location = "/".join(request.matchdict["wiki_location"])
+    result = dict(wiki_location=wiki_location, toc=None, errors=[])
+    if not wiki_location:
+        request.response.status_int = 400
+        result["errors"].append("No wikipedia location has been provided.")
+        return result
+
+    timer = get_timer(request)
+    try:
+        result["toc"] = json_toc(get_toc(request.registry, wiki_location, get_fetch_engine(request.registry), timer))
+        if not result["toc"]:
+            request.response.status_int = 404
+            result["errors"].append("No table of contents is available.")
+    except BaseException, e:
+        timer.count_error(e)
+        logging.error("Failed to process the contents of '%s' due to error: %s", wiki_location, str(e))
+        if isinstance(e, EngineBusy):
+            request.response.status_int = 503
+            request.response.headers["Retry-After"] = "1"
+        elif isinstance(e, UpstreamUnavailable):
+            request.response.status_int = 503
+            request.response.headers["Retry-After"] = retry_after_header(e)
+        elif isinstance(e, EngineTimeout):
+            request.response.status_int = 504
+        else:
+            request.response.status_int = 502
+        result["errors"].append(toc_error_message(e, wiki_location))
+    return result
+
+@view_config(route_name='cache_stats', renderer='json')
+def cache_stats(request):
+    """ This view returns the counters for the toc cache, the number of coalesced requests, the counters for background
+        refreshes, the counters for the precomputed index and the rendered page cache and the state of the upstream
+        circuit breakers as json
+    """
+    toc_cache = getattr(request.registry, "toc_cache", None)
+    if toc_cache is None:
+        stats = dict(enabled=False)
+    else:
+        stats = toc_cache.stats()
+        stats["enabled"] = True
+    # Requests which waited for another request to fetch the same page
+    stats["coalesced"] = get_toc_flights(request.registry).stats()["coalesced"]
+    # Stale tables of contents which were refreshed in the background
+    stats["refreshes"] = get_refresher(request.registry).stats()
+    toc_index = getattr(request.registry, "toc_index", None)
+    if toc_index is not None:
+        stats["index"] = toc_index.stats()
+    response_cache = getattr(request.registry, "response_cache", None)
+    if response_cache is not None:
+        stats["responses"] = response_cache.stats()
+    batch_engine = getattr(request.registry, "batch_engine", None)
+    if batch_engine is not None:
+        stats["batch_engine"] = batch_engine.stats()
+    # Requests which were not sent to wikipedia, and the state of the circuit breaker for each of its hosts
+    guard = get_fetcher(request.registry).guard
+    if guard is not None:
+        stats["upstream"] = guard.stats()
+    return stats
+
+@view_config(route_name='metrics')
+def metrics(request):
+    """ This view returns the latency histograms, byte counts and error counters in the Prometheus text format
+    """
+    metrics = getattr(request.registry, "metrics", None)
+    if metrics is None:
+        raise exc.HTTPNotFound("Metrics are not enabled.")
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4", charset="utf-8")
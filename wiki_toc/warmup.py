@@ -0,0 +1,386 @@
+""" Warming the caches after a deploy or restart.
+
+    Requests for tables of contents are counted by a Popularity in which recent requests count for more than older
+    ones; the weight of a request halves every half_life seconds. The most requested locations are saved to a json
+    file, the popularity list, so that a new worker can fill its cache with them, from a few threads and within a time
+    budget, while it starts serving requests. A WarmupScheduler saves the list periodically and can also prefetch the
+    most requested pages shortly before their cached tables of contents expire.
+
+    The wiki_toc_warmup command fills the shared sqlite cache in the same way from outside the app, from the popularity
+    list or from the /wiki_toc requests in an access log.
+"""
+import argparse
+import atexit
+import heapq
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import timeit
+import urllib
+import urlparse
+from collections import deque
+from operator import itemgetter
+
+from pyramid.settings import asbool
+
+from .cache import normalize_key
+from .upstream import UpstreamUnavailable
+from .views import get_fetcher, get_toc_flights, load_toc, wikipedia_scheme
+
+clock = timeit.default_timer
+
+# The routes whose requests are counted
+popular_routes = frozenset(["wiki_toc", "wiki_toc_json"])
+
+_access_log_request = re.compile(r'"(?:GET|HEAD) /wiki_toc(?:_json)?/([^ "?#]+)')
+
+
+class Popularity(object):
+    """ Counts the requests for each wiki location, weighting recent requests more than older ones
+        Rather than decaying every score as time passes, each new request is given a weight which doubles every
+        half_life seconds. Only the max_entries most requested locations are kept.
+    """
+
+    def __init__(self, half_life=3600.0, max_entries=10000, now=None):
+        self.half_life = half_life
+        self.max_entries = max_entries
+        self.requests = 0
+        self._scores = {}
+        self._epoch = now or time.time()
+        self._lock = threading.Lock()
+
+    def record(self, wiki_location, now=None):
+        """ Counts a request for wiki_location made at now
+        """
+        self._add(normalize_key(wiki_location), 1.0, now or time.time())
+        with self._lock:
+            self.requests += 1
+
+    def _add(self, key, count, now):
+        with self._lock:
+            half_lives = (now - self._epoch) / self.half_life
+            if half_lives > 20:
+                # Rescale the scores so that the weights do not grow without bound
+                decay = 2.0 ** -half_lives
+                for other_key in self._scores:
+                    self._scores[other_key] *= decay
+                self._epoch = now
+                half_lives = 0
+            self._scores[key] = self._scores.get(key, 0.0) + count * 2.0 ** half_lives
+            if len(self._scores) > self.max_entries:
+                # Forget the least requested half so that trimming is not needed on every new location
+                self._scores = dict(heapq.nlargest(self.max_entries // 2, self._scores.iteritems(), key=itemgetter(1)))
+
+    def most_requested(self, count, now=None):
+        """ Returns up to count (wiki location, score) pairs, most requested first
+            A score is the number of requests made at now which its requests are worth.
+        """
+        with self._lock:
+            decay = 2.0 ** ((self._epoch - (now or time.time())) / self.half_life)
+            top = heapq.nlargest(count, self._scores.iteritems(), key=itemgetter(1))
+        return [(key, score * decay) for key, score in top]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._scores)
+
+    def save(self, path, count=1000):
+        """ Writes the count most requested locations to path, replacing it atomically
+        """
+        data = dict(saved=time.time(), locations=self.most_requested(count))
+        temporary_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(temporary_path, "w") as f:
+            json.dump(data, f)
+        os.rename(temporary_path, path)
+
+    def load(self, path):
+        """ Adds the locations saved in path by save and returns the number loaded, which is 0 if there is no file
+        """
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except IOError:
+            return 0
+        except ValueError, e:
+            logging.error("Ignoring the popularity list '%s': %s", path, str(e))
+            return 0
+        # A score saved some time ago is worth less now
+        now = time.time()
+        weight = 2.0 ** ((data.get("saved", now) - now) / self.half_life)
+        for wiki_location, score in data.get("locations", []):
+            self._add(normalize_key(wiki_location), score * weight, now)
+        return len(data.get("locations", []))
+
+    def stats(self):
+        with self._lock:
+            return dict(requests=self.requests, locations=len(self._scores))
+
+
+def read_access_log(lines):
+    """ Returns the wiki locations requested in the lines of an access log in the common or combined log format, most
+        requested first
+    """
+    counts = {}
+    for line in lines:
+        match = _access_log_request.search(line)
+        if match is not None:
+            wiki_location = normalize_key(urllib.unquote(match.group(1)))
+            counts[wiki_location] = counts.get(wiki_location, 0) + 1
+    return [wiki_location for wiki_location, count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))]
+
+
+def warm_location(registry, wiki_location, lead_time=0.0):
+    """ Loads the table of contents for wiki_location into the cache unless the cache already has one which is fresh
+        for at least lead_time more seconds, or the page is in the precomputed index. Returns True if it was loaded.
+        Raises the same errors as load_toc.
+    """
+    toc_cache = getattr(registry, "toc_cache", None)
+    if toc_cache is None:
+        return False
+    cache_key = normalize_key(wiki_location)
+    cached_entry = toc_cache.get_entry(cache_key, count=False)
+    if cached_entry is not None and cached_entry.expires - time.time() > lead_time:
+        return False
+    toc_index = getattr(registry, "toc_index", None)
+    if toc_index is not None and toc_index.lookup(cache_key)[0]:
+        return False
+    # Requests for the same page share the fetch
+    get_toc_flights(registry).do(cache_key, load_toc, wikipedia_scheme + cache_key, cache_key, toc_cache,
+                                 get_fetcher(registry), cached_entry)
+    return True
+
+def warm_up(registry, locations, concurrency=4, budget=30.0, lead_time=0.0, rate_share=0.5):
+    """ Calls warm_location for each of locations, in order, from concurrency threads
+        No location is started after budget seconds and warm_up returns by then; fetches which are still in progress
+        finish in the background. No more locations are started once the circuit breaker for wikipedia is open.
+        The warm-up only makes a request while it leaves at least (1 - rate_share) of the fetcher's upstream burst for
+        the requests of users, waiting for the rate limit otherwise.
+        Returns the number of locations which were fetched, skipped as they were already cached, failed and remaining.
+    """
+    started = clock()
+    deadline = started + budget
+    pending = deque(locations)
+    lock = threading.Lock()
+    stats = dict(fetched=0, skipped=0, failed=0, remaining=0)
+    suspended = []
+    guard = getattr(get_fetcher(registry), "guard", None)
+
+    def wait(seconds):
+        """ Sleeps for up to seconds and returns False if the budget ran out first
+        """
+        remaining = deadline - clock()
+        time.sleep(max(min(seconds, remaining), 0))
+        return seconds < remaining
+
+    def worker():
+        while True:
+            with lock:
+                if suspended or clock() >= deadline or not pending:
+                    return
+                wiki_location = pending.popleft()
+            if guard is not None:
+                host = urlparse.urlsplit(wikipedia_scheme + normalize_key(wiki_location)).hostname
+                if not wait(guard.share_wait(host, rate_share)):
+                    with lock:
+                        pending.appendleft(wiki_location)
+                    return
+            try:
+                outcome = "fetched" if warm_location(registry, wiki_location, lead_time) else "skipped"
+            except UpstreamUnavailable, e:
+                if e.rate_limited:
+                    # Try the location again once the rate limit allows it
+                    with lock:
+                        pending.appendleft(wiki_location)
+                    if not wait(e.retry_after):
+                        return
+                    continue
+                logging.warning("Stopped warming the cache: %s", str(e))
+                outcome = "failed"
+                suspended.append(e)
+            except Exception, e:
+                logging.warning("Failed to warm the cache with '%s': %s", wiki_location, str(e))
+                outcome = "failed"
+            with lock:
+                stats[outcome] += 1
+
+    threads = [threading.Thread(target=worker, name="wiki_toc-warmup-%d" % index) for index in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(max(deadline - clock(), 0))
+    with lock:
+        # Taking the remaining locations also stops the workers from starting any more of them
+        stats["remaining"] = len(pending)
+        pending.clear()
+        stats["elapsed"] = round(clock() - started, 3)
+        return dict(stats)
+
+
+class WarmupScheduler(object):
+    """ Every interval seconds, saves popularity to path and prefetches the prefetch_count most requested pages whose
+        tables of contents are missing or expire within lead_time seconds
+    """
+
+    def __init__(self, registry, popularity, interval=300.0, path=None, prefetch_count=0, lead_time=120.0,
+                 concurrency=2, rate_share=0.5):
+        self.registry = registry
+        self.popularity = popularity
+        self.interval = interval
+        self.path = path
+        self.prefetch_count = prefetch_count
+        self.lead_time = lead_time
+        self.concurrency = concurrency
+        self.rate_share = rate_share
+        self.last_prefetch = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def save(self):
+        """ Saves the popularity list, if there is a path for it, logging rather than raising any error
+        """
+        if self.path:
+            try:
+                self.popularity.save(self.path)
+            except (IOError, OSError), e:
+                logging.error("Failed to save the popularity list '%s': %s", self.path, str(e))
+
+    def run_once(self):
+        if self.prefetch_count:
+            locations = [wiki_location for wiki_location, score in self.popularity.most_requested(self.prefetch_count)]
+            self.last_prefetch = warm_up(self.registry, locations, self.concurrency, self.interval / 2.0, self.lead_time,
+                                         self.rate_share)
+        self.save()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception, e:
+                logging.error("The warm-up scheduler failed: %s", str(e))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="wiki_toc-warmup-scheduler")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def popularity_tween_factory(handler, registry):
+    """ Counts the successful requests for tables of contents in registry.popularity
+    """
+    popularity = registry.popularity
+
+    def popularity_tween(request):
+        response = handler(request)
+        route = getattr(request, "matched_route", None)
+        if route is not None and route.name in popular_routes and response.status_int in (200, 304):
+            wiki_location = "/".join(request.matchdict.get("wiki_location") or ())
+            if wiki_location:
+                popularity.record(wiki_location)
+        return response
+    return popularity_tween
+
+
+def popularity_from_settings(settings):
+    """ Returns a Popularity, loaded from the popularity list, for the 'wiki_toc.warmup.*' settings or None if
+        warm-up is disabled
+    """
+    if not asbool(settings.get("wiki_toc.warmup.enabled", True)):
+        return None
+    popularity = Popularity(half_life=float(settings.get("wiki_toc.warmup.half_life", 3600.0)))
+    path = settings.get("wiki_toc.warmup.popularity_path")
+    if path:
+        popularity.load(path)
+    return popularity
+
+def start_warmup(registry, settings):
+    """ Warms registry's cache with the most requested locations in registry.popularity and starts a WarmupScheduler,
+        according to the 'wiki_toc.warmup.*' settings. Returns the scheduler or None if one is not needed.
+        The warm-up runs in the background unless wiki_toc.warmup.blocking is set.
+    """
+    popularity = getattr(registry, "popularity", None)
+    if popularity is None or getattr(registry, "toc_cache", None) is None:
+        return None
+    path = settings.get("wiki_toc.warmup.popularity_path") or None
+    count = int(settings.get("wiki_toc.warmup.count", 200))
+    rate_share = float(settings.get("wiki_toc.warmup.rate_share", 0.5))
+    locations = [wiki_location for wiki_location, score in popularity.most_requested(count)]
+    if locations:
+        arguments = (registry, locations, int(settings.get("wiki_toc.warmup.concurrency", 4)),
+                     float(settings.get("wiki_toc.warmup.budget", 30.0)), 0.0, rate_share)
+        if asbool(settings.get("wiki_toc.warmup.blocking", False)):
+            logging.info("Warmed the cache: %s", warm_up(*arguments))
+        else:
+            thread = threading.Thread(target=warm_up, args=arguments, name="wiki_toc-warmup")
+            thread.daemon = True
+            thread.start()
+
+    prefetch_count = int(settings.get("wiki_toc.warmup.prefetch_count", 0))
+    if not path and not prefetch_count:
+        return None
+    scheduler = WarmupScheduler(registry, popularity, interval=float(settings.get("wiki_toc.warmup.interval", 300.0)),
+                                path=path, prefetch_count=prefetch_count,
+                                lead_time=float(settings.get("wiki_toc.warmup.prefetch_lead_time", 120.0)),
+                                rate_share=rate_share)
+    # Save the requests made since the last save when the worker exits
+    atexit.register(scheduler.save)
+    return scheduler.start()
+
+
+def main(argv=None):
+    from pyramid.paster import get_appsettings, setup_logging
+    from . import main as make_app
+
+    parser = argparse.ArgumentParser(description="Fill the shared table of contents cache with the most requested pages.")
+    parser.add_argument("config_uri", help="the app's .ini file, eg: production.ini")
+    parser.add_argument("--access-log", default=None,
+                        help="warm the pages requested in this access log rather than those in the popularity list")
+    parser.add_argument("--count", type=int, default=None, help="the number of pages to warm")
+    parser.add_argument("--concurrency", type=int, default=None, help="the number of pages fetched at the same time")
+    parser.add_argument("--budget", type=float, default=None, help="stop starting new pages after this many seconds")
+    args = parser.parse_args(argv)
+
+    setup_logging(args.config_uri)
+    settings = dict(get_appsettings(args.config_uri))
+    count = args.count if args.count is not None else int(settings.get("wiki_toc.warmup.count", 200))
+    concurrency = args.concurrency or int(settings.get("wiki_toc.warmup.concurrency", 4))
+    budget = args.budget if args.budget is not None else float(settings.get("wiki_toc.warmup.budget", 30.0))
+    path = settings.get("wiki_toc.warmup.popularity_path")
+    # The app warms nothing itself and the command leaves the popularity list alone
+    settings.update({"wiki_toc.warmup.count": "0", "wiki_toc.warmup.popularity_path": "",
+                     "wiki_toc.warmup.prefetch_count": "0"})
+    app = make_app({}, **settings)
+
+    if args.access_log:
+        with open(args.access_log) as f:
+            locations = read_access_log(f)[:count]
+    else:
+        popularity = Popularity(half_life=float(settings.get("wiki_toc.warmup.half_life", 3600.0)))
+        if path:
+            popularity.load(path)
+        locations = [wiki_location for wiki_location, score in popularity.most_requested(count)]
+
+    try:
+        stats = warm_up(app.registry, locations, concurrency, budget)
+    finally:
+        for engine in (getattr(app.registry, "fetch_engine", None), getattr(app.registry, "batch_engine", None)):
+            if engine is not None:
+                engine.stop()
+        app.registry.fetcher.close()
+    sys.stderr.write("Warmed %(fetched)d pages in %(elapsed).1fs: %(skipped)d were already cached, %(failed)d failed "
+                     "and %(remaining)d were not started\n" % stats)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())